@@ -0,0 +1,107 @@
+"""
+Time and memory-profile the CWAS pipeline on synthetic datasets of increasing size.
+
+    python benchmarks/benchmark_pipeline.py --workdir /scratch/cwas_benchmark \
+        --n_subjects 100 1000 5000 --n_rois 100 400 1000 --n_jobs 8
+
+Datasets are generated once in the work directory and reused by later runs.
+Each pipeline run is done in a fresh process so its peak memory is measured on its own.
+Results (one row per configuration and stage, plus the full run) are saved in benchmark_results.tsv.
+"""
+import os
+import json
+import time
+import argparse
+import itertools
+import multiprocessing as mp
+
+import numpy as np
+import pandas as pd
+
+from cwas_rsfmri.synthetic import generate_bids_dataset
+from cwas_rsfmri.workflow import run_pipeline
+from cwas_rsfmri.profiling import peak_rss_mb
+from cwas_rsfmri.triangle import ConnectomeTriangle
+
+
+def synthetic_dataset(workdir, n_subjects, n_rois, n_jobs):
+    """
+    Generate a dataset unless it is already in the work directory.
+    """
+    bids_dir = os.path.join(workdir, f'bids_sub-{n_subjects}_roi-{n_rois}')
+    if not os.path.exists(os.path.join(bids_dir, 'synthetic_ground_truth.tsv')):
+        return generate_bids_dataset(bids_dir, n_subjects=n_subjects, n_rois=n_rois, n_jobs=n_jobs)
+
+    triangle = ConnectomeTriangle(n_rois)
+    ground_truth = pd.read_csv(os.path.join(bids_dir, 'synthetic_ground_truth.tsv'), sep='\t')
+    planted = np.zeros(triangle.n_edges, dtype=bool)
+    planted[ground_truth['row'] * (ground_truth['row'] + 1) // 2 + ground_truth['col']] = True
+    return {'bids_dir': bids_dir, 'phenotype_file': os.path.join(bids_dir, 'phenotype.tsv'),
+            'atlas_file': os.path.join(bids_dir, 'synthetic.tsv'), 'atlas': 'synthetic',
+            'session': 'timepoint1', 'task': 'task01', 'run': '01', 'feature': 'denoiseSimple',
+            'case_name': 'NDD', 'control_name': 'HC', 'planted': planted}
+
+
+def run_case(dataset, output_dir, options, queue):
+    start = time.perf_counter()
+    summary = run_pipeline(bids_dir=dataset['bids_dir'], output_dir=output_dir,
+                           pheno_p=dataset['phenotype_file'], atlas_file=dataset['atlas_file'],
+                           atlas=dataset['atlas'], group='diagnosis', scanner=True, sequence=False,
+                           medication=False, case_name=dataset['case_name'],
+                           control_name=dataset['control_name'], session=dataset['session'],
+                           task=dataset['task'], run=dataset['run'], feature=dataset['feature'], **options)
+    table = pd.read_csv(summary['results_table'], sep='\t')
+    significant = table['pvals'].values < 0.05 / len(table)
+    queue.put({
+        'wall_s': round(time.perf_counter() - start, 3),
+        'peak_rss_mb': peak_rss_mb(),
+        'subjects': summary['n_subjects'],
+        'edges': summary['n_edges'],
+        'sensitivity': float(significant[dataset['planted']].mean()),
+    })
+
+
+def benchmark(workdir, n_subjects, n_rois, options, n_jobs=1, repeat=1):
+    os.makedirs(workdir, exist_ok=True)
+    context = mp.get_context('spawn')
+    rows = []
+    for n_sub, n_roi in itertools.product(n_subjects, n_rois):
+        dataset = synthetic_dataset(workdir, n_sub, n_roi, n_jobs)
+        for repetition in range(repeat):
+            output_dir = os.path.join(workdir, f'output_sub-{n_sub}_roi-{n_roi}_rep-{repetition}')
+            queue = context.Queue()
+            process = context.Process(target=run_case, args=(dataset, output_dir, options, queue))
+            process.start()
+            total = queue.get()
+            process.join()
+
+            with open(os.path.join(output_dir, 'cwas_report.json'), 'r') as f:
+                profile = json.load(f)['profile']
+            config = {'n_subjects': n_sub, 'n_rois': n_roi, 'repetition': repetition}
+            for stage, values in {**profile['shared'], **profile['stages']}.items():
+                rows.append(dict(config, stage=stage, **values))
+            rows.append(dict(config, stage='run_pipeline', **total))
+            print(f"📌 {n_sub} subjects, {n_roi} ROIs: {total['wall_s']:.1f}s, peak RSS {total['peak_rss_mb']} MB")
+    return pd.DataFrame(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the CWAS pipeline on synthetic datasets")
+    parser.add_argument("--workdir", required=True, help="Directory of the synthetic datasets and outputs")
+    parser.add_argument("--n_subjects", type=int, nargs="+", default=[100, 1000], help="Numbers of subjects")
+    parser.add_argument("--n_rois", type=int, nargs="+", default=[100, 400], help="Numbers of ROIs")
+    parser.add_argument("--n_jobs", type=int, default=1, help="Processes generating data and threads of the pipeline")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs of each configuration")
+    parser.add_argument("--max_memory", type=str, default=None, help="Memory budget passed to the pipeline")
+    parser.add_argument("--n_perm", type=int, default=0, help="Permutations passed to the pipeline")
+    parser.add_argument("--output", type=str, default="benchmark_results.tsv", help="Results table")
+    args = parser.parse_args()
+
+    options = {'n_jobs': args.n_jobs, 'max_memory': args.max_memory, 'n_perm': args.n_perm, 'seed': 0}
+    results = benchmark(args.workdir, args.n_subjects, args.n_rois, options, n_jobs=args.n_jobs, repeat=args.repeat)
+    results.to_csv(args.output, sep='\t', index=False)
+    print(f"\n✅ Benchmark results saved in: {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+import os
+import json
+
+# BEP-017 entities used to select connectomes and confounds
+BIDS_ENTITIES = ['sub', 'ses', 'task', 'run', 'seg', 'meas', 'desc']
+# Session or run label selecting every label of the entity, whose runs are averaged
+AGGREGATE_LABEL = 'all'
+
+
+def parse_bids_filename(filename):
+    """
+    Split a BIDS filename into its entities, suffix and extension.
+    """
+    stem, dot, extension = filename.partition('.')
+    parts = stem.split('_')
+    if len(parts) < 2 or not parts[0].startswith('sub-'):
+        return None
+
+    record = {'suffix': parts[-1], 'extension': dot + extension}
+    key = None
+    for part in parts[:-1]:
+        if '-' in part:
+            key, _, value = part.partition('-')
+            record[key] = value
+        else:
+            # Labels such as seg-example_atlas contain an underscore
+            record[key] += '_' + part
+    return record
+
+
+def scan_bids_derivatives(bids_dir):
+    """
+    Walk the subject folders of a BIDS derivatives tree once with os.scandir.
+    Returns the parsed files and the modification time of every folder visited.
+    """
+    records = []
+    directories = {}
+    stack = [entry.path for entry in os.scandir(bids_dir)
+             if entry.name.startswith('sub-') and entry.is_dir()]
+    directories[os.path.abspath(bids_dir)] = os.stat(bids_dir).st_mtime_ns
+
+    while stack:
+        directory = stack.pop()
+        directories[os.path.abspath(directory)] = os.stat(directory).st_mtime_ns
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    stack.append(entry.path)
+                    continue
+                record = parse_bids_filename(entry.name)
+                if record is not None:
+                    record['path'] = os.path.abspath(entry.path)
+                    records.append(record)
+
+    return records, directories
+
+
+def records_to_index(records):
+    import pandas as pd
+    columns = ['participant_id'] + BIDS_ENTITIES + ['suffix', 'extension', 'path']
+    bids_index = pd.DataFrame.from_records(records)
+    bids_index = bids_index.reindex(columns=columns + [c for c in bids_index.columns if c not in columns])
+    bids_index['participant_id'] = 'sub-' + bids_index['sub']
+    return bids_index
+
+
+def index_bids_derivatives(bids_dir, cache_path=None):
+    """
+    Build the table of BEP-017 files in the BIDS directory.
+    With cache_path, the index is saved and reused as long as no folder of the
+    tree has been modified (files added, removed or renamed).
+    """
+    print("⏳ Indexing BIDS derivatives ...")
+
+    if cache_path is not None and os.path.exists(cache_path):
+        with open(cache_path, 'r') as f:
+            cache = json.load(f)
+        if cache.get('bids_dir') == os.path.abspath(bids_dir) and all(
+                os.path.isdir(d) and os.stat(d).st_mtime_ns == mtime for d, mtime in cache['directories'].items()):
+            print(f"✅ BIDS index loaded from cache: {cache_path} ({len(cache['records'])} files)\n")
+            return records_to_index(cache['records'])
+
+    records, directories = scan_bids_derivatives(bids_dir)
+
+    if cache_path is not None:
+        with open(cache_path, 'w') as f:
+            json.dump({'bids_dir': os.path.abspath(bids_dir), 'directories': directories, 'records': records}, f)
+
+    print(f"✅ BIDS index built: {len(records)} files in {len(directories)} folders\n")
+    return records_to_index(records)
+
+
+def select_files(bids_index, participant_ids, suffix, extension, **entities):
+    """
+    Rows of the index matching the entities (None = entity absent, AGGREGATE_LABEL = any label).
+    """
+    selected = (bids_index['suffix'] == suffix) & (bids_index['extension'] == extension)
+    selected &= bids_index['participant_id'].isin(set(participant_ids))
+    for key, value in entities.items():
+        if value is None:
+            selected &= bids_index[key].isnull() if key in bids_index else True
+        elif value == AGGREGATE_LABEL:
+            continue
+        elif key in bids_index:
+            selected &= bids_index[key] == str(value)
+        else:
+            return bids_index.iloc[:0]
+    return bids_index.loc[selected]
+
+
+def is_canonical_path(path, participant_id, session):
+    """
+    Whether a file sits in the func folder of its participant and session (sub-X/ses-Y/func).
+    """
+    import pandas as pd
+    folders = [participant_id] + ([] if pd.isnull(session) else [f'ses-{session}']) + ['func']
+    return os.path.normpath(path).split(os.sep)[-len(folders) - 1:-1] == folders
+
+
+def select_canonical(matches, keys, description):
+    """
+    One file for each value of keys: a file in the canonical sub-X/ses-Y/func folder is preferred
+    over copies elsewhere in the tree, and several remaining candidates raise an error.
+    """
+    import pandas as pd
+    canonical = pd.Series([is_canonical_path(*row) for row in matches[['path', 'participant_id', 'ses']].values],
+                          index=matches.index, dtype=bool)
+    groups = [matches[key].fillna('') for key in keys]
+    matches = matches.loc[canonical | ~canonical.groupby(groups).transform('any')]
+
+    duplicated = matches.duplicated(keys, keep=False)
+    if duplicated.any():
+        ambiguous = matches.loc[duplicated].groupby('participant_id')['path'].apply(list).to_dict()
+        raise ValueError(f"❌ Several {description} files match the same participant: {ambiguous}")
+    return matches
+
+
+def find_files(bids_index, participant_ids, suffix, extension, **entities):
+    """
+    Path of the file matching the entities for each participant (None = entity absent).
+    Returns a Series indexed by participant_id; participants without a file are left out.
+    With aggregated sessions or runs (AGGREGATE_LABEL), the first run of each participant is returned.
+    """
+    import pandas as pd
+    matches = select_files(bids_index, participant_ids, suffix, extension, **entities)
+    aggregated = [key for key in ['ses', 'run'] if entities.get(key) == AGGREGATE_LABEL]
+    matches = select_canonical(matches, ['participant_id'] + aggregated, suffix + extension)
+    matches = matches.sort_values(['participant_id'] + aggregated, na_position='first')
+    matches = matches.drop_duplicates('participant_id')
+    return pd.Series(matches['path'].values, index=matches['participant_id'].values, dtype=object)
+
+
+def run_label(participant_id, session, run):
+    """
+    Identifier of one run of a participant, e.g. sub-01_ses-1_run-2 (absent entities are left out).
+    """
+    import pandas as pd
+    entities = [f'{key}-{value}' for key, value in [('ses', session), ('run', run)] if not pd.isnull(value)]
+    return '_'.join([participant_id] + entities)
+
+
+def find_runs(bids_index, participant_ids, suffix, extension, **entities):
+    """
+    Every file matching the entities, one row per run of each participant, sorted by participant,
+    session and run. Returns a table of participant_id, ses, run and path indexed by run_label.
+    """
+    import pandas as pd
+    matches = select_files(bids_index, participant_ids, suffix, extension, **entities)
+    matches = select_canonical(matches, ['participant_id', 'ses', 'run'], suffix + extension)
+    runs = matches.reindex(columns=['participant_id', 'ses', 'run', 'path'])
+    runs = runs.sort_values(['participant_id', 'ses', 'run'], na_position='first')
+    runs.index = pd.Index([run_label(*row) for row in runs[['participant_id', 'ses', 'run']].values], dtype=object)
+    return runs
+
+
+def find_connectome_files(bids_index, participant_ids, session, task, run, atlas, feature):
+    return find_files(bids_index, participant_ids, suffix='relmat', extension='.tsv',
+                      ses=session, task=task, run=run, seg=atlas, meas='PearsonCorrelation', desc=feature)
+
+
+def find_confounds_files(bids_index, participant_ids, session, task, run, feature):
+    return find_files(bids_index, participant_ids, suffix='timeseries', extension='.json',
+                      ses=session, task=task, run=run, seg=None, meas=None, desc=feature)
+
+
+def find_connectome_runs(bids_index, participant_ids, session, task, run, atlas, feature):
+    return find_runs(bids_index, participant_ids, suffix='relmat', extension='.tsv',
+                     ses=session, task=task, run=run, seg=atlas, meas='PearsonCorrelation', desc=feature)
+
+
+def find_confounds_runs(bids_index, participant_ids, session, task, run, feature):
+    return find_runs(bids_index, participant_ids, suffix='timeseries', extension='.json',
+                     ses=session, task=task, run=run, seg=None, meas=None, desc=feature)
+
+
+def aggregates_runs(session, run):
+    """
+    Whether the connectomes of several sessions or runs are averaged for each participant.
+    """
+    return AGGREGATE_LABEL in (str(session), str(run))
@@ -0,0 +1,104 @@
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+
+from .files import read_report, report_file
+
+
+def file_signature(paths):
+    """
+    Size and modification time of input files, used in checkpoint keys.
+    """
+    signature = []
+    for path in paths:
+        stat = os.stat(path)
+        signature.append([os.path.abspath(path), stat.st_size, stat.st_mtime_ns])
+    return signature
+
+
+def stage_key(stage, params):
+    """
+    Hash of a stage name and of everything its output depends on.
+    """
+    payload = json.dumps([stage, params], default=str, sort_keys=True)
+    return hashlib.sha1(payload.encode()).hexdigest()[:16]
+
+
+def save_checkpoint(path, value, kind):
+    tmp_path = path + '.tmp'
+    if kind == 'stack':
+        # Connectome stack and the phenotype rows it belongs to; the stack, written last, marks the checkpoint as complete
+        conn_stack, pheno = value
+        pd.to_pickle(pheno, path + '.pkl.tmp')
+        os.replace(path + '.pkl.tmp', path + '.pkl')
+        with open(tmp_path, 'wb') as f:
+            np.save(f, conn_stack)
+    else:
+        pd.to_pickle(value, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path, kind):
+    if kind == 'stack':
+        return np.load(path, mmap_mode='r'), pd.read_pickle(path + '.pkl')
+    return pd.read_pickle(path)
+
+
+def compute_with_report(compute, report_dir):
+    """
+    Run a stage and return its output with the entries it wrote in cwas_report.json.
+    The stage writes to an empty report, the previous entries are put back afterwards.
+    """
+    report_path = os.path.join(report_dir, 'cwas_report.json')
+    previous = read_report(report_dir)
+    if os.path.exists(report_path):
+        os.remove(report_path)
+    entries = {}
+    try:
+        value = compute()
+        entries = read_report(report_dir)
+    finally:
+        if os.path.exists(report_path):
+            os.remove(report_path)
+        report_file(report_dir, dict(previous, **entries))
+    return value, entries
+
+
+def cached_stage(cache_dir, stage, params, compute, kind='pickle', report_dir=None):
+    """
+    Reuse the output of a stage if it was saved with the same key, otherwise compute and save it.
+    Returns the output and the key, which downstream stages include in their own parameters.
+    With report_dir, the entries the stage writes in cwas_report.json are saved with the
+    checkpoint and written again when it is reused.
+    """
+    key = stage_key(stage, params)
+    if cache_dir is None:
+        return compute(), key
+
+    os.makedirs(cache_dir, exist_ok=True)
+    extension = '.npy' if kind == 'stack' else '.pkl'
+    path = os.path.join(cache_dir, f'{stage}_{key}{extension}')
+    report_path = path + '.report.json'
+    if os.path.exists(path) and (report_dir is None or os.path.exists(report_path)):
+        print(f"♻️  Reusing checkpoint for stage '{stage}': {path}")
+        if report_dir is not None:
+            with open(report_path, 'r') as f:
+                report_file(report_dir, json.load(f))
+        return load_checkpoint(path, kind), key
+
+    if report_dir is None:
+        value = compute()
+    else:
+        # The report is saved first: the checkpoint, written last, marks the stage as complete
+        value, entries = compute_with_report(compute, report_dir)
+        with open(report_path, 'w') as f:
+            json.dump(entries, f, indent=4)
+    save_checkpoint(path, value, kind)
+    print(f"💾 Checkpoint saved for stage '{stage}': {path}")
+
+    # Continue from the saved stack so that any temporary stack can be removed
+    if kind == 'stack':
+        value = load_checkpoint(path, kind)
+    return value, key
@@ -1,41 +1,154 @@
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 import numpy as np
 import pandas as pd
 
+from .store import store_key, update_connectome_store
+from .bids_index import find_connectome_files
+from .triangle import as_triangle
+
 def conn2mat(conn, mask):
-    conn_mat = np.zeros(shape=mask.shape)
-    conn_mat[mask] = conn
-    conn_mat += conn_mat.T
-    conn_mat[np.eye(mask.shape[0]).astype(bool)] /= 2
+    # Symmetric matrix from the precomputed triangle indices, no mask or identity rebuilt
+    return as_triangle(mask).unpack(conn)
 
-    return conn_mat
+def read_connectome(path, conn_mask):
+    """
+    Read one relmat TSV and keep the packed lower triangle.
+    """
+    triangle = as_triangle(conn_mask)
+    return triangle.pack(pd.read_csv(path, sep='\t', dtype=triangle.dtype, engine='c').to_numpy())
 
-def process_connectivity_matrix(pheno_filtered_fd, connectome_t, feature, atlas, bids_dir, conn_mask, session, task, run):
+def read_mean_connectome(paths, weights, conn_mask):
     """
-    Process connectivity matrices for valid subjects
+    Weighted mean of the relmat files of several runs, read one run at a time
+    into a float64 running sum, so the run matrices are never held together.
     """
-    print("\n⏳ Process connectivity matrices for valid subjects ...")
+    triangle = as_triangle(conn_mask)
+    total = np.zeros(triangle.n_edges)
+    for path, weight in zip(paths, weights):
+        total += weight * read_connectome(path, triangle)
+    return total / np.sum(weights)
 
-       # Collect valid connectome paths
+def load_connectomes(paths, conn_mask, out, rows=None, n_jobs=1, weights=None):
+    """
+    Read relmat files straight into the rows of a preallocated array.
+    With weights, each item of paths lists the runs of one subject, whose weighted
+    mean is written in its row (see read_mean_connectome).
+    With n_jobs > 1, files are read by a thread pool with at most 2 * n_jobs
+    subjects in flight, so the row order never depends on completion order.
+    """
+    rows = range(len(paths)) if rows is None else rows
+    weights = [None] * len(paths) if weights is None else weights
+    triangle = as_triangle(conn_mask)
+
+    def load(row, path, weight):
+        out[row] = read_connectome(path, triangle) if weight is None else read_mean_connectome(path, weight, triangle)
+
+    if n_jobs == 1:
+        for row, path, weight in zip(rows, paths, weights):
+            load(row, path, weight)
+        return out
+
+    # Bounded prefetch: wait for the oldest file before submitting a new one
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        in_flight = deque()
+        for row, path, weight in zip(rows, paths, weights):
+            if len(in_flight) >= 2 * n_jobs:
+                in_flight.popleft().result()
+            in_flight.append(pool.submit(load, row, path, weight))
+        while in_flight:
+            in_flight.popleft().result()
+    return out
+
+def find_connectome_paths(pheno, connectome_t, feature, atlas, bids_dir, session, task, run, bids_index=None):
+    """
+    Relmat file and phenotype index of each subject with a connectome.
+    """
     valid_subject_paths = []
     valid_subject_indices = []
-    
-    for index, row in tqdm(pheno_filtered_fd.iterrows()):
-        connectome_file = os.path.join(
-            bids_dir,
-            connectome_t.format(
-                row['participant_id'], session, 
-                row['participant_id'], session, 
-                task, run, atlas, feature
+
+    if bids_index is not None:
+        connectome_files = find_connectome_files(bids_index, pheno['participant_id'],
+                                                 session, task, run, atlas, feature)
+        has_file = pheno['participant_id'].isin(connectome_files.index)
+        valid_subject_indices = pheno.index[has_file].tolist()
+        valid_subject_paths = connectome_files.loc[pheno.loc[has_file, 'participant_id']].tolist()
+    else:
+        for index, row in tqdm(pheno.iterrows()):
+            connectome_file = os.path.join(
+                bids_dir,
+                connectome_t.format(
+                    row['participant_id'], session, 
+                    row['participant_id'], session, 
+                    task, run, atlas, feature
+                )
             )
-        )
-        if os.path.exists(connectome_file):  # Check if file exists
-            valid_subject_paths.append(connectome_file)
-            valid_subject_indices.append(index)  # Store index of valid subjects
+            if os.path.exists(connectome_file):  # Check if file exists
+                valid_subject_paths.append(connectome_file)
+                valid_subject_indices.append(index)  # Store index of valid subjects
+
+    return valid_subject_paths, valid_subject_indices
+
+def process_connectivity_matrix(pheno_filtered_fd, connectome_t, feature, atlas, bids_dir, conn_mask, session, task, run,
+                                stack_path=None, store_dir=None, n_jobs=1, bids_index=None, runs=None):
+    """
+    Process connectivity matrices for valid subjects.
+    With runs (participant_id, path and weight of the selected runs, see runs.aggregate_runs),
+    the connectome of each subject is the weighted mean of its runs, streamed one run at a time.
+    If stack_path is given, the stack is written to a memory-mapped .npy file
+    one subject at a time instead of being held in memory.
+    If store_dir is given, connectomes are read from the persistent connectome
+    store, which is first updated for new or modified relmat files.
+    Relmat files are read by n_jobs threads and, when a BIDS index is given,
+    resolved from the index instead of probing the filesystem.
+    """
+    print("\n⏳ Process connectivity matrices for valid subjects ...")
+    triangle = as_triangle(conn_mask)
+
+    # Collect valid connectome paths
+    run_weights = None
+    if runs is not None:
+        subject_runs = runs.groupby('participant_id', sort=False)
+        has_runs = pheno_filtered_fd['participant_id'].isin(runs['participant_id'])
+        valid_subject_indices = pheno_filtered_fd.index[has_runs].tolist()
+        subjects = pheno_filtered_fd.loc[has_runs, 'participant_id']
+        valid_subject_paths = [subject_runs.get_group(sub)['path'].tolist() for sub in subjects]
+        run_weights = [subject_runs.get_group(sub)['weight'].tolist() for sub in subjects]
+    else:
+        valid_subject_paths, valid_subject_indices = find_connectome_paths(
+            pheno_filtered_fd, connectome_t, feature, atlas, bids_dir, session, task, run, bids_index=bids_index)
 
     # Stack connectome data
-    conn_stack = np.array([pd.read_csv(p, sep='\t').values[conn_mask] for p in valid_subject_paths])
+    if store_dir is not None and runs is not None:
+        raise ValueError("❌ The connectome store holds single runs and cannot be combined with run aggregation")
+    if store_dir is not None:
+        subjects = pheno_filtered_fd.loc[valid_subject_indices, 'participant_id'].tolist()
+        conn_store, store_rows = update_connectome_store(
+            store_dir, store_key(session, task, run, atlas, feature, triangle.dtype),
+            subjects, valid_subject_paths, triangle, dtype=triangle.dtype, n_jobs=n_jobs
+            )
+        if np.array_equal(store_rows, np.arange(conn_store.shape[0])):
+            # Same subjects in the same order: use the store without copying
+            conn_stack = conn_store
+        elif stack_path is None:
+            conn_stack = np.asarray(conn_store[store_rows])
+        else:
+            conn_stack = np.lib.format.open_memmap(stack_path, mode='w+', dtype=conn_store.dtype,
+                                                   shape=(len(store_rows), conn_store.shape[1]))
+            for sub_id, store_row in enumerate(store_rows):
+                conn_stack[sub_id] = conn_store[store_row]
+            conn_stack.flush()
+    else:
+        shape = (len(valid_subject_paths), triangle.n_edges)
+        if stack_path is None:
+            conn_stack = np.empty(shape, dtype=triangle.dtype)
+        else:
+            conn_stack = np.lib.format.open_memmap(stack_path, mode='w+', dtype=triangle.dtype, shape=shape)
+        load_connectomes(valid_subject_paths, triangle, conn_stack, n_jobs=n_jobs, weights=run_weights)
+        if stack_path is not None:
+            conn_stack.flush()
     
     print(f"\n📌 Processing statistics for feature {feature} with atlas {atlas}:")
     
@@ -0,0 +1,218 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+
+from .connectome import load_connectomes
+from .linear_model import fit_ols_crossproducts
+from .stats import build_design, find_contrast
+from .triangle import as_triangle
+
+# Arrays saved in a site file, on top of the JSON metadata
+SITE_ARRAYS = ['xtx', 'xty', 'yty', 'n_obs', 'n_control', 'control_sum', 'control_sumsq']
+
+
+def subject_block_size(n_data, max_memory=None, default=256):
+    """
+    Number of subjects read together so that a block stays within max_memory bytes.
+    """
+    if max_memory is None:
+        return default
+    # The block of connectomes and its squared copy
+    return int(max(max_memory // (n_data * 8 * 2), 1))
+
+
+def design_factors(dmat):
+    """
+    Levels and reference level of each categorical regressor of a patsy design coded against
+    a reference (columns 'name[T.level]'), so that sites that saw different levels, or kept a
+    different reference, can be lined up on one level set when they are merged.
+    """
+    factors = {}
+    info = dmat.design_info
+    for term, span in info.term_slices.items():
+        if len(term.factors) != 1 or info.factor_infos[term.factors[0]].type != 'categorical':
+            continue
+        name = term.factors[0].name()
+        levels = [str(level) for level in info.factor_infos[term.factors[0]].categories]
+        columns = info.column_names[span]
+        coded = [col[len(name) + 3:-1] for col in columns if col.startswith(f'{name}[T.') and col.endswith(']')]
+        reference = [level for level in levels if level not in coded]
+        if len(coded) == len(columns) and len(reference) == 1:
+            factors[name] = {'levels': levels, 'reference': reference[0]}
+    return factors
+
+
+def factor_columns(name, levels, reference):
+    """
+    Design column of each level of a categorical regressor but the reference.
+    """
+    return {level: f'{name}[T.{level}]' for level in levels if level != reference}
+
+
+def site_sufficient_stats(connectome_paths, pheno, group, case, control, conn_mask, regressors='',
+                          n_jobs=1, max_memory=None):
+    """
+    Cross-products X'X, X'Y, Y'Y of the site GLM, streamed over blocks of subjects.
+    pheno holds one row per connectome path. The sums of the controls are kept so that
+    the coordinator can standardize the betas with the pooled control variance.
+    """
+    sub_mask, case_masks, dmat = build_design(pheno, group, case, control, regressors)
+    paths = np.asarray(connectome_paths, dtype=object)[sub_mask]
+    design = dmat.to_numpy(dtype=np.float64)
+    control_mask = case_masks[control]
+
+    n_sub, n_data = len(paths), as_triangle(conn_mask).n_edges
+    stats = {
+        'xtx': design.T @ design,
+        'xty': np.zeros((design.shape[1], n_data)),
+        'yty': np.zeros(n_data),
+        'n_obs': n_sub,
+        'n_control': int(control_mask.sum()),
+        'control_sum': np.zeros(n_data),
+        'control_sumsq': np.zeros(n_data),
+    }
+
+    block_size = subject_block_size(n_data, max_memory)
+    buffer = np.empty((min(block_size, n_sub), n_data))
+    for start in range(0, n_sub, block_size):
+        stop = min(start + block_size, n_sub)
+        block = load_connectomes(paths[start:stop], conn_mask, buffer[:stop - start], n_jobs=n_jobs)
+        block_control = block[control_mask[start:stop]]
+
+        stats['xty'] += design[start:stop].T @ block
+        stats['yty'] += np.einsum('ij,ij->j', block, block)
+        stats['control_sum'] += block_control.sum(axis=0)
+        stats['control_sumsq'] += np.einsum('ij,ij->j', block_control, block_control)
+
+    stats['columns'] = list(dmat.columns)
+    stats['factors'] = design_factors(dmat)
+    return stats
+
+
+def save_sufficient_stats(path, stats, metadata):
+    """
+    Write the sufficient statistics of a site and what they were computed on.
+    """
+    metadata = dict(metadata, columns=stats['columns'], factors=stats['factors'])
+    np.savez(path, metadata=np.array(json.dumps(metadata)), **{name: stats[name] for name in SITE_ARRAYS})
+    print(f"✅ Sufficient statistics saved in: {path}")
+
+
+def load_sufficient_stats(path):
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"❌ Missing site statistics file: {path}")
+    with np.load(path, allow_pickle=False) as f:
+        stats = {name: f[name] for name in SITE_ARRAYS}
+        metadata = json.loads(str(f['metadata']))
+    stats['columns'] = metadata['columns']
+    stats['factors'] = metadata.get('factors', {})
+    return stats, metadata
+
+
+def merge_sufficient_stats(site_stats, site_names, site_effects=True):
+    """
+    Pool the cross-products of several sites into those of one GLM.
+    Design columns are aligned by name; a column missing at a site is zero for its subjects.
+    Categorical regressors are recoded on the union of the levels of all sites, against the
+    reference of the first site: a level a site did not see is zero for its subjects, and the
+    reference of a site that differs is its intercept minus its other levels.
+    With site_effects, one indicator per site but the first is added, built from the
+    intercept row of each site (the indicator equals the intercept for that site's subjects).
+    """
+    site_factors = [stats.get('factors', {}) for stats in site_stats]
+    factors = {}
+    for site in site_factors:
+        for name, factor in site.items():
+            levels = factors.setdefault(name, {'levels': [], 'reference': factor['reference']})['levels']
+            levels += [level for level in factor['levels'] if level not in levels]
+    missing = [name for name in factors if any(name not in site for site in site_factors)]
+    if missing:
+        raise ValueError(f"❌ Categorical regressors {missing} are not in the design of every site")
+    merged_columns = {name: factor_columns(name, **factor) for name, factor in factors.items()}
+    site_columns = [{name: factor_columns(name, **factor) for name, factor in site.items()} for site in site_factors]
+    owners = [{col: name for name, cols in site.items() for col in cols.values()} for site in site_columns]
+
+    # Other categorical columns (e.g. interactions) cannot be recoded and must be the same at every site
+    uncoded = [sorted(col for col in stats['columns'] if '[' in col and col not in owner)
+               for stats, owner in zip(site_stats, owners)]
+    if any(cols != uncoded[0] for cols in uncoded):
+        raise ValueError(f"❌ Sites have different categorical design columns: {dict(zip(site_names, uncoded))}")
+
+    columns = []
+    for stats, owner in zip(site_stats, owners):
+        for col in stats['columns']:
+            new = merged_columns[owner[col]].values() if col in owner else [col]
+            columns += [new_col for new_col in new if new_col not in columns]
+    for cols in merged_columns.values():
+        columns += [col for col in cols.values() if col not in columns]
+    if site_effects:
+        if any('Intercept' not in stats['columns'] for stats in site_stats):
+            raise ValueError("❌ Site effects need an intercept in every site design")
+        columns += [f'site[T.{name}]' for name in site_names[1:]]
+
+    n_data = {stats['yty'].shape[0] for stats in site_stats}
+    if len(n_data) != 1:
+        raise ValueError(f"❌ Sites have different numbers of edges: {sorted(n_data)}")
+    n_data = n_data.pop()
+
+    merged = {
+        'xtx': np.zeros((len(columns), len(columns))),
+        'xty': np.zeros((len(columns), n_data)),
+        'yty': np.zeros(n_data),
+        'n_obs': 0,
+        'n_control': 0,
+        'control_sum': np.zeros(n_data),
+        'control_sumsq': np.zeros(n_data),
+        'columns': columns,
+    }
+    for site_id, stats in enumerate(site_stats):
+        # Map of the site design onto the merged one: X_merged = X_site @ transform
+        site_cols = stats['columns']
+        transform = np.zeros((len(site_cols), len(columns)))
+        for i, col in enumerate(site_cols):
+            if col not in owners[site_id]:
+                transform[i, columns.index(col)] = 1
+        for name, factor in site_factors[site_id].items():
+            for level, col in merged_columns[name].items():
+                if level in site_columns[site_id][name]:
+                    transform[site_cols.index(site_columns[site_id][name][level]), columns.index(col)] = 1
+                elif level == factor['reference']:
+                    if 'Intercept' not in site_cols:
+                        raise ValueError(f"❌ The reference level of {name} differs between sites "
+                                         f"and site {site_names[site_id]} has no intercept to recode it")
+                    transform[site_cols.index('Intercept'), columns.index(col)] = 1
+                    for site_col in site_columns[site_id][name].values():
+                        transform[site_cols.index(site_col), columns.index(col)] = -1
+        if site_effects and site_id > 0:
+            # The site indicator is a copy of the intercept column
+            transform[site_cols.index('Intercept'), columns.index(f'site[T.{site_names[site_id]}]')] = 1
+
+        merged['xtx'] += transform.T @ stats['xtx'] @ transform
+        merged['xty'] += transform.T @ stats['xty']
+        for name in ['yty', 'n_obs', 'n_control', 'control_sum', 'control_sumsq']:
+            merged[name] = merged[name] + stats[name]
+
+    return merged
+
+
+def glm_sufficient_stats(stats, group):
+    """
+    Pooled GLM of the group contrast from merged sufficient statistics.
+    Returns the same table as glm_wrap_cc: betas, betas standardized on the controls, p-values.
+    """
+    contrast_id, _ = find_contrast(pd.DataFrame(columns=stats['columns']), group)[0]
+    intercept = stats['columns'].index('Intercept') if 'Intercept' in stats['columns'] else None
+    results = fit_ols_crossproducts(stats['xtx'], stats['xty'], stats['yty'], stats['n_obs'], intercept=intercept)
+
+    # Standard deviation of the controls, as used by standardize()
+    n_control = stats['n_control']
+    mean = stats['control_sum'] / n_control
+    var = np.clip(stats['control_sumsq'] / n_control - mean ** 2, 0, None)
+    scale = np.sqrt(var)
+    scale[var <= (n_control * np.abs(mean) * np.finfo(float).eps) ** 2] = 1
+
+    betas = results['betas'][contrast_id]
+    return pd.DataFrame(data={'betas': betas,
+                              'stand_betas': betas / scale,
+                              'pvals': results['pvals'][contrast_id]})
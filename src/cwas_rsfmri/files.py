@@ -1,9 +1,12 @@
 import os
+import re
 import json
-import numpy as np
-import pandas as pd
+import importlib.util
 from pathlib import Path
 
+# Formats of the results: text tables, or the packed edge table with the labels as metadata
+OUTPUT_FORMATS = ['tsv', 'npz', 'parquet']
+
 def bids_validation(bids_dir):
     """
     Validate BIDS directory structure.
@@ -37,6 +40,16 @@ def create_output_directory(out_p):
     print(f"✅ Output directory created at: {out_p}\n")
     return out_p
 
+def read_report(out_p):
+    """
+    Entries of cwas_report.json in out_p, empty if it was not written yet.
+    """
+    json_path = os.path.join(out_p, 'cwas_report.json')
+    if not os.path.exists(json_path):
+        return {}
+    with open(json_path, 'r') as f:
+        return json.load(f)
+
 def report_file(out_p, summary_data):
     json_path = os.path.join(out_p, 'cwas_report.json')
     if os.path.exists(json_path):
@@ -52,6 +65,68 @@ def report_file(out_p, summary_data):
     with open(json_path, 'w') as f:
         json.dump(existing_data, f, indent=4)
 
+def parse_memory(max_memory):
+    """
+    Convert a memory budget such as "8G" or "512M" into a number of bytes.
+    """
+    if max_memory is None or isinstance(max_memory, (int, float)):
+        return max_memory
+
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    value = str(max_memory).strip().upper().rstrip('B')
+    try:
+        if value and value[-1] in units:
+            return int(float(value[:-1]) * units[value[-1]])
+        return int(float(value))
+    except ValueError:
+        raise ValueError(f"❌ Invalid memory budget: {max_memory}. Expected a value such as 8G or 512M")
+
+def parse_shard(shard):
+    """
+    Convert a shard such as "2/8" (the second of 8 slices of the edges) into (2, 8).
+    """
+    if shard is None or isinstance(shard, tuple):
+        return shard
+    try:
+        index, count = (int(part) for part in str(shard).split('/'))
+    except ValueError:
+        raise ValueError(f"❌ Invalid shard: {shard}. Expected i/N, e.g. 2/8")
+    if not 1 <= index <= count:
+        raise ValueError(f"❌ Invalid shard: {shard}. The shard index must be between 1 and {count}")
+    return index, count
+
+def parse_contrasts(specs):
+    """
+    Convert contrasts such as "age", "dxage=diagnosis:age" or "w=[0, 1, -1]" into {name: spec}.
+    Specs are design terms, patsy linear constraints or JSON weight vectors/matrices.
+    Unnamed contrasts are named after their spec.
+    """
+    contrasts = {}
+    for spec in specs or []:
+        name, sep, value = spec.partition('=')
+        # A constraint such as "age = 0.5" has no name
+        if not sep or not re.fullmatch(r'\w+', name.strip()) or re.fullmatch(r'[-+.\d\s]*', value):
+            name, value = re.sub(r'\W+', '', spec.replace(':', 'x').replace('-', 'minus')) or 'contrast', spec
+        name, value = name.strip(), value.strip()
+        if value.startswith('['):
+            try:
+                value = json.loads(value)
+            except json.JSONDecodeError:
+                raise ValueError(f"❌ Invalid contrast weights: {value}. Expected a JSON list, e.g. [0, 1, -1]")
+        if name in contrasts:
+            raise ValueError(f"❌ Contrast name {name} is used twice")
+        contrasts[name] = value
+    return contrasts
+
+def check_output_format(output_format):
+    """
+    Fail before the analysis, rather than when saving, if the results cannot be written.
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"❌ Unknown output format: {output_format}. Expected one of {OUTPUT_FORMATS}")
+    if output_format == 'parquet' and importlib.util.find_spec('pyarrow') is None:
+        raise ValueError("❌ The parquet output format requires pyarrow (pip install pyarrow)")
+
 def find_bids_output(working_directory):
     reports_dir = os.path.join(working_directory, "reports") # Path to report folder
     connectome_t = os.path.join('{}', 'ses-{}', 'func', "{}_ses-{}_task-{}_run-{}_seg-{}_meas-PearsonCorrelation_desc-{}_relmat.tsv")
@@ -64,7 +139,9 @@ def find_bids_output(working_directory):
     
     return dict_halfpipe
     
-def verify_atlas_files(atlas_file) :
+def verify_atlas_files(atlas_file, dtype="float64") :
+    import pandas as pd
+    from .triangle import ConnectomeTriangle
     print("⏳ Verifying altas location ...")
     print("path to access atlas:", atlas_file)
     
@@ -73,10 +150,21 @@ def verify_atlas_files(atlas_file) :
     
     labels = pd.read_csv(atlas_file, sep='\t', header=None)
 
-    conn_mask = np.tril(np.ones((len(labels),len(labels)))).astype(bool)
+    conn_mask = ConnectomeTriangle(len(labels), dtype=dtype)
     roi_labels = labels[1].to_list()
 
     return conn_mask, roi_labels
+
+
+def read_atlas_networks(atlas_file):
+    """
+    Network of each ROI, from an optional third column of the atlas file.
+    """
+    import pandas as pd
+    labels = pd.read_csv(atlas_file, sep='\t', header=None)
+    if labels.shape[1] < 3:
+        return None
+    return labels[2].astype(str).to_list()
     
 
 def verify_working_directory(working_directory) :
@@ -0,0 +1,214 @@
+import os
+import json
+import numpy as np
+
+from .linear_model import factorize_design
+from .stats import build_design, edge_block_size
+from .files import report_file
+
+# Arrays saved in a ComBat parameter file, on top of the JSON metadata
+COMBAT_ARRAYS = ['grand_mean', 'var_pooled', 'beta_covariates', 'gamma_star', 'delta_star']
+
+
+def combat_design(pheno, group, case, control, regressors='', batch_col='scanner',
+                  batch_levels=None, covariate_columns=None):
+    """
+    Subjects of the case and control groups, their batch and the biological covariates
+    kept by ComBat: the design of the GLM without the batch term and the intercept.
+    With the levels and columns of saved parameters, new subjects get the same coding.
+    """
+    batch_term = f'C({batch_col})'
+    regressors = ' + '.join(term for term in regressors.split(' + ') if term and term != batch_term)
+    sub_mask, _, dmat = build_design(pheno, group, case, control, regressors)
+    covariates = dmat.drop(columns='Intercept')
+    if covariate_columns is not None:
+        # Levels missing from the new subjects are zero; covariates the parameters do not know cannot be kept
+        unknown = [col for col in covariates.columns if col not in covariate_columns]
+        if unknown:
+            raise ValueError(f"❌ Covariates {unknown} were not in the fitted ComBat parameters: {covariate_columns}")
+        covariates = covariates.reindex(columns=covariate_columns, fill_value=0.0)
+
+    batches = pheno.loc[sub_mask, batch_col].astype(str).to_numpy()
+    if batch_levels is None:
+        batch_levels = sorted(set(batches))
+    unknown = sorted(set(batches) - set(batch_levels))
+    if unknown:
+        raise ValueError(f"❌ Batches {unknown} were not in the fitted ComBat parameters: {batch_levels}")
+    batch_ids = np.searchsorted(np.asarray(batch_levels), batches)
+
+    return sub_mask, batch_ids, list(batch_levels), covariates
+
+
+def combat_eb(gamma_hat, delta_hat, counts, tol=1e-4, max_iter=1000):
+    """
+    Parametric empirical-Bayes shrinkage of the batch locations (gamma) and scales (delta),
+    with priors pooled over the edges (batches x edges arrays). The sum of squares of the
+    standardized data around a location follows from delta_hat, so the data are not needed.
+    """
+    gamma_bar = gamma_hat.mean(axis=1, keepdims=True)
+    t2 = gamma_hat.var(axis=1, ddof=1, keepdims=True)
+    # Inverse gamma prior of the scales, from the moments of delta_hat
+    m = delta_hat.mean(axis=1, keepdims=True)
+    s2 = delta_hat.var(axis=1, ddof=1, keepdims=True)
+    a_prior = (2 * s2 + m ** 2) / s2
+    b_prior = (m * s2 + m ** 3) / s2
+
+    n = counts[:, None]
+    gamma_star, delta_star = gamma_hat.copy(), delta_hat.copy()
+    # Batches iterate until their own relative change is below tol
+    active = np.arange(len(counts))
+    for _ in range(max_iter):
+        if not active.size:
+            break
+        g_old, d_old = gamma_star[active], delta_star[active]
+        g_new = (t2[active] * n[active] * gamma_hat[active] + d_old * gamma_bar[active]) \
+            / (t2[active] * n[active] + d_old)
+        sum2 = (n[active] - 1) * delta_hat[active] + n[active] * (gamma_hat[active] - g_new) ** 2
+        d_new = (0.5 * sum2 + b_prior[active]) / (n[active] / 2 + a_prior[active] - 1)
+        gamma_star[active], delta_star[active] = g_new, d_new
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            change = np.maximum(np.nanmax(np.abs(g_new - g_old) / np.abs(g_old), axis=1),
+                                np.nanmax(np.abs(d_new - d_old) / d_old, axis=1))
+        active = active[change >= tol]
+
+    return gamma_star, delta_star
+
+
+def fit_combat(data, batch_ids, covariates, n_batch=None, eb=True, rows=None, max_memory=None):
+    """
+    ComBat location and scale parameters of every edge (columns of data), keeping the covariates.
+    rows selects the subjects of data, which match batch_ids and covariates.
+    The edges are read in blocks, only the batches x edges estimates are kept in memory.
+    Constant edges (e.g. the diagonal of correlation matrices) are left as they are.
+    """
+    rows = np.arange(data.shape[0]) if rows is None else rows
+    n_batch = n_batch or int(batch_ids.max()) + 1
+    batch = np.eye(n_batch)[batch_ids]
+    counts = batch.sum(axis=0)
+    if counts.min() < 2:
+        raise ValueError(f"❌ ComBat needs at least 2 subjects per batch, got {counts.astype(int).tolist()}")
+
+    covariates = np.asarray(covariates, dtype=np.float64).reshape(len(batch_ids), -1)
+    factor = factorize_design(np.column_stack([batch, covariates]))
+    n_sub, n_data = len(rows), data.shape[1]
+    params = {
+        'grand_mean': np.zeros(n_data),
+        'var_pooled': np.zeros(n_data),
+        'beta_covariates': np.zeros((covariates.shape[1], n_data)),
+        'gamma_star': np.zeros((n_batch, n_data)),
+        'delta_star': np.ones((n_batch, n_data)),
+    }
+    gamma_hat, delta_hat = np.zeros((n_batch, n_data)), np.ones((n_batch, n_data))
+
+    block_size = edge_block_size(n_sub, n_data, max_memory)
+    for start in range(0, n_data, block_size):
+        stop = min(start + block_size, n_data)
+        block = np.asarray(data[:, start:stop], dtype=np.float64)[rows]
+        betas = factor['pinv'] @ block
+        var_pooled = np.mean((block - factor['design'] @ betas) ** 2, axis=0)
+        var_pooled[np.ptp(block, axis=0) == 0] = 0
+        # Standardize around the sample-weighted mean of the batches and the covariate effects
+        grand_mean = counts / n_sub @ betas[:n_batch]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            stand = (block - grand_mean - covariates @ betas[n_batch:]) / np.sqrt(var_pooled)
+            gamma_hat[:, start:stop] = batch.T @ stand / counts[:, None]
+            delta_hat[:, start:stop] = batch.T @ (stand - gamma_hat[batch_ids, start:stop]) ** 2 / (counts[:, None] - 1)
+
+        params['grand_mean'][start:stop] = grand_mean
+        params['var_pooled'][start:stop] = var_pooled
+        params['beta_covariates'][:, start:stop] = betas[n_batch:]
+
+    valid = params['var_pooled'] > 0
+    if eb:
+        params['gamma_star'][:, valid], params['delta_star'][:, valid] = combat_eb(
+            gamma_hat[:, valid], delta_hat[:, valid], counts)
+    else:
+        params['gamma_star'][:, valid], params['delta_star'][:, valid] = gamma_hat[:, valid], delta_hat[:, valid]
+    return params
+
+
+def apply_combat(data, batch_ids, covariates, params, out=None, rows=None, max_memory=None):
+    """
+    Remove the batch effects of fitted ComBat parameters, block by block of edges.
+    Only the subjects in rows are harmonized, the other rows are copied.
+    Writes into out (e.g. a memory-map) when given, the input is never modified.
+    """
+    rows = np.arange(data.shape[0]) if rows is None else rows
+    n_sub, n_data = len(rows), data.shape[1]
+    if out is None:
+        out = np.empty(data.shape, dtype=data.dtype)
+    covariates = np.asarray(covariates, dtype=np.float64).reshape(n_sub, -1)
+
+    block_size = edge_block_size(data.shape[0], n_data, max_memory)
+    for start in range(0, n_data, block_size):
+        stop = min(start + block_size, n_data)
+        block = np.asarray(data[:, start:stop], dtype=np.float64)
+        out[:, start:stop] = block
+        block = block[rows]
+        var_pooled = params['var_pooled'][start:stop]
+        valid = var_pooled > 0
+        scale = np.sqrt(np.where(valid, var_pooled, 1))
+        mean = params['grand_mean'][start:stop] + covariates @ params['beta_covariates'][:, start:stop]
+
+        stand = (block - mean) / scale
+        adjusted = (stand - params['gamma_star'][batch_ids, start:stop]) \
+            / np.sqrt(params['delta_star'][batch_ids, start:stop])
+        out[rows, start:stop] = np.where(valid, adjusted * scale + mean, block)
+    return out
+
+
+def save_combat(path, params, metadata):
+    np.savez(path, metadata=np.array(json.dumps(metadata)), **{name: params[name] for name in COMBAT_ARRAYS})
+    print(f"✅ ComBat parameters saved in: {path}")
+
+
+def load_combat(path):
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"❌ Missing ComBat parameter file: {path}")
+    with np.load(path, allow_pickle=False) as f:
+        metadata = json.loads(str(f['metadata']))
+        params = {name: f[name] for name in COMBAT_ARRAYS}
+    return params, metadata
+
+
+def combat_harmonize(out_p, conn, pheno, group, case, control, regressors='', batch_col='scanner',
+                     params_path=None, save_path=None, out=None, eb=True, max_memory=None):
+    """
+    ComBat harmonization of the connectomes of the case and control subjects, before the GLM.
+    Parameters are fitted on conn and saved in save_path, or read from params_path
+    (fitted on another sample) to harmonize new subjects without refitting.
+    Rows outside the case and control groups are copied unchanged.
+    """
+    if batch_col not in pheno.columns:
+        raise ValueError(f"❌ ComBat needs the {batch_col} column of the phenotype file")
+
+    if params_path is not None:
+        params, metadata = load_combat(params_path)
+        if metadata['n_edges'] != conn.shape[1]:
+            raise ValueError(f"❌ ComBat parameters are for {metadata['n_edges']} edges, got {conn.shape[1]}")
+        if metadata['batch_col'] != batch_col:
+            raise ValueError(f"❌ ComBat parameters are for the batches of {metadata['batch_col']}, got {batch_col}")
+        sub_mask, batch_ids, levels, covariates = combat_design(
+            pheno, group, case, control, regressors, batch_col,
+            batch_levels=metadata['batch_levels'], covariate_columns=metadata['covariate_columns'])
+        print(f"\n⏳ Harmonizing {sub_mask.sum()} subjects with the ComBat parameters of {params_path} ...")
+    else:
+        sub_mask, batch_ids, levels, covariates = combat_design(pheno, group, case, control, regressors, batch_col)
+        print(f"\n⏳ Fitting ComBat on {sub_mask.sum()} subjects and {conn.shape[1]} edges "
+              f"({len(levels)} batches of {batch_col}) ...")
+        params = fit_combat(conn, batch_ids, covariates, n_batch=len(levels), eb=eb, rows=np.flatnonzero(sub_mask),
+                            max_memory=max_memory)
+        metadata = {'batch_col': batch_col, 'batch_levels': levels, 'covariate_columns': list(covariates.columns),
+                    'n_edges': int(conn.shape[1]), 'n_subjects': int(sub_mask.sum()), 'eb': eb}
+        if save_path is not None:
+            save_combat(save_path, params, metadata)
+
+    out = apply_combat(conn, batch_ids, covariates, params, out=out, rows=np.flatnonzero(sub_mask),
+                       max_memory=max_memory)
+
+    report_file(out_p, {
+        'ComBat harmonization': f'{batch_col} batches {levels}, covariates {list(covariates.columns)}',
+        'ComBat parameters': params_path if params_path is not None else save_path,
+    })
+    return out
@@ -0,0 +1,262 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+
+from .connectome import load_connectomes
+from .federated import SITE_ARRAYS, subject_block_size, glm_sufficient_stats
+from .linear_model import factorize_design, fit_ols
+from .stats import build_design, find_contrast, edge_block_size
+from .store import source_stat
+from .triangle import as_triangle
+from .files import report_file
+
+# Settings of the accumulated cross-products: when one changes, they are rebuilt from the stored contributions
+STATE_KEYS = ['group', 'regressors', 'columns']
+# What a subject adds to the cross-products; a change means its contribution is replaced
+CONTRIBUTION_KEYS = ['source', 'design', 'control']
+# Share of unused rows (replaced files, excluded subjects) above which the contributions are compacted
+COMPACT_FRACTION = 0.5
+
+
+def incremental_paths(state_dir, key):
+    # The stored connectomes are in one of the two contributions files, as named in the state
+    return {
+        "data": os.path.join(state_dir, f"{key}_contributions.dat"),
+        "compacted": os.path.join(state_dir, f"{key}_contributions.compacted.dat"),
+        "state": os.path.join(state_dir, f"{key}_state.npz"),
+    }
+
+
+def empty_stats(columns, n_data):
+    return {
+        'xtx': np.zeros((len(columns), len(columns))),
+        'xty': np.zeros((len(columns), n_data)),
+        'yty': np.zeros(n_data),
+        'n_obs': 0,
+        'n_control': 0,
+        'control_sum': np.zeros(n_data),
+        'control_sumsq': np.zeros(n_data),
+        'columns': list(columns),
+    }
+
+
+def load_incremental_state(state_dir, key):
+    path = incremental_paths(state_dir, key)["state"]
+    if not os.path.exists(path):
+        return None, None
+    with np.load(path, allow_pickle=False) as f:
+        stats = {name: f[name] for name in SITE_ARRAYS}
+        metadata = json.loads(str(f['metadata']))
+    stats['n_obs'], stats['n_control'] = int(stats['n_obs']), int(stats['n_control'])
+    stats['columns'] = metadata['columns']
+    return stats, metadata
+
+
+def save_incremental_state(state_dir, key, stats, metadata):
+    """
+    Write the cross-products with the contribution of each subject (row of the stored
+    connectome, design row, control flag, mean FD and source file). The file is replaced
+    at once, so an interrupted update leaves the previous state.
+    """
+    path = incremental_paths(state_dir, key)["state"]
+    tmp_path = path + '.tmp.npz'
+    np.savez(tmp_path, metadata=np.array(json.dumps(metadata)), **{name: stats[name] for name in SITE_ARRAYS})
+    os.replace(tmp_path, path)
+
+
+def accumulate(stats, data, rows, design, control, sign=1, max_memory=None):
+    """
+    Add (sign=1) or subtract (sign=-1) the contributions of the subjects stored in rows of data,
+    with their design rows and control flags, to the cross-products, block by block of subjects.
+    """
+    design = np.asarray(design, dtype=np.float64).reshape(len(rows), -1)
+    control = np.asarray(control, dtype=bool)
+    block_size = subject_block_size(data.shape[1], max_memory)
+    for start in range(0, len(rows), block_size):
+        stop = min(start + block_size, len(rows))
+        block = np.asarray(data[rows[start:stop]], dtype=np.float64)
+        x, block_control = design[start:stop], block[control[start:stop]]
+
+        stats['xtx'] += sign * x.T @ x
+        stats['xty'] += sign * x.T @ block
+        stats['yty'] += sign * np.einsum('ij,ij->j', block, block)
+        stats['n_obs'] += sign * (stop - start)
+        stats['n_control'] += sign * int(control[start:stop].sum())
+        stats['control_sum'] += sign * block_control.sum(axis=0)
+        stats['control_sumsq'] += sign * np.einsum('ij,ij->j', block_control, block_control)
+    return stats
+
+
+def compact_contributions(state_dir, key, metadata, dtype, n_data, keep, max_memory=None):
+    """
+    Copy the rows of the subjects in keep, in their order, to the other contributions file and
+    forget the other subjects. The saved state still points to the previous file, so it stays
+    valid until the new state is saved. Returns the path of the previous file.
+    """
+    paths = incremental_paths(state_dir, key)
+    previous, current = metadata['data'], 'compacted' if metadata['data'] == 'data' else 'data'
+    rows = [metadata['subjects'][sub]['row'] for sub in keep]
+    open(paths[current], 'wb').close()
+    if rows:
+        source = np.memmap(paths[previous], mode='r', dtype=dtype, shape=(metadata['n_rows'], n_data))
+        target = np.memmap(paths[current], mode='w+', dtype=dtype, shape=(len(rows), n_data))
+        block_size = subject_block_size(n_data, max_memory)
+        for start in range(0, len(rows), block_size):
+            target[start:start + block_size] = source[rows[start:start + block_size]]
+        target.flush()
+        del source, target
+
+    metadata['subjects'] = {sub: dict(metadata['subjects'][sub], row=row) for row, sub in enumerate(keep)}
+    metadata.update(data=current, n_rows=len(rows))
+    return paths[previous]
+
+
+def refit_table(data, rows, design, control, contrast_id, max_memory=None):
+    """
+    Edge table of the OLS fit of the stored connectomes, as glm_wrap_cc: the full refit
+    the accumulated cross-products are checked against.
+    """
+    factor = factorize_design(np.asarray(design, dtype=np.float64).reshape(len(rows), -1))
+    control = np.asarray(control, dtype=bool)
+    n_data = data.shape[1]
+    betas, stand_betas, pvals = np.zeros(n_data), np.zeros(n_data), np.zeros(n_data)
+    block_size = edge_block_size(len(rows), n_data, max_memory)
+    for start in range(0, n_data, block_size):
+        stop = min(start + block_size, n_data)
+        block = np.asarray(data[rows, start:stop], dtype=np.float64)
+        results = fit_ols(block, factor)
+        scale = block[control].std(axis=0)
+        scale[scale == 0] = 1
+        betas[start:stop] = results['betas'][contrast_id]
+        stand_betas[start:stop] = betas[start:stop] / scale
+        pvals[start:stop] = results['pvals'][contrast_id]
+    return pd.DataFrame(data={'betas': betas, 'stand_betas': stand_betas, 'pvals': pvals})
+
+
+def update_incremental(out_p, state_dir, key, pheno, connectome_paths, group, case, control, conn_mask,
+                       regressors='', n_jobs=1, max_memory=None, check=False, rtol=1e-6):
+    """
+    Bring the accumulated cross-products of an analysis up to date with the subjects of pheno
+    (one row per connectome path) and derive the GLM table from them (see glm_sufficient_stats).
+    The contribution of each subject is kept in state_dir: subjects excluded since the last update,
+    or whose file, design row or group changed, are subtracted, and only new or modified files are
+    read, so the work grows with the change and not with the cohort. When the design columns
+    change (e.g. a new scanner), the cross-products are rebuilt from the stored connectomes.
+    With check, the table is compared with a full OLS refit of the stored connectomes, and the
+    cross-products are rebuilt from them if the two differ.
+    Returns the table, the cross-products and the counts of the update.
+    """
+    triangle = as_triangle(conn_mask)
+    n_data, dtype = triangle.n_edges, triangle.dtype
+    os.makedirs(state_dir, exist_ok=True)
+    paths = incremental_paths(state_dir, key)
+
+    sub_mask, case_masks, dmat = build_design(pheno, group, case, control, regressors)
+    sub_pheno = pheno.loc[sub_mask]
+    design = dmat.to_numpy(dtype=np.float64)
+    mean_fd = sub_pheno['mean_fd'] if 'mean_fd' in sub_pheno else np.full(len(sub_pheno), np.nan)
+    current = {
+        sub: {'source': source_stat(path), 'design': design[i].tolist(), 'control': bool(is_control),
+              'mean_fd': float(fd)}
+        for i, (sub, path, is_control, fd) in enumerate(zip(sub_pheno['participant_id'],
+                                                            np.asarray(connectome_paths, dtype=object)[sub_mask],
+                                                            case_masks[control], mean_fd))
+    }
+    settings = {'group': group, 'regressors': regressors, 'columns': list(dmat.columns)}
+
+    stats, metadata = load_incremental_state(state_dir, key)
+    rebuilt = False
+    if metadata is None or metadata['n_edges'] != n_data or metadata['dtype'] != dtype.name:
+        # Start a new state
+        metadata = dict(settings, n_edges=n_data, dtype=dtype.name, data='data', n_rows=0, subjects={})
+        stats = empty_stats(dmat.columns, n_data)
+        open(paths[metadata['data']], 'wb').close()
+    elif any(metadata[name] != settings[name] for name in STATE_KEYS):
+        print(f"❗️ The design of {key} changed: cross-products are rebuilt from the stored connectomes")
+        metadata.update(settings)
+        stats = empty_stats(dmat.columns, n_data)
+        for record in metadata['subjects'].values():
+            record['included'] = False
+        rebuilt = True
+    subjects = metadata['subjects']
+
+    def open_data(mode='r'):
+        return np.memmap(paths[metadata['data']], mode=mode, dtype=dtype, shape=(max(metadata['n_rows'], 1), n_data))
+
+    # Subtract the subjects that left the analysis or whose contribution changed
+    removed = [sub for sub, record in subjects.items() if record['included'] and
+               (sub not in current or any(record[name] != current[sub][name] for name in CONTRIBUTION_KEYS))]
+    if removed:
+        accumulate(stats, open_data(), [subjects[sub]['row'] for sub in removed],
+                   [subjects[sub]['design'] for sub in removed], [subjects[sub]['control'] for sub in removed],
+                   sign=-1, max_memory=max_memory)
+        for sub in removed:
+            subjects[sub]['included'] = False
+
+    # New and modified files are appended; rows of replaced files are left unused until compaction
+    added = [sub for sub in current if not subjects.get(sub, {}).get('included')]
+    to_read = [sub for sub in added if sub not in subjects or subjects[sub]['source'] != current[sub]['source']]
+    if to_read:
+        for sub in to_read:
+            subjects.setdefault(sub, {})['row'] = metadata['n_rows']
+            metadata['n_rows'] += 1
+        with open(paths[metadata['data']], 'r+b') as f:
+            f.truncate(metadata['n_rows'] * n_data * dtype.itemsize)
+        data = open_data('r+')
+        load_connectomes([current[sub]['source']['path'] for sub in to_read], triangle, data,
+                         rows=[subjects[sub]['row'] for sub in to_read], n_jobs=n_jobs)
+        data.flush()
+        del data
+
+    if added:
+        accumulate(stats, open_data(), [subjects[sub]['row'] for sub in added],
+                   [current[sub]['design'] for sub in added], [current[sub]['control'] for sub in added],
+                   max_memory=max_memory)
+    for sub in current:
+        subjects[sub].update(current[sub], included=True)
+
+    # Drop the unused rows once they make up most of the file
+    previous = None
+    if metadata['n_rows'] - len(current) > COMPACT_FRACTION * metadata['n_rows']:
+        previous = compact_contributions(state_dir, key, metadata, dtype, n_data, list(current),
+                                         max_memory=max_memory)
+        subjects = metadata['subjects']
+        print(f"📦 Contributions of {key} compacted to {metadata['n_rows']} rows")
+
+    print(f"📦 Incremental state {key}: {len(added)} added ({len(to_read)} files read), {len(removed)} removed, "
+          f"{len(current) - len(added)} unchanged")
+    table = glm_sufficient_stats(stats, group)
+    summary_data = {
+        'incremental state': paths["state"],
+        'incremental update': {'subjects': len(current), 'added': len(added), 'removed': len(removed),
+                               'files read': len(to_read), 'design rebuilt': rebuilt,
+                               'compacted': previous is not None},
+        'incremental subjects added': sorted(added),
+        'incremental subjects removed': sorted(removed),
+    }
+
+    if check and current:
+        rows = [subjects[sub]['row'] for sub in current]
+        contrast_id, _ = find_contrast(dmat, group)[0]
+        refit = refit_table(open_data(), rows, design, case_masks[control], contrast_id, max_memory=max_memory)
+        # Constant edges (the diagonal) have no residual variance to compare
+        edges = triangle.off_diagonal
+        differences = {col: float(np.max(np.abs(table[col].values[edges] - refit[col].values[edges]), initial=0))
+                       for col in refit.columns}
+        consistent = all(np.allclose(table[col].values[edges], refit[col].values[edges], rtol=rtol, atol=1e-10)
+                         for col in refit.columns)
+        summary_data['incremental check'] = dict(differences, consistent=consistent)
+        if consistent:
+            print(f"✅ Incremental GLM matches the full refit (max beta difference {differences['betas']:.2e})")
+        else:
+            print(f"❗️ Incremental GLM differs from the full refit {differences}: cross-products are rebuilt")
+            stats = accumulate(empty_stats(dmat.columns, n_data), open_data(), rows, design, case_masks[control],
+                               max_memory=max_memory)
+            table = glm_sufficient_stats(stats, group)
+
+    save_incremental_state(state_dir, key, stats, metadata)
+    if previous is not None:
+        os.remove(previous)
+    report_file(out_p, summary_data)
+    return table, stats, summary_data['incremental update']
@@ -0,0 +1,250 @@
+import numpy as np
+from scipy import stats as sps
+
+# Heteroskedasticity-consistent covariances of fit_ols and the Huber M-estimator of fit_huber
+ROBUST_ESTIMATORS = ['HC0', 'HC1', 'HC2', 'HC3', 'huber']
+
+def factorize_design(design_matrix):
+    """
+    Factorize the design matrix once so every edge can reuse it.
+    """
+    columns = list(getattr(design_matrix, 'columns', range(np.shape(design_matrix)[1])))
+    design = np.asarray(design_matrix, dtype=np.float64)
+
+    # Same pseudo-inverse and residual degrees of freedom as statsmodels OLS
+    pinv_design = np.linalg.pinv(design, rcond=1e-15)
+    rank = np.linalg.matrix_rank(design)
+
+    return {
+        "columns": columns,
+        "design": design,
+        "pinv": pinv_design,
+        "xtx_inv": pinv_design @ pinv_design.T,
+        # Diagonal of the hat matrix, shared by the HC2/HC3 covariances of all edges
+        "leverage": np.einsum('ij,ji->i', design, pinv_design),
+        "n_obs": design.shape[0],
+        "rank": int(rank),
+        "df_resid": design.shape[0] - int(rank),
+    }
+
+
+def hc_weights(factor, cov_type):
+    """
+    Weight of each squared residual in the HC0-HC3 sandwich covariances.
+    """
+    if cov_type == 'HC0':
+        return np.ones(factor['n_obs'])
+    if cov_type == 'HC1':
+        return np.full(factor['n_obs'], factor['n_obs'] / factor['df_resid'])
+    with np.errstate(divide='ignore'):
+        if cov_type == 'HC2':
+            return 1 / (1 - factor['leverage'])
+        if cov_type == 'HC3':
+            return 1 / (1 - factor['leverage']) ** 2
+    raise ValueError(f"❌ Unknown covariance type: {cov_type}. Expected nonrobust, HC0, HC1, HC2 or HC3")
+
+
+def fit_ols(data, factor, cov_type='nonrobust'):
+    """
+    Fit one OLS model per column of data (subjects x edges) with a shared design.
+    With cov_type HC0 to HC3, standard errors are heteroskedasticity-consistent and
+    p-values use the normal distribution, as statsmodels OLS.fit(cov_type=...).
+    """
+    data = np.asarray(data, dtype=np.float64)
+    if data.ndim == 1:
+        data = data[:, None]
+
+    betas = factor['pinv'] @ data
+    resid = data - factor['design'] @ betas
+    rss = np.einsum('ij,ij->j', resid, resid)
+    scale = rss / factor['df_resid']
+
+    if cov_type == 'nonrobust':
+        bse = np.sqrt(np.outer(np.diag(factor['xtx_inv']), scale))
+    else:
+        # Diagonal of pinv diag(w e^2) pinv' for every edge at once
+        weights = hc_weights(factor, cov_type)
+        bse = np.sqrt((factor['pinv'] ** 2 * weights) @ resid ** 2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tvals = betas / bse
+    # Constant edges (e.g. the diagonal) only keep the rounding of the fit: no effect
+    tvals[:, np.all(data == data[:1], axis=0)] = 0
+    if cov_type == 'nonrobust':
+        pvals = 2 * sps.t.sf(np.abs(tvals), factor['df_resid'])
+    else:
+        pvals = 2 * sps.norm.sf(np.abs(tvals))
+
+    return {
+        "betas": betas,
+        "bse": bse,
+        "tvals": tvals,
+        "pvals": pvals,
+        "rss": rss,
+    }
+
+
+def fit_contrasts(data, factor, contrasts):
+    """
+    t-tests (one row) and F-tests (several rows) of contrasts (name -> (L, c), testing L b = c)
+    on every column of data, from a single OLS fit with a shared design.
+    """
+    data = np.asarray(data, dtype=np.float64)
+    if data.ndim == 1:
+        data = data[:, None]
+
+    betas = factor['pinv'] @ data
+    resid = data - factor['design'] @ betas
+    scale = np.einsum('ij,ij->j', resid, resid) / factor['df_resid']
+
+    # Constant edges (e.g. the diagonal) only keep the rounding of the fit: no effect
+    constant = np.all(data == data[:1], axis=0)
+    results = {}
+    for name, (coefs, constants) in contrasts.items():
+        coefs = np.atleast_2d(np.asarray(coefs, dtype=np.float64))
+        effect = coefs @ betas - np.reshape(constants, (-1, 1))
+        # Covariance of L b up to the residual variance of each edge
+        cov = coefs @ factor['xtx_inv'] @ coefs.T
+        n_rows = coefs.shape[0]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if n_rows == 1:
+                stat = effect[0] / np.sqrt(cov[0, 0] * scale)
+                stat[constant] = 0
+                pvals = 2 * sps.t.sf(np.abs(stat), factor['df_resid'])
+            else:
+                stat = np.einsum('ie,ij,je->e', effect, np.linalg.pinv(cov), effect) / (n_rows * scale)
+                stat[constant] = 0
+                pvals = sps.f.sf(stat, n_rows, factor['df_resid'])
+        results[name] = {
+            "effect": effect,
+            "stat": stat,
+            "pvals": pvals,
+            "df": (n_rows, factor['df_resid']),
+        }
+    return results
+
+
+def huber_rho(z, t):
+    return np.where(np.abs(z) <= t, 0.5 * z ** 2, t * np.abs(z) - 0.5 * t ** 2)
+
+
+def mad_scale(resid):
+    # Median absolute deviation around 0, consistent for the normal distribution
+    return np.median(np.abs(resid), axis=0) / sps.norm.ppf(0.75)
+
+
+def fit_huber(data, factor, t=1.345, max_iter=50, tol=1e-8):
+    """
+    Huber M-estimation of every column of data with a shared design, by IRLS.
+    All edges are reweighted together and an edge leaves the iterations once its
+    deviance has converged. Same defaults, scale (MAD) and H1 covariance as
+    statsmodels RLM(M=HuberT()).fit(); p-values use the normal distribution.
+    """
+    data = np.asarray(data, dtype=np.float64)
+    if data.ndim == 1:
+        data = data[:, None]
+    design = factor['design']
+    n_obs, n_col = design.shape
+    # X'WX of every edge is a weighted sum of the outer products of the design rows
+    outer = (design[:, :, None] * design[:, None, :]).reshape(n_obs, n_col * n_col)
+
+    # Start from OLS
+    betas = factor['pinv'] @ data
+    resid = data - design @ betas
+    scale = mad_scale(resid)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        deviance = huber_rho(resid / (np.einsum('ij,ij->j', resid, resid) / (n_obs - n_col)), t).sum(axis=0)
+
+    # Edges with a perfect fit (zero scale) keep the OLS estimates.
+    # Converged edges are dropped from the working arrays, which only hold the active edges.
+    active = np.flatnonzero(scale > 0)
+    y, r, s, dev = data[:, active], resid[:, active], scale[active], deviance[active]
+    for _ in range(max_iter - 1):
+        if not active.size:
+            break
+        weights = np.minimum(1, t / np.abs(r / s))
+        xtwx = (outer.T @ weights).T.reshape(-1, n_col, n_col)
+        xtwy = design.T @ (weights * y)
+        b = np.linalg.solve(xtwx, xtwy.T[:, :, None])[:, :, 0].T
+        r = y - design @ b
+        s = mad_scale(r)
+
+        wrss = np.einsum('ij,ij->j', weights * r, r)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            new_dev = huber_rho(r / (wrss / (n_obs - n_col)), t).sum(axis=0)
+        converged = (np.abs(new_dev - dev) <= tol) | (s == 0)
+        betas[:, active], resid[:, active], scale[active] = b, r, s
+        keep = ~converged
+        active, y, r, s, dev = active[keep], y[:, keep], r[:, keep], s[keep], new_dev[keep]
+
+    # H1 covariance of Huber (1981): correction factor k for the design size
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sresid = resid / scale
+    psi = np.clip(sresid, -t, t)
+    psi_deriv = (np.abs(sresid) <= t).astype(np.float64)
+    mean_deriv = psi_deriv.mean(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        k = 1 + factor['rank'] / n_obs * psi_deriv.var(axis=0) / mean_deriv ** 2
+        bcov_scale = k ** 2 * np.sum(psi ** 2, axis=0) / factor['df_resid'] * scale ** 2 / mean_deriv ** 2
+        bse = np.sqrt(np.outer(np.diag(factor['xtx_inv']), bcov_scale))
+        tvals = betas / bse
+    pvals = 2 * sps.norm.sf(np.abs(tvals))
+
+    return {
+        "betas": betas,
+        "bse": bse,
+        "tvals": tvals,
+        "pvals": pvals,
+        "scale": scale,
+    }
+
+
+def fit_glm(data, factor, robust=None):
+    """
+    fit_ols, with HC standard errors or the Huber M-estimator when robust is set.
+    """
+    if robust is None:
+        return fit_ols(data, factor)
+    if robust == 'huber':
+        return fit_huber(data, factor)
+    if robust not in ROBUST_ESTIMATORS:
+        raise ValueError(f"❌ Unknown robust estimator: {robust}. Expected one of {ROBUST_ESTIMATORS}")
+    return fit_ols(data, factor, cov_type=robust)
+
+
+def fit_ols_crossproducts(xtx, xty, yty, n_obs, intercept=None):
+    """
+    Same fit as fit_ols from the cross-products X'X (p x p), X'Y (p x edges),
+    Y'Y (edges) and the number of observations, without the subject-level data.
+    With the index of the intercept column, constant edges get t = 0 (p = 1) as in fit_ols.
+    """
+    xtx = np.asarray(xtx, dtype=np.float64)
+    xty = np.asarray(xty, dtype=np.float64)
+
+    xtx_inv = np.linalg.pinv(xtx, rcond=1e-15)
+    rank = int(np.linalg.matrix_rank(xtx))
+    df_resid = int(n_obs) - rank
+
+    betas = xtx_inv @ xty
+    # RSS = Y'Y - B'X'Y for each edge
+    rss = np.clip(np.asarray(yty, dtype=np.float64) - np.einsum('ij,ij->j', betas, xty), 0, None)
+    scale = rss / df_resid
+
+    bse = np.sqrt(np.outer(np.diag(xtx_inv), scale))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tvals = betas / bse
+    if intercept is not None:
+        # Constant edges (e.g. the diagonal): the sum of squares around the mean, from the intercept
+        # row of X'Y, is only rounding. Their RSS is the rounding of Y'Y - B'X'Y: no effect, not p = 0
+        yty = np.asarray(yty, dtype=np.float64)
+        centered = yty - xty[intercept] ** 2 / int(n_obs)
+        tvals[:, centered <= int(n_obs) * np.finfo(np.float64).eps * np.abs(yty)] = 0
+    pvals = 2 * sps.t.sf(np.abs(tvals), df_resid)
+
+    return {
+        "betas": betas,
+        "bse": bse,
+        "tvals": tvals,
+        "pvals": pvals,
+        "rss": rss,
+        "df_resid": df_resid,
+    }
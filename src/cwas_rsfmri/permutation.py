@@ -0,0 +1,222 @@
+import numpy as np
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+
+def permutation_seeds(seed, n_perm, batch_size):
+    """
+    One independent seed per batch of permutations, so the permutations
+    only depend on the seed and not on the number of jobs.
+    """
+    n_batches = int(np.ceil(n_perm / batch_size))
+    children = np.random.SeedSequence(seed).spawn(n_batches)
+    sizes = [min(batch_size, n_perm - b * batch_size) for b in range(n_batches)]
+    return list(zip(children, sizes))
+
+
+def draw_permutations(seed_seq, size, n_obs):
+    rng = np.random.default_rng(seed_seq)
+    return np.array([rng.permutation(n_obs) for _ in range(size)])
+
+
+def freedman_lane_basis(design, contrast_id):
+    """
+    Quantities shared by all permutations of a Freedman-Lane test of one design column.
+    """
+    design = np.asarray(design, dtype=np.float64)
+    pinv_design = np.linalg.pinv(design, rcond=1e-15)
+
+    # Orthonormal basis of the full design, used to get residuals of permuted data
+    u, s, _ = np.linalg.svd(design, full_matrices=False)
+    rank = int(np.sum(s > s.max() * max(design.shape) * np.finfo(float).eps))
+
+    nuisance = np.delete(design, contrast_id, axis=1)
+    return {
+        "nuisance": nuisance,
+        "pinv_nuisance": np.linalg.pinv(nuisance, rcond=1e-15),
+        "contrast_weights": pinv_design[contrast_id],
+        "contrast_var": (pinv_design @ pinv_design.T)[contrast_id, contrast_id],
+        "basis": u[:, :rank],
+        "df_resid": design.shape[0] - rank,
+    }
+
+
+def nuisance_residuals(data, basis):
+    """
+    Residuals of the data after regressing out the nuisance columns only.
+    Constant edges (e.g. the diagonal) are flagged so they never enter the max statistic.
+    """
+    data = np.asarray(data, dtype=np.float64)
+    resid = data - basis['nuisance'] @ (basis['pinv_nuisance'] @ data)
+    constant = np.all(data == data[:1], axis=0)
+    return resid, constant
+
+
+def permuted_tvals(resid, perms, basis):
+    """
+    t-values of the contrast for a batch of permutations of the nuisance residuals.
+    Permuting the rows of the data is done by permuting the design-side weights,
+    so a whole batch is a single matrix product with the residuals.
+    """
+    n_batch, n_obs = perms.shape
+    batch_rows = np.arange(n_batch)[:, None]
+
+    # w_perm[b, perms[b, i]] = w[i], so w_perm[b] @ resid == w @ resid[perms[b]]
+    weights = np.empty((n_batch, n_obs))
+    weights[batch_rows, perms] = basis['contrast_weights']
+    betas = weights @ resid
+
+    basis_perm = np.empty((n_batch, n_obs, basis['basis'].shape[1]))
+    basis_perm[batch_rows, perms] = basis['basis']
+    projected = (basis_perm.transpose(0, 2, 1).reshape(-1, n_obs) @ resid).reshape(n_batch, -1, resid.shape[1])
+
+    rss = np.einsum('ij,ij->j', resid, resid) - np.einsum('bkj,bkj->bj', projected, projected)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return betas / np.sqrt(np.clip(rss, 0, None) / basis['df_resid'] * basis['contrast_var'])
+
+
+def freedman_lane_permutations(data_blocks, design, contrast_id, n_perm, collectors, seed=None, n_jobs=1,
+                               batch_size=100):
+    """
+    Run the Freedman-Lane permutations over the edge blocks and return the observed t-values.
+    data_blocks yields the (subjects x edges) blocks of the data, in edge order. Each collector
+    is called as collector(perm_start, edge_start, tvals) with the t-values of a batch of
+    permutations (batch x edges); batches write to disjoint permutations so threads do not overlap.
+    """
+    basis = freedman_lane_basis(design, contrast_id)
+    n_obs = basis['basis'].shape[0]
+    batches = permutation_seeds(seed, n_perm, batch_size)
+    offsets = np.cumsum([0] + [size for _, size in batches])
+    observed = []
+
+    def run_batch(batch_id, resid, edge_start):
+        seed_seq, size = batches[batch_id]
+        perms = draw_permutations(seed_seq, size, n_obs)
+        tvals = permuted_tvals(resid, perms, basis)
+        for collector in collectors:
+            collector(offsets[batch_id], edge_start, tvals)
+
+    edge_start = 0
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        for block in data_blocks:
+            resid, constant = nuisance_residuals(block, basis)
+            resid[:, constant] = 0
+            block_obs = permuted_tvals(resid, np.arange(n_obs)[None, :], basis)[0]
+            block_obs[constant] = np.nan
+            observed.append(block_obs)
+            list(pool.map(partial(run_batch, resid=resid, edge_start=edge_start), range(len(batches))))
+            edge_start += block.shape[1]
+
+    return np.concatenate(observed)
+
+
+def max_stat_collector(n_perm):
+    """
+    Max |t| over all edges of each permutation, filled block by block.
+    """
+    null_max = np.zeros(n_perm)
+
+    def collect(perm_start, edge_start, tvals):
+        block_max = np.max(np.nan_to_num(np.abs(tvals), nan=0.0), axis=1, initial=0)
+        stop = perm_start + len(tvals)
+        null_max[perm_start:stop] = np.maximum(null_max[perm_start:stop], block_max)
+
+    return null_max, collect
+
+
+def max_stat_null(data_blocks, design, contrast_id, n_perm, seed=None, n_jobs=1, batch_size=100):
+    """
+    Freedman-Lane max-|t| null distribution and observed |t| over all edges.
+    data_blocks yields the (subjects x edges) blocks of the data, in edge order.
+    """
+    null_max, collect = max_stat_collector(n_perm)
+    observed = freedman_lane_permutations(data_blocks, design, contrast_id, n_perm, [collect],
+                                          seed=seed, n_jobs=n_jobs, batch_size=batch_size)
+    return null_max, np.abs(observed)
+
+
+def fwer_pvalues(observed, null_max):
+    """
+    FWER-corrected p-values: share of permutations whose max |t| reaches the edge |t|.
+    """
+    sorted_null = np.sort(null_max)
+    n_exceed = len(sorted_null) - np.searchsorted(sorted_null, observed, side='left')
+    pvals = (1 + n_exceed) / (len(sorted_null) + 1)
+    pvals[np.isnan(observed)] = np.nan
+    return pvals
+
+
+def supra_threshold_collector(n_perm, threshold):
+    """
+    Edges with t above threshold and below -threshold in each permutation, filled block by block.
+    Only the edge indices are kept, so memory grows with the supra-threshold edges.
+    """
+    positive = [[] for _ in range(n_perm)]
+    negative = [[] for _ in range(n_perm)]
+
+    def collect(perm_start, edge_start, tvals):
+        for row, perm_tvals in enumerate(tvals):
+            positive[perm_start + row].append(edge_start + np.flatnonzero(perm_tvals > threshold))
+            negative[perm_start + row].append(edge_start + np.flatnonzero(perm_tvals < -threshold))
+
+    return (positive, negative), collect
+
+
+def edge_components(edges, triangle):
+    """
+    Connected components of the ROI graph made of the given edges (indices in the packed triangle).
+    Returns the component of each edge and the number of edges of each component.
+    """
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    edges = np.asarray(edges, dtype=np.int64)
+    if len(edges) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    rows, cols = triangle.rows[edges], triangle.cols[edges]
+    graph = coo_matrix((np.ones(len(edges), dtype=np.int8), (rows, cols)), shape=triangle.shape)
+    _, node_labels = connected_components(graph, directed=False)
+
+    # Renumber the components that hold edges, isolated ROIs are not components
+    edge_labels = np.unique(node_labels[rows], return_inverse=True)[1]
+    return edge_labels, np.bincount(edge_labels)
+
+
+def max_component_size(edge_sets, triangle):
+    """
+    Size, in edges, of the largest component over the edge sets (e.g. positive and negative edges).
+    """
+    sizes = [edge_components(np.concatenate(edges) if len(edges) else [], triangle)[1] for edges in edge_sets]
+    return max((int(size.max(initial=0)) for size in sizes), default=0)
+
+
+def nbs_null(edge_sets, triangle, n_jobs=1):
+    """
+    Largest component size of every permutation, from the collected supra-threshold edges.
+    """
+    positive, negative = edge_sets
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        return np.array(list(pool.map(lambda pair: max_component_size(pair, triangle), zip(positive, negative))))
+
+
+def nbs_components(observed, threshold, triangle, null_sizes):
+    """
+    Network-based statistic: components of the edges with |t| above threshold, each tested
+    with its size against the null distribution of the largest component.
+    Returns, per edge, the component id (0 for edges in no component, positive and negative
+    components numbered in turn) and the FWER-corrected p-value of its component (NaN outside).
+    """
+    sorted_null = np.sort(null_sizes)
+    component = np.zeros(len(observed), dtype=np.int64)
+    pvals = np.full(len(observed), np.nan)
+
+    n_components = 0
+    with np.errstate(invalid='ignore'):
+        edge_sets = [np.flatnonzero(observed > threshold), np.flatnonzero(observed < -threshold)]
+    for edges in edge_sets:
+        labels, sizes = edge_components(edges, triangle)
+        n_exceed = len(sorted_null) - np.searchsorted(sorted_null, sizes, side='left')
+        component[edges] = n_components + labels + 1
+        pvals[edges] = ((1 + n_exceed) / (len(sorted_null) + 1))[labels]
+        n_components += len(sizes)
+    return component, pvals
@@ -6,28 +6,42 @@ from pathlib import Path
 import pandas as pd
 pd.set_option('future.no_silent_downcasting', True)
 
+PHENOTYPE_EXTENSIONS = ['.tsv', '.csv', '.xlsx', '.parquet', '.arrow', '.feather']
+
 def create_output(out_p) : 
     # Create output directory if it doesn't exist
     out_p = Path(out_p)
     out_p.mkdir(parents=True, exist_ok=True)
 
-def read_phenotype_file(path):
+def read_phenotype_file(path, columns=None):
+    """
+    Read a phenotype table. Text files only parse the listed columns;
+    Parquet and Arrow/Feather files need pyarrow.
+    """
     ext = Path(path).suffix.lower()
-    if ext not in ['.tsv', '.csv', '.xlsx']:
-        raise ValueError(f"❌ Unsupported extension: {ext}. Expected .tsv, .csv, or .xlsx\n")
+    if ext not in PHENOTYPE_EXTENSIONS:
+        raise ValueError(f"❌ Unsupported extension: {ext}. Expected {', '.join(PHENOTYPE_EXTENSIONS)}\n")
+    usecols = None if columns is None else (lambda col: col in set(columns))
     try:
         if ext == '.tsv':
-            return pd.read_csv(path, sep='\t')
+            return pd.read_csv(path, sep='\t', usecols=usecols)
         elif ext == '.csv':
-            return pd.read_csv(path)
+            return pd.read_csv(path, usecols=usecols)
+        elif ext == '.parquet':
+            return pd.read_parquet(path)
+        elif ext in ['.arrow', '.feather']:
+            return pd.read_feather(path)
         else:
             return pd.read_excel(path)
+    except ImportError as e:
+        raise ValueError(f"❌ Reading {ext} phenotype files requires pyarrow: {e}\n")
     except Exception as e:
         raise ValueError(f"❌ Error reading file: {e}. Make sure the file exists and is in the correct format.\n")
 
 
 def validate_columns(df, col_map):
-    missing = [c for c in col_map.keys() if c not in df.columns]
+    available = set(df.columns)
+    missing = [c for c in col_map.keys() if c not in available]
     if missing:
         raise ValueError(f"❌ Missing required columns: {missing}\n")
     df = df.rename(columns=col_map)
@@ -37,41 +51,49 @@ def validate_columns(df, col_map):
 def validate_subject_ids(df, subject_file_path):
     with open(subject_file_path) as f:
         subjects = [line.strip() for line in f if line.strip()]
-    pattern = r'^sub-(?:' + '|'.join(subjects) + r')$'
-    invalid = df[~df['participant_id'].str.match(pattern)]
+    valid = {f'sub-{subject}' for subject in subjects}
+    invalid = df[~df['participant_id'].isin(valid)]
     if not invalid.empty:
         warnings.warn(f"❗️ Found invalid subject IDs: {invalid['participant_id'].tolist()[:5]} \n")
     return df
 
 
-def encode_diagnosis(df, case, control):
-    allowed = [case, control]
+def encode_phenotype(df, case, control, covariates=()):
+    """
+    Keep the case and control rows and encode them in one pass, as categoricals:
+    diagnosis (case as 0, control as 1), sex (codes in order of appearance) and covariates.
+    """
     print(f"Encoding diagnosis: {case} as 0, {control} as 1")
-    invalid = df[~df["diagnosis"].isin(allowed)]
-    if not invalid.empty:
-        warnings.warn(f"❗️ Unexpected diagnosis values: {invalid['diagnosis'].unique()}\n")
-    df = df[df["diagnosis"].isin(allowed)]
-    return df.replace({'diagnosis': {case: 0, control: 1}})
-
+    diagnosis = df["diagnosis"].map({case: 0, control: 1})
+    valid = diagnosis.notna().to_numpy()
+    if not valid.all():
+        warnings.warn(f"❗️ Unexpected diagnosis values: {df['diagnosis'][~valid].unique()}\n")
+
+    sex_codes, _ = pd.factorize(df["sex"][valid])
+    encoded = {
+        "diagnosis": pd.Categorical(diagnosis[valid].astype(int), categories=[0, 1]),
+        "sex": pd.Categorical.from_codes(sex_codes, categories=list(range(sex_codes.max(initial=-1) + 1))),
+    }
+    for col in covariates:
+        encoded[col] = pd.Categorical(df[col][valid])
 
-def encode_sex(df):
-    sex_variable = df["sex"].unique()
-    return df.replace({'sex': {sex_variable[0]: 0, sex_variable[1]: 1}})
+    return pd.DataFrame({col: encoded[col] if col in encoded else df[col].to_numpy()[valid] for col in df.columns},
+                        index=df.index[valid])
 
 
 def warn_on_invalid_age(df):
-    invalid = df[~df["age"].apply(lambda x: isinstance(x, (int, float)) and x > 0)]
+    age = pd.to_numeric(df["age"], errors='coerce')
+    invalid = df[~(age > 0)]
     if not invalid.empty:
         warnings.warn(f"❗️ Possible invalid age values in rows: {invalid.index.tolist()[:5]}\n")
 
+
 def load_phenotype(
     phenotype_file_path, diagnosis_col, subject_col, age_col, sex_col,
     scanner_col=False, sequence=False, medication=False,
     case_name="case", control_name="control"
 ):
     print(f"⏳ Reading phenotype file: {phenotype_file_path}")
-    df = read_phenotype_file(phenotype_file_path)
-
     col_map = {
         subject_col: "participant_id",
         diagnosis_col: "diagnosis",
@@ -87,6 +109,7 @@ def load_phenotype(
     if medication: 
         col_map["medication"] = "medication"
 
+    df = read_phenotype_file(phenotype_file_path, columns=col_map.keys())
     df = validate_columns(df, col_map)
 
     if scanner_col:
@@ -96,8 +119,8 @@ def load_phenotype(
     if medication:
         print("Medications found:", df["medication"].unique())
 
-    df = encode_diagnosis(df, case_name, control_name)
-    df = encode_sex(df)
+    covariates = [col for col in ["scanner", "sequence", "medication"] if col in col_map]
+    df = encode_phenotype(df, case_name, control_name, covariates)
     warn_on_invalid_age(df)
 
     return df
\ No newline at end of file
@@ -0,0 +1,132 @@
+import os
+import csv
+import itertools
+from pathlib import Path
+
+from .files import bids_validation
+from .bids_index import scan_bids_derivatives, AGGREGATE_LABEL
+
+# Standard library only: the CLI validates its arguments and plans dry runs before numpy/pandas are imported
+ITEMSIZE = {'float32': 4, 'float64': 8}
+
+
+def expand_grid(sessions, tasks, runs, atlases, atlas_files, features):
+    """
+    All combinations of the requested labels. Atlas files are matched to atlases by position.
+    """
+    if len(atlas_files) != len(atlases):
+        raise ValueError(f"❌ Expected one atlas file per atlas, got {len(atlas_files)} files for {len(atlases)} atlases")
+    atlas_map = dict(zip(atlases, atlas_files))
+
+    return [
+        {"session": ses, "task": task, "run": run, "atlas": atlas, "atlas_file": atlas_map[atlas], "feature": feature}
+        for ses, task, run, atlas, feature in itertools.product(sessions, tasks, runs, atlases, features)
+    ]
+
+
+def read_phenotype_columns(path, columns):
+    """
+    Header and selected columns of the phenotype file, as lists of strings.
+    Only .xlsx, Parquet and Arrow files need pandas.
+    """
+    ext = Path(path).suffix.lower()
+    if ext not in ['.tsv', '.csv', '.xlsx', '.parquet', '.arrow', '.feather']:
+        raise ValueError(f"❌ Unsupported extension: {ext}. Expected .tsv, .csv, .xlsx, .parquet, .arrow or .feather\n")
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"❌ Missing phenotype file: {path}")
+
+    if ext not in ['.tsv', '.csv']:
+        from .phenotype import read_phenotype_file
+        df = read_phenotype_file(path)
+        header = [str(c) for c in df.columns]
+        rows = df.astype(str).to_dict('records')
+    else:
+        with open(path, 'r', newline='') as f:
+            reader = csv.DictReader(f, delimiter='\t' if ext == '.tsv' else ',')
+            header = reader.fieldnames or []
+            rows = list(reader)
+
+    missing = [c for c in columns if c not in header]
+    if missing:
+        raise ValueError(f"❌ Missing required columns: {missing}\n")
+    return {c: [row[c] for row in rows] for c in columns}
+
+
+def count_atlas_rois(atlas_file):
+    if not os.path.exists(atlas_file):
+        raise FileNotFoundError(f"❌ Missing required file: {atlas_file}")
+    with open(atlas_file, 'r') as f:
+        return sum(1 for line in f if line.strip())
+
+
+def select_participants(records, participant_ids, suffix, extension, **entities):
+    """
+    Participants with a file matching the entities (None = entity absent, AGGREGATE_LABEL = any label),
+    as find_files does.
+    """
+    selected = set()
+    for record in records:
+        participant_id = 'sub-' + record['sub']
+        if record['suffix'] != suffix or record['extension'] != extension or participant_id not in participant_ids:
+            continue
+        if all(value == AGGREGATE_LABEL or record.get(key) == (None if value is None else str(value))
+               for key, value in entities.items()):
+            selected.add(participant_id)
+    return selected
+
+
+def dry_run(bids_dir, pheno_p, combinations, group, scanner, sequence, medication,
+            case_name, control_name, dtype="float64"):
+    """
+    Validate the BIDS tree, the phenotype columns and the input files of every combination,
+    then print the execution plan. Nothing is read beyond file names, headers and labels.
+    """
+    print("⏳ Dry run: checking inputs without running the analysis ...\n")
+    bids_validation(bids_dir=bids_dir)
+
+    columns = ["participant_id", group, "age", "sex"]
+    columns += [name for name, used in [("scanner", scanner), ("sequence", sequence), ("medication", medication)] if used]
+    pheno = read_phenotype_columns(pheno_p, columns)
+    groups = dict(zip(pheno["participant_id"], pheno[group]))
+    participants = {sub for sub, value in groups.items() if value in (case_name, control_name)}
+    print(f"✅ Phenotype columns found: {columns} ({len(participants)} {case_name}/{control_name} subjects)")
+
+    records, directories = scan_bids_derivatives(bids_dir)
+    print(f"✅ BIDS tree scanned: {len(records)} files in {len(directories)} folders")
+
+    plan = []
+    for combination in combinations:
+        session, task, run = combination["session"], combination["task"], combination["run"]
+        atlas, feature = combination["atlas"], combination["feature"]
+        n_roi = count_atlas_rois(combination["atlas_file"])
+        connectomes = select_participants(records, participants, 'relmat', '.tsv', ses=session, task=task, run=run,
+                                          seg=atlas, meas='PearsonCorrelation', desc=feature)
+        confounds = select_participants(records, participants, 'timeseries', '.json', ses=session, task=task, run=run,
+                                        seg=None, meas=None, desc=feature)
+        subjects = connectomes & confounds
+        n_edges = n_roi * (n_roi + 1) // 2
+        plan.append(dict(combination,
+                         rois=n_roi,
+                         edges=n_edges,
+                         connectomes=len(connectomes),
+                         confounds=len(confounds),
+                         subjects=len(subjects),
+                         cases=sum(groups[sub] == case_name for sub in subjects),
+                         controls=sum(groups[sub] == control_name for sub in subjects),
+                         stack_mb=round(len(subjects) * n_edges * ITEMSIZE[dtype] / 1024 ** 2, 1)))
+
+    print_plan(plan, case_name, control_name)
+    return plan
+
+
+def print_plan(plan, case_name, control_name):
+    print(f"\n📌 Execution plan: {len(plan)} analysis(es)")
+    for step in plan:
+        print(f"ses-{step['session']} task-{step['task']} run-{step['run']} seg-{step['atlas']} desc-{step['feature']}: "
+              f"{step['subjects']} subjects ({step['cases']} {case_name}, {step['controls']} {control_name}) "
+              f"before motion QC, {step['rois']} ROIs, {step['edges']} edges, "
+              f"connectome stack {step['stack_mb']} MB")
+        if step['connectomes'] != step['confounds']:
+            print(f"❗️ {step['connectomes']} connectomes but {step['confounds']} confounds files")
+        if step['cases'] == 0 or step['controls'] == 0:
+            print(f"❗️ No {case_name if step['cases'] == 0 else control_name} subject for this analysis")
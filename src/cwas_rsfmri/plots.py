@@ -2,42 +2,53 @@ import plotly.graph_objects as go
 import numpy as np
 import os
 
-def plot_interactive_matrix(output_path, beta_matrix, pvalues_matrix, labels):
+# Above this number of ROIs, the heatmap is rendered as network blocks
+SCALABLE_MIN_ROIS = 200
+
+CUSTOM_COLORSCALE = [
+    [0.0, "blue"],
+    [0.5, "white"],
+    [1.0, "red"]
+]
+
+def plot_interactive_matrix(output_path, beta_matrix, pvalues_matrix, labels, triangle=None, correction='FDR'):
     """
     Plot an interactive connectivity matrix using Plotly.
+    With a ConnectomeTriangle, beta_matrix and pvalues_matrix are packed vectors and
+    only their upper triangle is built, without the full symmetric matrices.
+    pvalues_matrix holds p-values corrected with correction (e.g. FDR q-values), as named in the title.
     """
     print("\n📊 Plotting interactive connectivity matrix ...\n")
 
-    # Prepare pvalues matrix
-    pvalues_corrected = np.array(pvalues_matrix)
-    significance_mask = np.zeros_like(pvalues_corrected, dtype=bool)
-    upper_triangle_indices = np.triu_indices_from(pvalues_corrected, k=1)
-    significance_mask[upper_triangle_indices] = pvalues_corrected[upper_triangle_indices] < 0.05
+    if triangle is not None:
+        beta_matrix_upper = triangle.upper(beta_matrix)
+        significance_mask = triangle.upper(np.asarray(pvalues_matrix) < 0.05, fill=0) == 1
+        abs_max = np.nanmax(np.abs(beta_matrix))
+    else:
+        # Prepare pvalues matrix
+        pvalues_corrected = np.array(pvalues_matrix)
+        significance_mask = np.zeros_like(pvalues_corrected, dtype=bool)
+        upper_triangle_indices = np.triu_indices_from(pvalues_corrected, k=1)
+        significance_mask[upper_triangle_indices] = pvalues_corrected[upper_triangle_indices] < 0.05
 
-    # Prepare beta matrix
-    beta_matrix = np.array(beta_matrix)
-    abs_max = np.nanmax(np.abs(beta_matrix))
-    zmin, zmax = -abs_max, abs_max
+        # Prepare beta matrix
+        beta_matrix = np.array(beta_matrix)
+        abs_max = np.nanmax(np.abs(beta_matrix))
 
-    # Create a full matrix of NaNs with same shape
-    beta_matrix_upper = np.full_like(beta_matrix, np.nan)
+        # Create a full matrix of NaNs with same shape
+        beta_matrix_upper = np.full_like(beta_matrix, np.nan)
 
-    # Fill in only the upper triangle (excluding diagonal)
-    i_upper, j_upper = np.triu_indices_from(beta_matrix, k=1)
-    beta_matrix_upper[i_upper, j_upper] = beta_matrix[i_upper, j_upper]
-
-    custom_colorscale = [
-        [0.0, "blue"],   
-        [0.5, "white"], 
-        [1.0, "red"]     
-    ]
+        # Fill in only the upper triangle (excluding diagonal)
+        i_upper, j_upper = np.triu_indices_from(beta_matrix, k=1)
+        beta_matrix_upper[i_upper, j_upper] = beta_matrix[i_upper, j_upper]
+    zmin, zmax = -abs_max, abs_max
 
     # Prepare beta heatmap
     heatmap = go.Heatmap(
         z=beta_matrix_upper,
         x=labels,
         y=labels,
-        colorscale=custom_colorscale,
+        colorscale=CUSTOM_COLORSCALE,
         zmin=zmin,
         zmax=zmax,
         colorbar=dict(title='Beta values'),
@@ -59,13 +70,17 @@ def plot_interactive_matrix(output_path, beta_matrix, pvalues_matrix, labels):
     fig = go.Figure(data=[heatmap, sig_overlay])
 
     fig.update_layout(
-        title=f'Interactive beta value heatmap with FDR correction',
+        title=f'Interactive beta value heatmap with {correction} correction',
         xaxis=dict(title='Labels (Colonnes)', tickangle=45),
         yaxis=dict(title='Labels (Lignes)', autorange='reversed'),
         width=1200,  
         height=800   
     )
 
+    return save_heatmap(fig, output_path)
+
+
+def save_heatmap(fig, output_path):
     # Save in html file
     filename = f'interactive_heatmap'
     output_path = os.path.join(output_path, "{}.html".format(filename))
@@ -75,4 +90,138 @@ def plot_interactive_matrix(output_path, beta_matrix, pvalues_matrix, labels):
     full_html=True,         
     config={"responsive": True} 
     )
-    print(f"✅ Heatmap interactive saved in : {output_path}")
\ No newline at end of file
+    print(f"✅ Heatmap interactive saved in : {output_path}")
+    return output_path
+
+
+def roi_networks(labels, networks=None, n_blocks=20):
+    """
+    Network of each ROI: given by the atlas, parsed from Schaefer-style labels
+    (e.g. 7Networks_LH_Vis_1), or else consecutive blocks of ROIs.
+    """
+    if networks is not None:
+        return np.asarray(networks, dtype=str)
+
+    parts = [str(label).split('_') for label in labels]
+    if all(len(p) >= 3 and p[1] in ('LH', 'RH') for p in parts):
+        return np.array([p[2] for p in parts])
+
+    block = int(np.ceil(len(labels) / n_blocks))
+    return np.array([f'ROIs {start + 1}-{min(start + block, len(labels))}'
+                     for start in range(0, len(labels), block) for _ in range(min(block, len(labels) - start))])
+
+
+def plot_network_blocks(output_path, betas, pvals, labels, triangle, networks=None, alpha=0.05, correction='FDR'):
+    """
+    Scalable interactive heatmap for large atlases.
+    The first view is the network x network overview (mean beta and number of significant
+    edges per block). Each block can be opened from the dropdown: its upper-triangle betas
+    are sent as float32 typed arrays, and significant edges as a sparse list of markers.
+    pvals are corrected with correction (e.g. FDR q-values), as named in the titles.
+    """
+    print("\n📊 Plotting interactive network blocks ...\n")
+
+    labels = np.asarray(labels, dtype=str)
+    networks = roi_networks(labels, networks)
+    names, roi_network = np.unique(networks, return_inverse=True)
+    # Keep the networks in atlas order
+    order = np.argsort([np.flatnonzero(roi_network == n)[0] for n in range(len(names))])
+    names, roi_network = names[order], np.argsort(order)[roi_network]
+
+    betas = np.asarray(betas, dtype=np.float32)
+    significant = np.asarray(pvals) < alpha
+    off_diagonal = triangle.off_diagonal
+    beta_full = triangle.unpack(np.where(off_diagonal, betas, np.nan))
+    sig_full = triangle.unpack(significant & off_diagonal)
+    abs_max = float(np.nanmax(np.abs(betas[off_diagonal]))) if off_diagonal.any() else 1.0
+
+    # Overview: one cell per pair of networks, each edge counted once
+    net_rows = roi_network[triangle.rows[off_diagonal]]
+    net_cols = roi_network[triangle.cols[off_diagonal]]
+    low, high = np.minimum(net_rows, net_cols), np.maximum(net_rows, net_cols)
+    n_net = len(names)
+    sums = np.zeros((n_net, n_net))
+    counts = np.zeros((n_net, n_net))
+    n_sig = np.zeros((n_net, n_net), dtype=int)
+    np.add.at(sums, (low, high), betas[off_diagonal])
+    np.add.at(counts, (low, high), 1)
+    np.add.at(n_sig, (low, high), significant[off_diagonal])
+    with np.errstate(invalid='ignore'):
+        overview = np.where(counts > 0, sums / counts, np.nan).astype(np.float32)
+
+    traces = [go.Heatmap(
+        z=overview, x=names, y=names, customdata=n_sig,
+        colorscale=CUSTOM_COLORSCALE, zmin=-abs_max, zmax=abs_max,
+        colorbar=dict(title='Beta values'),
+        hovertemplate="%{y} - %{x}<br>Mean beta: %{z:.3f}<br>Significant edges: %{customdata}<extra></extra>"
+    )]
+    buttons = [dict(label='Overview', method='update',
+                    args=[{'visible': None}, {'title': f'Network overview: mean beta and significant edges ({correction})'}])]
+
+    # Drill-down blocks, the blocks with the most significant edges first
+    pairs = sorted(zip(*np.triu_indices(n_net)), key=lambda pair: -n_sig[pair])
+    for a, b in pairs:
+        rows, cols = np.flatnonzero(roi_network == a), np.flatnonzero(roi_network == b)
+        block = beta_full[np.ix_(rows, cols)]
+        block_sig = sig_full[np.ix_(rows, cols)] > 0
+        if a == b:
+            # Within a network, show each edge once
+            lower = np.tril(np.ones(block.shape, dtype=bool))
+            block[lower] = np.nan
+            block_sig[lower] = False
+        sig_rows, sig_cols = np.nonzero(block_sig)
+
+        traces.append(go.Heatmap(
+            z=block, x=labels[cols], y=labels[rows], visible=False,
+            colorscale=CUSTOM_COLORSCALE, zmin=-abs_max, zmax=abs_max, showscale=False,
+            hovertemplate="%{y} - %{x}<br>Beta value: %{z}<extra></extra>"
+        ))
+        traces.append(go.Scatter(
+            x=labels[cols][sig_cols], y=labels[rows][sig_rows], mode='markers', visible=False,
+            marker=dict(symbol='square-open', color='rgba(255,200,0,0.9)', size=8), hoverinfo='skip',
+            showlegend=False
+        ))
+        buttons.append(dict(label=f'{names[a]} - {names[b]} ({n_sig[a, b]})', method='update',
+                            args=[{'visible': None}, {'title': f'{names[a]} - {names[b]}: betas, significant edges ({correction}) outlined'}]))
+
+    for button_id, button in enumerate(buttons):
+        visible = [False] * len(traces)
+        if button_id == 0:
+            visible[0] = True
+        else:
+            visible[2 * button_id - 1] = visible[2 * button_id] = True
+        button['args'][0]['visible'] = visible
+
+    fig = go.Figure(data=traces)
+    fig.update_layout(
+        title=f'Network overview: mean beta and significant edges ({correction})',
+        updatemenus=[dict(buttons=buttons, direction='down', x=0, xanchor='left', y=1.12, yanchor='top')],
+        xaxis=dict(title='Labels (Colonnes)', tickangle=45),
+        yaxis=dict(title='Labels (Lignes)', autorange='reversed'),
+        width=1200,
+        height=800
+    )
+
+    return save_heatmap(fig, output_path)
+
+
+def plot_connectome_results(output_path, betas, pvals, labels, triangle, mode='auto', networks=None, correction='FDR'):
+    """
+    Interactive heatmap of packed results: the full matrix for small atlases,
+    network blocks ("scalable") above SCALABLE_MIN_ROIS ROIs or when requested.
+    pvals are the corrected p-values that mark significant edges (see stats.corrected_pvalues).
+    """
+    if mode == 'auto':
+        mode = 'scalable' if triangle.n_roi > SCALABLE_MIN_ROIS else 'full'
+    if mode not in ('full', 'scalable'):
+        raise ValueError(f'❌ Unknown plot mode: {mode}. Expected "auto", "full" or "scalable"')
+
+    if mode == 'scalable':
+        return plot_network_blocks(output_path, betas, pvals, labels, triangle, networks=networks, correction=correction)
+    return plot_interactive_matrix(output_path=output_path,
+                                   beta_matrix=betas,
+                                   pvalues_matrix=pvals,
+                                   labels=labels,
+                                   triangle=triangle,
+                                   correction=correction
+                                   )
@@ -0,0 +1,71 @@
+import os
+import sys
+import time
+import pstats
+import cProfile
+from contextlib import contextmanager
+
+# Stages of run_pipeline, in order
+PIPELINE_STAGES = ['bids_index', 'phenotype', 'atlas', 'subjects', 'fd_table', 'runs', 'fd_filter',
+                   'site_stats', 'incremental', 'connectome_stack', 'transform', 'harmonization', 'glm', 'contrasts', 'save', 'plot']
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def peak_rss_mb():
+    """
+    Peak resident memory of the process so far, in MB (None where unavailable).
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return round(peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024, 1)
+
+
+@contextmanager
+def profile_stage(profile, stage, output_dir=None, cprofile_stages=()):
+    """
+    Record wall time, CPU time and peak RSS of a stage in profile[stage].
+    The block gets a dict to fill with item counts (subjects, edges, files read ...).
+    Stages listed in cprofile_stages also run under cProfile, with the statistics
+    saved in output_dir as profile_{stage}.prof and profile_{stage}.txt.
+    CPU time is that of the calling thread, so analyses running concurrently in a batch
+    are not counted (nor the worker threads of the stage). Peak RSS is a process-level
+    figure: the peak of the whole process when the stage ends.
+    """
+    counts = {}
+    profiler = cProfile.Profile() if stage in cprofile_stages else None
+    wall, cpu = time.perf_counter(), time.thread_time()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield counts
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            save_cprofile(profiler, output_dir, stage)
+        profile[stage] = dict({
+            'wall_s': round(time.perf_counter() - wall, 3),
+            'cpu_s': round(time.thread_time() - cpu, 3),
+            'peak_rss_mb': peak_rss_mb(),
+        }, **counts)
+
+
+def save_cprofile(profiler, output_dir, stage):
+    prof_path = os.path.join(output_dir, f'profile_{stage}.prof')
+    profiler.dump_stats(prof_path)
+    with open(os.path.join(output_dir, f'profile_{stage}.txt'), 'w') as f:
+        pstats.Stats(profiler, stream=f).sort_stats('cumulative').print_stats(30)
+    print(f"📌 cProfile statistics of stage '{stage}' saved in: {prof_path}")
+
+
+def print_profile(profile):
+    print("\n⏱️  Time per stage:")
+    for stage, values in profile.items():
+        counts = ', '.join(f'{k}={v}' for k, v in values.items() if k not in ('wall_s', 'cpu_s', 'peak_rss_mb'))
+        print(f"{stage}: {values['wall_s']:.2f}s wall, {values['cpu_s']:.2f}s CPU, "
+              f"process peak RSS {values['peak_rss_mb']} MB" + (f" ({counts})" if counts else ''))
@@ -5,9 +5,12 @@ import glob
 import os
 import json
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
 from .files import report_file
+from .bids_index import find_confounds_files, find_confounds_runs, aggregates_runs
+from .store import source_stat
 
 def filter_by_qc(json_file_path, pheno_filtered, out_p):
     """
@@ -91,40 +94,156 @@ def filter_by_qc(json_file_path, pheno_filtered, out_p):
 
     return pheno_filtered_qc
 
-def filter_by_fd(pheno_filtered_qc, derivatives_p, confounds_json, out_p, session, task, run, feature):
+# Fields of the HALFpipe confounds JSON used for motion QC
+QC_FIELDS = {
+    'mean_fd': 'MeanFramewiseDisplacement',
+    'n_scrubbed': 'NumberOfVolumesDiscardedByMotionScrubbing',
+    'n_nonsteady': 'NumberOfVolumesDiscardedByNonsteadyStatesDetector',
+}
+# Columns of the motion QC table: the JSON fields and the number of acquired volumes
+QC_COLUMNS = list(QC_FIELDS) + ['n_volumes']
+
+def count_volumes(tsv_path):
+    """
+    Number of volumes (non-empty rows) of a timeseries TSV, without its header line if it has one.
+    """
+    with open(tsv_path, 'r') as f:
+        first_values = [line.split('\t', 1)[0] for line in f if line.strip()]
+    try:
+        float(first_values[0])
+    except (IndexError, ValueError):
+        return max(len(first_values) - 1, 0)
+    return len(first_values)
+
+def read_confounds_qc(path):
+    """
+    Motion QC values of a confounds JSON. The JSON does not give the number of acquired volumes:
+    it is the number of rows of the timeseries TSV next to it, plus the volumes discarded as
+    non-steady states or by motion scrubbing (NaN without the TSV).
+    """
+    with open(path, 'r') as file:
+        data = json.load(file)
+    values = [data.get(key, np.nan) for key in QC_FIELDS.values()]
+    tsv_path = os.path.splitext(path)[0] + '.tsv'
+    if os.path.exists(tsv_path):
+        n_volumes = count_volumes(tsv_path) + np.nansum([data.get(QC_FIELDS['n_scrubbed'], 0),
+                                                         data.get(QC_FIELDS['n_nonsteady'], 0)])
+    else:
+        n_volumes = np.nan
+    return values + [n_volumes]
+
+def read_fd_table(json_files, n_jobs=1, cache_path=None):
+    """
+    Motion QC table (mean FD, scrubbed volumes) of each subject, from a Series
+    participant_id -> confounds JSON. JSON files are read by n_jobs threads.
+    With cache_path, the values are saved with the size and mtime of each JSON
+    and later runs only read the files that are new or modified.
+    """
+    json_files = json_files.dropna()
+    sources = pd.DataFrame([source_stat(path) for path in json_files], columns=['path', 'size', 'mtime_ns'])
+
+    cache = sources.iloc[:0].assign(**{field: np.zeros(0) for field in QC_COLUMNS})
+    if cache_path is not None and os.path.exists(cache_path):
+        cached = pd.read_csv(cache_path, sep='\t')
+        # A cache written with other columns is read again
+        if set(QC_COLUMNS) <= set(cached.columns):
+            cache = cached
+    known = sources.merge(cache, on=['path', 'size', 'mtime_ns'], how='left', indicator=True)
+    to_read = (known['_merge'] == 'left_only').values
+
+    if to_read.any():
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            values = list(pool.map(read_confounds_qc, sources.loc[to_read, 'path']))
+        known.loc[to_read, QC_COLUMNS] = np.array(values, dtype=float).reshape(-1, len(QC_COLUMNS))
+    print(f"📌 Motion QC of {len(sources)} subjects: {to_read.sum()} JSON files read, {(~to_read).sum()} from cache")
+
+    known = known.drop(columns='_merge')
+    if cache_path is not None and to_read.any():
+        # Keep the entries of other subjects, sessions and tasks
+        updated = pd.concat([cache[~cache['path'].isin(known['path'])], known], ignore_index=True)
+        tmp_path = cache_path + '.tmp'
+        updated.to_csv(tmp_path, sep='\t', index=False)
+        os.replace(tmp_path, cache_path)
+
+    fd_table = known[QC_COLUMNS].astype(float).set_index(json_files.index)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fd_table['percent_scrubbed'] = 100 * fd_table['n_scrubbed'] / fd_table['n_volumes']
+    return fd_table
+
+def read_mean_fd(pheno, derivatives_p, confounds_json, session, task, run, feature, bids_index=None,
+                 n_jobs=1, cache_path=None):
+    """
+    Read the mean framewise displacement (FD) of each subject from the HALFpipe confounds JSON.
+    Returns the motion QC table indexed by participant_id; subjects without JSON are left out.
+    When the runs are aggregated (see bids_index.AGGREGATE_LABEL), the table has one row
+    per run, indexed by bids_index.run_label.
+    """
+    if aggregates_runs(session, run):
+        if bids_index is None:
+            raise ValueError("❌ Aggregating sessions or runs needs the BIDS index")
+        json_files = find_confounds_runs(bids_index, pheno['participant_id'], session, task, run, feature)['path']
+    elif bids_index is not None:
+        json_files = find_confounds_files(bids_index, pheno['participant_id'], session, task, run, feature)
+    else:
+        json_files = {}
+        for _, row in tqdm(pheno.iterrows()):
+            json_file_path = os.path.join(derivatives_p, row['participant_id'], 'ses-{}'.format(session), "func",
+                                                    confounds_json.format(row['participant_id'], session, task, run, feature))
+            if os.path.exists(json_file_path):
+                json_files[row['participant_id']] = json_file_path
+        json_files = pd.Series(json_files, dtype=object)
+
+    return read_fd_table(json_files, n_jobs=n_jobs, cache_path=cache_path)
+
+def filter_by_fd(pheno_filtered_qc, derivatives_p, confounds_json, out_p, session, task, run, feature, bids_index=None,
+                 fd_table=None, fd_threshold=0.5, max_percent_scrubbed=None):
     """
-    Filter subjects based on framewise displacement (FD)
+    Filter subjects based on framewise displacement (FD).
+    Subjects are kept when their mean FD is below fd_threshold and, if max_percent_scrubbed
+    is set, when at most this percentage of their volumes was removed by motion scrubbing.
+    A precomputed FD table (participant_id -> mean FD) can be given to skip the JSON reads.
     """
-    print("\n⏳ Reject subjects based on mean FD>0.5 ...")
+    print(f"\n⏳ Reject subjects based on mean FD>{fd_threshold} ...")
     print("This might take a moment, please do not interupt the process ...\n")
     
     # Find subjects processed by HALFpipe and collect their FD values
-    mean_fd_list = []
-    
-    for _, row in tqdm(pheno_filtered_qc.iterrows()):
-        json_file_path = os.path.join(derivatives_p, row['participant_id'], 'ses-{}'.format(session), "func",
-                                                confounds_json.format(row['participant_id'], session, task, run, feature))
-        if os.path.exists(json_file_path) :
-            # Read the JSON file
-            with open(json_file_path, 'r') as file:
-                data = json.load(file)  
-
-            mean_fd_list.append(data["MeanFramewiseDisplacement"])
+    if fd_table is None:
+        fd_table = read_mean_fd(pheno_filtered_qc, derivatives_p, confounds_json,
+                                session, task, run, feature, bids_index=bids_index)
+    if isinstance(fd_table, pd.Series):
+        fd_table = fd_table.to_frame('mean_fd')
         
-    # Add mean FD values to phenotype dataframe
-    pheno_filtered_qc.loc[:, 'mean_fd'] = mean_fd_list
+    # Add mean FD values to phenotype dataframe, matched on subject ID
+    pheno_filtered_qc = pheno_filtered_qc.copy()
+    pheno_filtered_qc['mean_fd'] = pheno_filtered_qc['participant_id'].map(fd_table['mean_fd'])
 
-    # Filter out subjects with high mean framewise displacement (FD >= 0.5)
-    pheno_filtered_fd_mean = pheno_filtered_qc[pheno_filtered_qc['mean_fd'] < 0.5]
-    subjects_with_mean_rejection = pheno_filtered_qc[pheno_filtered_qc['mean_fd'] > 0.5]['participant_id']
+    # Filter out subjects with high mean framewise displacement (FD >= threshold)
+    keep = pheno_filtered_qc['mean_fd'] < fd_threshold
+    subjects_with_mean_rejection = pheno_filtered_qc[pheno_filtered_qc['mean_fd'] >= fd_threshold]['participant_id']
+    subjects_without_fd = pheno_filtered_qc[pheno_filtered_qc['mean_fd'].isnull()]['participant_id']
     
     # Define summary data
     summary_data = {
         "Total subjects before FD rejection": len(pheno_filtered_qc),
-        "N Subjects with mean FD>0.5": len(subjects_with_mean_rejection),
-        "Subjects with mean FD>0.5": sorted(subjects_with_mean_rejection),
+        f"N Subjects with mean FD>{fd_threshold}": len(subjects_with_mean_rejection),
+        f"Subjects with mean FD>{fd_threshold}": sorted(subjects_with_mean_rejection),
+        "Subjects without mean FD": sorted(subjects_without_fd),
     }
 
+    if max_percent_scrubbed is not None:
+        percent_scrubbed = pheno_filtered_qc['participant_id'].map(fd_table['percent_scrubbed'])
+        missing = pheno_filtered_qc.loc[keep & percent_scrubbed.isnull(), 'participant_id']
+        if len(missing):
+            raise ValueError(f"❌ The scrubbing criterion needs the number of volumes, from the timeseries TSV "
+                             f"next to the confounds JSON, missing for {len(missing)} subjects: {sorted(missing)}")
+        scrubbed = keep & (percent_scrubbed > max_percent_scrubbed)
+        keep &= ~scrubbed
+        summary_data[f"N Subjects with more than {max_percent_scrubbed}% scrubbed volumes"] = int(scrubbed.sum())
+        summary_data[f"Subjects with more than {max_percent_scrubbed}% scrubbed volumes"] = \
+            sorted(pheno_filtered_qc.loc[scrubbed, 'participant_id'])
+
+    pheno_filtered_fd_mean = pheno_filtered_qc[keep]
+
     # Save summary to file
     json_path = os.path.join(out_p, 'cwas_report.json')
     report_file(out_p, summary_data)
@@ -138,4 +257,4 @@ def filter_by_fd(pheno_filtered_qc, derivatives_p, confounds_json, out_p, sessio
             
     print(f"\n✅ Information saved in:", json_path)
     
-    return pheno_filtered_fd_mean
\ No newline at end of file
+    return pheno_filtered_fd_mean
@@ -1,5 +1,22 @@
+import json
 import argparse
-from cwas_rsfmri.workflow import run_pipeline
+# The workflow and its numerical stack are only imported once the arguments are parsed
+from cwas_rsfmri.profiling import PIPELINE_STAGES
+from cwas_rsfmri.plan import expand_grid, dry_run
+from cwas_rsfmri.files import parse_shard, parse_contrasts, OUTPUT_FORMATS
+
+# Entry points of the workflow that can still be imported from this module
+WORKFLOW_EXPORTS = ['run_pipeline', 'run_batch', 'run_merge_sites', 'run_merge_shards']
+
+
+def __getattr__(name):
+    """
+    Import the workflow entry points on first use, e.g. from cwas_rsfmri.run import run_pipeline.
+    """
+    if name in WORKFLOW_EXPORTS:
+        from cwas_rsfmri import workflow
+        return getattr(workflow, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 def parsers():
     parser = argparse.ArgumentParser()
@@ -7,16 +24,18 @@ def parsers():
     parser.add_argument("--output_dir", required=True, help="Path to the output directory")
     parser.add_argument("--phenotype_file", required=True, help="Path to the phenotype file")
     
-    parser.add_argument("--atlas", required=True, help="Atlas to use for the analysis")
-    parser.add_argument("--atlas_file", required=True, help="Path to the atlas file")
+    parser.add_argument("--atlas", nargs="+", help="Atlas(es) to use for the analysis")
+    parser.add_argument("--atlas_file", nargs="+", help="Path to the atlas file, one per atlas")
 
     parser.add_argument("--analysis_level", choices=["group"])
     parser.add_argument("--participant-label", nargs="+")
     
-    parser.add_argument("--session", type=str, required=True, help="Session label for the analysis")
-    parser.add_argument("--task", type=str, required=True, help="Task label for the analysis")
-    parser.add_argument("--run", type=str, required=True, help="Run label for the analysis")
-    parser.add_argument("--feature", type=str, required=True, help="Feature label for the analysis")
+    parser.add_argument("--session", type=str, nargs="+", help="Session label(s) for the analysis ('all' averages every session of a subject)")
+    parser.add_argument("--task", type=str, nargs="+", help="Task label(s) for the analysis")
+    parser.add_argument("--run", type=str, nargs="+", help="Run label(s) for the analysis ('all' averages every run of a subject)")
+    parser.add_argument("--feature", type=str, nargs="+", help="Feature label(s) for the analysis")
+    parser.add_argument("--grid", type=str, default=None, help="JSON file listing the session/task/run/atlas/atlas_file/feature combinations to run")
+    parser.add_argument("--batch_jobs", type=int, default=None, help="Number of combinations run concurrently in batch mode")
 
     # Based on phenotype file
     parser.add_argument("--group", type=str, required=False, default="diagnosis", help="Column name for the diagnosis in the phenotype file")
@@ -27,29 +46,240 @@ def parsers():
     parser.add_argument("--scanner", type=bool, default=False, help="Include scanner information")
     parser.add_argument("--sequence", type=bool, default=False, help="Include sequence column in the phenotype file")
     parser.add_argument("--medication", type=bool, default=False, help="Include medication column in the phenotype file")
+    parser.add_argument("--transform", nargs="+", choices=["fisher_z", "partial", "tangent"], default=None, help="Connectome transforms applied in order before the GLM: Fisher r-to-z, partial correlation, tangent-space embedding (e.g. --transform partial fisher_z)")
+    parser.add_argument("--combat", action="store_true", help="Harmonize the connectomes across scanners with ComBat before the GLM (needs --scanner)")
+    parser.add_argument("--combat_params", type=str, default=None, help="ComBat parameters (.npz) saved by an earlier run, to harmonize new subjects without refitting")
+
+    # Motion QC
+    parser.add_argument("--fd_threshold", type=float, default=0.5, help="Subjects with a mean FD at or above this value are rejected")
+    parser.add_argument("--max_scrubbed", type=float, default=None, help="Reject subjects with more than this percentage of volumes removed by motion scrubbing")
+    parser.add_argument("--run_weights", choices=["equal", "volumes", "fd"], default="equal", help="Weight of each run when sessions or runs are averaged (--session all, --run all): equal, volumes left after scrubbing, or inverse mean FD")
+    parser.add_argument("--fd_cache", type=str, default=None, help="Path to a TSV file caching the motion QC values of the confounds JSON files between runs")
+
+    # Performance options
+    parser.add_argument("--glm_engine", choices=["vectorized", "statsmodels"], default="vectorized", help="GLM engine: batched OLS over all edges or one statsmodels fit per edge")
+    parser.add_argument("--contrasts", nargs="+", default=None, metavar="[NAME=]SPEC", help="Other effects tested in one pass, each saved in its own tables: a design term (age, sex, scanner, diagnosis:age; several columns give an F-test), a patsy constraint (\"age - mean_fd\") or JSON weights over the design columns")
+    parser.add_argument("--extra_terms", type=str, default="", help="Terms added to the design of --contrasts, e.g. \"C(diagnosis):age\"")
+    parser.add_argument("--robust", choices=["HC0", "HC1", "HC2", "HC3", "huber"], default=None, help="Robust GLM: heteroskedasticity-consistent standard errors (HC0-HC3) or Huber M-estimation, fitted over all edges at once")
+    parser.add_argument("--n_perm", type=int, default=0, help="Number of Freedman-Lane permutations for FWER correction (0 to skip)")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed for the permutations")
+    parser.add_argument("--nbs_threshold", type=float, default=None, help="Network-based statistic: t threshold of the edges forming components, tested with the --n_perm permutations")
+    parser.add_argument("--checkpoint", action="store_true", help="Save the output of each stage in output_dir/cache and reuse it when the inputs did not change")
+    parser.add_argument("--bids_index", type=str, default=None, help="Path to a JSON file caching the BIDS derivatives index between runs")
+    parser.add_argument("--n_jobs", type=int, default=1, help="Number of threads used to read connectome files and run permutations")
+    parser.add_argument("--connectome_store", type=str, default=None, help="Directory of the persistent binary connectome store, reused and updated across runs")
+    parser.add_argument("--incremental", type=str, default=None, metavar="STATE_DIR", help="Keep the OLS cross-products and the contribution of each subject in this directory; later runs only read the subjects added or excluded since the last update")
+    parser.add_argument("--incremental_check", action="store_true", help="Compare the incremental GLM with a full refit of the stored connectomes, and rebuild the cross-products if they differ")
+    parser.add_argument("--shard", type=str, default=None, metavar="i/N", help="Only fit the i-th of N slices of the edges (i from 1 to N) and save it, to be assembled with cwas-rsfmri-merge-shards")
+    parser.add_argument("--site_stats", type=str, default=None, metavar="SITE_NAME", help="Federated mode: only export the sufficient statistics of this site, to be pooled with cwas-rsfmri-merge-sites")
+    parser.add_argument("--dtype", choices=["float64", "float32"], default="float64", help="Precision of the stored connectomes. float32 halves the memory of the connectome stack")
+    parser.add_argument("--plot_mode", choices=["auto", "full", "scalable"], default="auto", help="Interactive heatmap: full matrix, or network blocks for large atlases (auto: blocks above 200 ROIs)")
+    parser.add_argument("--output_format", choices=OUTPUT_FORMATS, default="tsv", help="Results as text tables and matrices (tsv), or as one compressed edge table (npz, parquet) with the ROI labels as metadata")
+    parser.add_argument("--cprofile_stage", nargs="+", choices=PIPELINE_STAGES, default=(), help="Run these stages under cProfile and save the statistics in the output directory")
+    parser.add_argument("--max_memory", type=str, default=None, help="Memory budget for the CWAS (e.g. 8G). Connectomes are kept on disk and fitted in edge blocks")
+    parser.add_argument("--dry_run", "--dry-run", action="store_true", help="Only validate the inputs and print the execution plan, without loading the numerical stack")
 
     args = parser.parse_args()
 
+    # Without a grid file, every label of the combinations is required
+    if args.grid is None:
+        missing = [f"--{name}" for name in ["atlas", "atlas_file", "session", "task", "run", "feature"]
+                   if getattr(args, name) is None]
+        if missing:
+            parser.error(f"the following arguments are required without --grid: {', '.join(missing)}")
+    if args.nbs_threshold is not None and not args.n_perm:
+        parser.error("--nbs_threshold needs permutations, set --n_perm")
+    if (args.combat or args.combat_params) and not args.scanner:
+        parser.error("--combat harmonizes scanners, set --scanner True")
+    if args.incremental_check and args.incremental is None:
+        parser.error("--incremental_check needs --incremental")
+    if args.robust is not None and (args.n_perm or args.site_stats is not None):
+        parser.error("--robust cannot be combined with --n_perm or --site_stats, which use OLS statistics")
+    try:
+        parse_shard(args.shard)
+        args.contrasts = parse_contrasts(args.contrasts)
+    except ValueError as e:
+        parser.error(str(e))
+
     return args
 
+def read_grid(grid_file, args):
+    """
+    Combinations listed in a grid file; missing labels are taken from the command line,
+    which must then give a single value.
+    """
+    with open(grid_file, 'r') as f:
+        grid = json.load(f)
+
+    combinations = []
+    for entry in grid:
+        combination = {}
+        for name in ["session", "task", "run", "atlas", "atlas_file", "feature"]:
+            if entry.get(name) is not None:
+                combination[name] = entry[name]
+                continue
+            values = getattr(args, name) or []
+            if not values:
+                raise ValueError(f"❌ Missing {name} in grid entry: {entry}")
+            if len(values) > 1:
+                raise ValueError(f"❌ Several --{name} values {values} for grid entry {entry}: "
+                                 f"list the {name} of each combination in the grid file")
+            combination[name] = values[0]
+        combinations.append(combination)
+    return combinations
+
 def main():
     print("\n🚀 Welcome to CWAS-rsfmri! \n")
     args = parsers()
 
+    if args.grid is not None:
+        combinations = read_grid(args.grid, args)
+    else:
+        combinations = expand_grid(args.session, args.task, args.run, args.atlas, args.atlas_file, args.feature)
+
+    if args.dry_run:
+        dry_run(bids_dir=args.bids_dir,
+                pheno_p=args.phenotype_file,
+                combinations=combinations,
+                group=args.group,
+                scanner=args.scanner,
+                sequence=args.sequence,
+                medication=args.medication,
+                case_name=args.case_id,
+                control_name=args.control_id,
+                dtype=args.dtype)
+        print("\n🎉 Dry run finished! \n")
+        return
+
+    from cwas_rsfmri.workflow import run_pipeline, run_batch
+
+    # Several combinations: shared work is done once and analyses run concurrently
+    if len(combinations) > 1:
+        run_batch(bids_dir=args.bids_dir,
+                  output_dir=args.output_dir,
+                  pheno_p=args.phenotype_file,
+                  combinations=combinations,
+                  group=args.group,
+                  scanner=args.scanner,
+                  sequence=args.sequence,
+                  medication=args.medication,
+                  case_name=args.case_id,
+                  control_name=args.control_id,
+                  glm_engine=args.glm_engine,
+                  max_memory=args.max_memory,
+                  store_dir=args.connectome_store,
+                  n_jobs=args.n_jobs,
+                  bids_index_cache=args.bids_index,
+                  n_perm=args.n_perm,
+                  seed=args.seed,
+                  batch_jobs=args.batch_jobs,
+                  checkpoint=args.checkpoint,
+                  site_name=args.site_stats,
+                  dtype=args.dtype,
+                  plot_mode=args.plot_mode,
+                  cprofile_stages=args.cprofile_stage,
+                  fd_cache=args.fd_cache,
+                  fd_threshold=args.fd_threshold,
+                  max_percent_scrubbed=args.max_scrubbed,
+                  nbs_threshold=args.nbs_threshold,
+                  shard=args.shard,
+                  output_format=args.output_format,
+                  robust=args.robust,
+                  combat=args.combat,
+                  combat_params=args.combat_params,
+                  contrasts=args.contrasts,
+                  extra_terms=args.extra_terms,
+                  transforms=args.transform,
+                  run_weights=args.run_weights,
+                  incremental_dir=args.incremental,
+                  incremental_check=args.incremental_check)
+        print("\n🎉 Pipeline finished! \n")
+        return
+
+    combination = combinations[0]
     run_pipeline(bids_dir=args.bids_dir, 
                  output_dir=args.output_dir, 
                  pheno_p=args.phenotype_file, 
-                 atlas_file=args.atlas_file,
-                 atlas=args.atlas, 
+                 atlas_file=combination["atlas_file"],
+                 atlas=combination["atlas"], 
                  group=args.group,
                  scanner=args.scanner,
                  sequence=args.sequence, 
                  medication=args.medication, 
                  case_name=args.case_id, 
                  control_name=args.control_id, 
-                 session=args.session,
-                 task=args.task, 
-                 run=args.run, 
-                 feature=args.feature)
+                 session=combination["session"],
+                 task=combination["task"], 
+                 run=combination["run"], 
+                 feature=combination["feature"],
+                 glm_engine=args.glm_engine,
+                 max_memory=args.max_memory,
+                 store_dir=args.connectome_store,
+                 n_jobs=args.n_jobs,
+                 bids_index_cache=args.bids_index,
+                 n_perm=args.n_perm,
+                 seed=args.seed,
+                 checkpoint=args.checkpoint,
+                 site_name=args.site_stats,
+                 dtype=args.dtype,
+                 plot_mode=args.plot_mode,
+                 cprofile_stages=args.cprofile_stage,
+                 fd_cache=args.fd_cache,
+                 fd_threshold=args.fd_threshold,
+                 max_percent_scrubbed=args.max_scrubbed,
+                 nbs_threshold=args.nbs_threshold,
+                 shard=args.shard,
+                 output_format=args.output_format,
+                 robust=args.robust,
+                 combat=args.combat,
+                 combat_params=args.combat_params,
+                 contrasts=args.contrasts,
+                 extra_terms=args.extra_terms,
+                 transforms=args.transform,
+                 run_weights=args.run_weights,
+                 incremental_dir=args.incremental,
+                 incremental_check=args.incremental_check)
     
     print("\n🎉 Pipeline finished! \n")
+
+def merge_sites_parsers():
+    parser = argparse.ArgumentParser(description="Pool the sufficient statistics exported by each site with --site_stats")
+    parser.add_argument("--site_stats", nargs="+", required=True, help="Sufficient statistics files (.npz), one per site")
+    parser.add_argument("--output_dir", required=True, help="Path to the output directory")
+    parser.add_argument("--output_format", choices=OUTPUT_FORMATS, default="tsv", help="Results as text tables and matrices (tsv), or as one compressed edge table (npz, parquet) with the ROI labels as metadata")
+    parser.add_argument("--no_site_effects", action="store_true", help="Do not add one indicator per site to the pooled design")
+    parser.add_argument("--plot_mode", choices=["auto", "full", "scalable"], default="auto", help="Interactive heatmap: full matrix, or network blocks for large atlases (auto: blocks above 200 ROIs)")
+    return parser.parse_args()
+
+def merge_sites_main():
+    print("\n🚀 Welcome to CWAS-rsfmri! \n")
+    args = merge_sites_parsers()
+
+    from cwas_rsfmri.workflow import run_merge_sites
+    run_merge_sites(site_files=args.site_stats,
+                    output_dir=args.output_dir,
+                    site_effects=not args.no_site_effects,
+                    plot_mode=args.plot_mode,
+                    output_format=args.output_format)
+
+    print("\n🎉 Pipeline finished! \n")
+
+def merge_shards_parsers():
+    parser = argparse.ArgumentParser(description="Assemble the edge shards written with --shard into one CWAS")
+    parser.add_argument("--shards", nargs="+", required=True, help="Shard files (.npz), all shards of one analysis")
+    parser.add_argument("--output_dir", required=True, help="Path to the output directory")
+    parser.add_argument("--output_format", choices=OUTPUT_FORMATS, default="tsv", help="Results as text tables and matrices (tsv), or as one compressed edge table (npz, parquet) with the ROI labels as metadata")
+    parser.add_argument("--plot_mode", choices=["auto", "full", "scalable"], default="auto", help="Interactive heatmap: full matrix, or network blocks for large atlases (auto: blocks above 200 ROIs)")
+    return parser.parse_args()
+
+def merge_shards_main():
+    print("\n🚀 Welcome to CWAS-rsfmri! \n")
+    args = merge_shards_parsers()
+
+    from cwas_rsfmri.workflow import run_merge_shards
+    run_merge_shards(shard_files=args.shards,
+                     output_dir=args.output_dir,
+                     plot_mode=args.plot_mode,
+                     output_format=args.output_format)
+
+    print("\n🎉 Pipeline finished! \n")
@@ -0,0 +1,86 @@
+import numpy as np
+import pandas as pd
+
+from .files import report_file
+
+# Weight of each run in the average connectome of a subject
+RUN_WEIGHTS = ['equal', 'volumes', 'fd']
+
+
+def run_weights(runs, weighting='equal'):
+    """
+    Weight of each run: the same for all runs, the number of volumes left after non-steady
+    states and motion scrubbing (the rows of its timeseries), or the inverse of the mean FD.
+    """
+    if weighting == 'equal':
+        weights = np.ones(len(runs))
+    elif weighting == 'volumes':
+        weights = (runs['n_volumes'] - runs['n_scrubbed'].fillna(0) - runs['n_nonsteady'].fillna(0)).to_numpy(dtype=float)
+    elif weighting == 'fd':
+        weights = 1 / runs['mean_fd'].to_numpy(dtype=float)
+    else:
+        raise ValueError(f"❌ Unknown run weighting: {weighting}. Expected one of {RUN_WEIGHTS}")
+
+    invalid = ~np.isfinite(weights) | (weights <= 0)
+    if invalid.any():
+        raise ValueError(f"❌ Runs without a valid {weighting} weight: {list(runs.index[invalid])}")
+    return weights
+
+
+def aggregate_runs(out_p, pheno, connectome_runs, fd_runs, weighting='equal', fd_threshold=0.5,
+                   max_percent_scrubbed=None):
+    """
+    Runs and sessions averaged into the connectome of each subject. Runs without confounds JSON,
+    with a mean FD at or above fd_threshold or too many scrubbed volumes are left out, then each
+    run is weighted (see run_weights). Returns the selected runs, with their weight, and the motion
+    QC table of each subject for filter_by_fd: mean FD weighted as the connectomes, total volumes.
+    The runs that went into each subject are saved in the report.
+    """
+    print(f"\n⏳ Aggregating the runs of each subject (weights: {weighting}) ...")
+
+    runs = connectome_runs[connectome_runs['participant_id'].isin(pheno['participant_id'])]
+    runs = runs.join(fd_runs.reindex(columns=['mean_fd', 'n_scrubbed', 'n_nonsteady', 'n_volumes', 'percent_scrubbed']))
+
+    keep = runs['mean_fd'] < fd_threshold
+    if max_percent_scrubbed is not None:
+        keep &= ~(runs['percent_scrubbed'] > max_percent_scrubbed)
+    rejected = runs.index[~keep]
+    runs = runs[keep].copy()
+    runs['weight'] = run_weights(runs, weighting)
+
+    # Motion of the averaged connectome, for the FD filter and the regressors
+    weighted_fd = (runs['mean_fd'] * runs['weight']).groupby(runs['participant_id'], sort=False).sum()
+    totals = runs.groupby('participant_id', sort=False)[['weight', 'n_scrubbed', 'n_volumes']].sum(min_count=1)
+    fd_table = pd.DataFrame({
+        'mean_fd': weighted_fd / totals['weight'],
+        'n_scrubbed': totals['n_scrubbed'],
+        'n_volumes': totals['n_volumes'],
+    })
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fd_table['percent_scrubbed'] = 100 * fd_table['n_scrubbed'] / fd_table['n_volumes']
+
+    # Runs of each subject, without the participant prefix, with their share of the average
+    share = runs['weight'] / runs.groupby('participant_id', sort=False)['weight'].transform('sum')
+    runs_per_subject = {}
+    for label, participant_id, value in zip(runs.index, runs['participant_id'], share):
+        runs_per_subject.setdefault(participant_id, {})[label[len(participant_id) + 1:] or label] = round(float(value), 4)
+    n_runs = fd_table.index.map(lambda sub: len(runs_per_subject[sub]))
+
+    summary_data = {
+        "Run weighting": weighting,
+        "N runs found": int(len(rejected) + len(runs)),
+        f"N runs rejected (no confounds JSON, mean FD>={fd_threshold} or scrubbing)": int(len(rejected)),
+        "Rejected runs": sorted(rejected),
+        "N Subjects with several runs": int((n_runs > 1).sum()),
+        "Runs per subject": runs_per_subject,
+    }
+    report_file(out_p, summary_data)
+
+    print("\n=== Summary run aggregation ===")
+    for key, value in summary_data.items():
+        if isinstance(value, (list, dict)):
+            print(f"{key}: {len(value)}")
+        else:
+            print(f"{key}: {value}")
+
+    return runs, fd_table
@@ -0,0 +1,67 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+
+from .permutation import fwer_pvalues
+
+# Arrays saved in a shard file, on top of the JSON metadata
+SHARD_COLUMNS = ['betas', 'stand_betas', 'pvals']
+# Metadata that must be the same in every shard of an analysis
+SHARD_KEYS = ['count', 'n_edges', 'group', 'case_name', 'control_name', 'atlas', 'feature', 'roi_labels',
+              'n_perm', 'seed', 'robust', 'combat']
+
+
+def shard_edges(n_edges, index, count):
+    """
+    First and last (excluded) edge of the index-th of count slices of the edges (index from 1).
+    """
+    return n_edges * (index - 1) // count, n_edges * index // count
+
+
+def save_shard(path, table, null_dist, metadata):
+    """
+    Write the GLM table of a slice of the edges, with the permutation null when there is one.
+    """
+    arrays = {name: table[name].to_numpy() for name in SHARD_COLUMNS}
+    if null_dist:
+        arrays.update(null_max=null_dist['max_stat'], observed=null_dist['observed'])
+    np.savez(path, metadata=np.array(json.dumps(metadata)), **arrays)
+    print(f"✅ Shard {metadata['index']}/{metadata['count']} saved in: {path}")
+
+
+def load_shard(path):
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"❌ Missing shard file: {path}")
+    with np.load(path, allow_pickle=False) as f:
+        metadata = json.loads(str(f['metadata']))
+        arrays = {name: f[name] for name in f.files if name != 'metadata'}
+    return arrays, metadata
+
+
+def merge_shards(shards, shard_metadata):
+    """
+    GLM table over all edges from the shards of one analysis.
+    Shards must all be there; FWER p-values use the max statistic over the shards,
+    which share their permutations through the seed.
+    """
+    reference = shard_metadata[0]
+    for metadata in shard_metadata[1:]:
+        for name in SHARD_KEYS:
+            if metadata[name] != reference[name]:
+                raise ValueError(f"❌ Shards {reference['index']} and {metadata['index']} differ in {name}")
+
+    indices = sorted(metadata['index'] for metadata in shard_metadata)
+    if indices != list(range(1, reference['count'] + 1)):
+        raise ValueError(f"❌ Expected shards 1 to {reference['count']}, got {indices}")
+
+    order = np.argsort([metadata['index'] for metadata in shard_metadata])
+    shards = [shards[i] for i in order]
+    table = pd.DataFrame({name: np.concatenate([shard[name] for shard in shards]) for name in SHARD_COLUMNS})
+    if len(table) != reference['n_edges']:
+        raise ValueError(f"❌ Shards hold {len(table)} edges, expected {reference['n_edges']}")
+
+    if reference['n_perm']:
+        null_max = np.max([shard['null_max'] for shard in shards], axis=0)
+        table['pvals_fwer'] = fwer_pvalues(np.concatenate([shard['observed'] for shard in shards]), null_max)
+    return table
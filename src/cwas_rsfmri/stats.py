@@ -1,13 +1,16 @@
 import os
+import re
 import json
+import hashlib
 import numpy as np
 import patsy as pat
 import pandas as pd
-import statsmodels.api as sm
-from sklearn import preprocessing as skp
-from statsmodels.sandbox.stats.multicomp import multipletests as stm
 
 from .connectome import conn2mat
+from .linear_model import factorize_design, fit_glm, fit_contrasts
+from .permutation import (freedman_lane_permutations, max_stat_collector, fwer_pvalues,
+                          supra_threshold_collector, nbs_null, nbs_components)
+from .triangle import as_triangle
 from .subject import find_subset
 from .files import report_file
 
@@ -30,24 +33,116 @@ def define_regressors(scanner, sequence_col, medication_col):
 
 def save_glm(out_p, table_con, table_stand_beta_con, 
              table_qval_con, conn_mask, roi_labels,
-             case_name, control_name, feature, atlas):
-    
-    out_table = table_con.copy()
-
-    (fdr_pass, qval, _, _) = stm(table_con.pvals, alpha=0.05, method='fdr_bh')
-    out_table['qval'] = qval
-    
-    # Save results
-    base_filename = f'cwas_{case_name}_{control_name}_rsfmri_{feature}_{atlas}'
-    table_con.to_csv(os.path.join(out_p, f'{base_filename}.tsv'), sep='\t')
-    table_stand_beta_con.to_csv(os.path.join(out_p, f'{base_filename}_standardized_betas.tsv'), sep='\t')
-    table_qval_con.to_csv(os.path.join(out_p, f'{base_filename}_fdr_corrected_pvalues.tsv'), sep='\t')
+             case_name, control_name, feature, atlas, output_format='tsv', suffix=''):
+    """
+    Save the results and return the path of the edge table. 'tsv' writes the edge table and
+    labelled N x N matrices as text; 'npz' and 'parquet' write the edge table only, compressed,
+    with the ROI labels stored once. Significant edges are always listed in a small TSV.
+    suffix tells apart the tables of other contrasts.
+    """
+    base_filename = f'cwas_{case_name}_{control_name}_rsfmri_{feature}_{atlas}{suffix}'
+    if output_format == 'tsv':
+        results_path = os.path.join(out_p, f'{base_filename}.tsv')
+        table_con.to_csv(results_path, sep='\t')
+        table_stand_beta_con.to_csv(os.path.join(out_p, f'{base_filename}_standardized_betas.tsv'), sep='\t')
+        table_qval_con.to_csv(os.path.join(out_p, f'{base_filename}_fdr_corrected_pvalues.tsv'), sep='\t')
+        if 'pvals_fwer' in table_con:
+            table_fwer_con = pd.DataFrame(conn2mat(table_con.pvals_fwer.values, conn_mask), index=roi_labels, columns=roi_labels)
+            table_fwer_con.to_csv(os.path.join(out_p, f'{base_filename}_fwer_corrected_pvalues.tsv'), sep='\t')
+        if 'pvals_nbs' in table_con:
+            table_nbs_con = pd.DataFrame(conn2mat(table_con.pvals_nbs.values, conn_mask), index=roi_labels, columns=roi_labels)
+            table_nbs_con.to_csv(os.path.join(out_p, f'{base_filename}_nbs_corrected_pvalues.tsv'), sep='\t')
+    else:
+        metadata = {'roi_labels': list(map(str, roi_labels)), 'case_name': case_name, 'control_name': control_name,
+                    'feature': feature, 'atlas': atlas}
+        results_path = os.path.join(out_p, f'{base_filename}.{output_format}')
+        if output_format == 'npz':
+            np.savez_compressed(results_path, metadata=np.array(json.dumps(metadata)),
+                                **{col: table_con[col].to_numpy() for col in table_con.columns})
+        else:
+            # Parquet keeps the attrs of the frame in its metadata
+            table_out = table_con.copy(deep=False)
+            table_out.attrs = {'cwas': json.dumps(metadata)}
+            table_out.to_parquet(results_path, compression='zstd')
+    if 'pvals_nbs' in table_con:
+        nbs_component_table(table_con, conn_mask, roi_labels) \
+            .to_csv(os.path.join(out_p, f'{base_filename}_nbs_components.tsv'), sep='\t', index=False)
+    significant_edges(table_con, conn_mask, roi_labels) \
+        .to_csv(os.path.join(out_p, f'{base_filename}_significant_edges.tsv'), sep='\t', index=False)
     
     print(f"\n✅ Completed processing for feature: {feature}")
-    print(f"✅ Results saved to: {os.path.join(out_p, f'{base_filename}.tsv')}")
-    
+    print(f"✅ Results saved to: {results_path}")
+    return results_path
+
+
+def read_results(path):
+    """
+    Edge table and metadata (ROI labels ...) of results saved as npz or parquet.
+    """
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"❌ Missing results file: {path}")
+    if path.endswith('.npz'):
+        with np.load(path, allow_pickle=False) as f:
+            metadata = json.loads(str(f['metadata']))
+            table = pd.DataFrame({name: f[name] for name in f.files if name != 'metadata'})
+    elif path.endswith('.parquet'):
+        table = pd.read_parquet(path)
+        metadata = json.loads(table.attrs['cwas'])
+    else:
+        raise ValueError(f"❌ Unsupported results file: {path}. Expected .npz or .parquet")
+    return table, metadata
+
+
+def corrected_pvalues(table_con):
+    """
+    Corrected p-values that mark the significant edges of the plots, and the name of the
+    correction: NBS or FWER when they were computed, FDR q-values otherwise.
+    """
+    for col, correction in [('pvals_nbs', 'NBS'), ('pvals_fwer', 'FWER')]:
+        if col in table_con:
+            return table_con[col].values, correction
+    return table_con.qval.values, 'FDR'
+
+
+def significant_edges(table_con, conn_mask, roi_labels, alpha=0.05):
+    """
+    Edges significant after FDR, FWER or NBS correction, sorted by absolute standardized effect.
+    """
+    triangle = as_triangle(conn_mask)
+    significant = table_con.qval < alpha
+    for col in ['pvals_fwer', 'pvals_nbs']:
+        if col in table_con:
+            significant |= table_con[col] < alpha
+    edges = table_con.loc[significant]
+    edges = edges.iloc[np.argsort(-np.abs(edges.stand_betas.values), kind='stable')]
+
+    roi_labels = np.asarray(roi_labels, dtype=object)
+    return pd.concat([pd.DataFrame({'edge': edges.index,
+                                    'roi_1': roi_labels[triangle.rows[edges.index]],
+                                    'roi_2': roi_labels[triangle.cols[edges.index]]}),
+                      edges.reset_index(drop=True)], axis=1)
+
+
+def nbs_component_table(table_con, conn_mask, roi_labels):
+    """
+    One row per NBS component: direction of the effect, size, ROIs and corrected p-value.
+    """
+    triangle = as_triangle(conn_mask)
+    roi_labels = np.asarray(roi_labels, dtype=object)
+    rows = []
+    for component, edges in table_con.loc[table_con.nbs_component > 0].groupby('nbs_component'):
+        rois = np.union1d(triangle.rows[edges.index], triangle.cols[edges.index])
+        rows.append({'component': component,
+                     'direction': 'positive' if edges.stand_betas.iloc[0] > 0 else 'negative',
+                     'n_edges': len(edges),
+                     'n_rois': len(rois),
+                     'pval': edges.pvals_nbs.iloc[0],
+                     'rois': ','.join(map(str, roi_labels[rois]))})
+    return pd.DataFrame(rows, columns=['component', 'direction', 'n_edges', 'n_rois', 'pval', 'rois'])
+
 
 def summarize_glm(glm_table, conn_mask, roi_labels):
+    from statsmodels.sandbox.stats.multicomp import multipletests as stm
     out_table = glm_table.copy()
     (fdr_pass, qval, _, _) = stm(glm_table.pvals, alpha=0.05, method='fdr_bh')
     out_table['qval'] = qval
@@ -60,12 +155,24 @@ def summarize_glm(glm_table, conn_mask, roi_labels):
 
 
 def standardize(data, mask):
+    from sklearn import preprocessing as skp
     scaler = skp.StandardScaler(with_mean=False, with_std=True)
     scaler.fit(data[mask, :])
     standardized_data = scaler.transform(data)
     return standardized_data
 
 
+def edge_block_size(n_sub, n_data, max_memory=None):
+    """
+    Number of edges fitted together so that a block stays within max_memory bytes.
+    """
+    if max_memory is None:
+        return max(n_data, 1)
+    # Raw, standardized, residual and estimate arrays are alive at the same time
+    n_copies = 6
+    return int(min(max(max_memory // (n_sub * 8 * n_copies), 1), max(n_data, 1)))
+
+
 def find_contrast(design_matrix, contrast):
     # Find the contrast column
     contrast_columns = [(col_id, col) for col_id, col in enumerate(design_matrix.columns) if f'{contrast}' in col]
@@ -74,7 +181,8 @@ def find_contrast(design_matrix, contrast):
     return contrast_columns
 
 
-def glm(data, design_matrix, contrast):
+def glm(data, design_matrix, contrast, robust=None):
+    import statsmodels.api as sm
     contrast_id, _ = find_contrast(design_matrix, contrast)[0]
     n_data = data.shape[1]
 
@@ -82,26 +190,172 @@ def glm(data, design_matrix, contrast):
     betas = np.zeros(shape=n_data)
     pvals = np.zeros(shape=n_data)
     for conn_id in range(n_data):
-        model = sm.OLS(data[:, conn_id], design_matrix)
-        results = model.fit()
+        if robust == 'huber':
+            results = sm.RLM(data[:, conn_id], design_matrix, M=sm.robust.norms.HuberT()).fit()
+        else:
+            results = sm.OLS(data[:, conn_id], design_matrix).fit(cov_type=robust or 'nonrobust')
         betas[conn_id] = results.params.iloc[contrast_id]
         pvals[conn_id] = results.pvalues.iloc[contrast_id]
 
     return betas, pvals
 
-def glm_wrap_cc(out_p, conn, pheno, group, case, control, regressors='', report=False):
+
+def glm_vectorized(data, design_matrix, contrast, factor=None, robust=None):
+    contrast_id, _ = find_contrast(design_matrix, contrast)[0]
+
+    # Conduct the GLM for all edges at once
+    if factor is None:
+        factor = factorize_design(design_matrix)
+    results = fit_glm(data, factor, robust=robust)
+
+    return results['betas'][contrast_id], results['pvals'][contrast_id]
+
+
+def term_name(term):
+    """
+    Short name of a design term: variables without the C() coding, joined by ':' for interactions.
+    """
+    names = []
+    for factor in term.factors:
+        coded = re.match(r'C\((\w+)', factor.name())
+        names.append(coded.group(1) if coded else factor.name())
+    return ':'.join(names)
+
+
+def contrast_matrix(dmat, spec):
+    """
+    Contrast (L, c) testing L b = c on the columns of dmat. spec is a vector or matrix over the
+    columns, a term of the design (e.g. 'age', 'sex', 'diagnosis:age', all its columns are tested
+    together) or a patsy linear constraint (e.g. 'age - mean_fd', 'C(sex)[T.1] = 0.5').
+    """
+    n_col = dmat.shape[1]
+    if not isinstance(spec, str):
+        coefs = np.atleast_2d(np.asarray(spec, dtype=np.float64))
+        if coefs.shape[1] != n_col:
+            raise ValueError(f'❌ Contrast {spec} has {coefs.shape[1]} weights, the design has {n_col} columns: {list(dmat.columns)}')
+        return coefs, np.zeros(coefs.shape[0])
+
+    design_info = dmat.design_info
+    for term in design_info.terms:
+        if spec in (term.name(), term_name(term)):
+            columns = np.arange(n_col)[design_info.term_slices[term]]
+            return np.eye(n_col)[columns], np.zeros(len(columns))
+    try:
+        constraint = design_info.linear_constraint(spec)
+    except Exception as e:
+        raise ValueError(f'❌ Invalid contrast {spec}: {e}. Design columns: {list(dmat.columns)}')
+    return constraint.coefs, constraint.constants[:, 0]
+
+
+def cached_factorization(dmat, design_cache=None):
+    """
+    factorize_design of dmat, kept in design_cache (a dict) so that analyses with the
+    same design (e.g. other atlases) share one factorization.
+    """
+    design_key = (tuple(dmat.columns), hashlib.sha1(np.ascontiguousarray(dmat.values).tobytes()).hexdigest())
+    if design_cache is not None and design_key in design_cache:
+        return design_cache[design_key]
+    factor = factorize_design(dmat)
+    if design_cache is not None:
+        design_cache[design_key] = factor
+    return factor
+
+
+def glm_contrasts(out_p, conn, pheno, group, case, control, contrasts, regressors='', extra_terms='',
+                  report=False, max_memory=None, design_cache=None):
+    """
+    t- and F-tests of several contrasts (name -> spec, see contrast_matrix) in one pass over the
+    edges, sharing the factorization of the design. extra_terms (e.g. 'C(diagnosis):age') are
+    added to the regressors of the design. Returns one edge table per contrast: contrast estimate
+    (betas), estimate in control SD units (stand_betas) and t for t-tests; F and the partial R2
+    (as stand_betas) for F-tests.
+    """
+    regressors = ' + '.join(term for term in (regressors, extra_terms) if term)
+    sub_mask, case_masks, dmat = build_design(pheno, group, case, control, regressors)
+    matrices = {name: contrast_matrix(dmat, spec) for name, spec in contrasts.items()}
+    n_sub = np.sum(sub_mask)
+    n_data = conn.shape[1]
+
+    factor = cached_factorization(dmat, design_cache)
+
+    if report:
+        summary_data = {'contrasts design': ' + '.join(dmat.design_info.term_names)}
+        for name, (coefs, _) in matrices.items():
+            kind = 't-test' if coefs.shape[0] == 1 else f'F-test ({coefs.shape[0]} rows)'
+            columns = [col for col, weight in zip(dmat.columns, np.abs(coefs).sum(axis=0)) if weight]
+            summary_data[f'contrast {name}'] = f'{kind} of {contrasts[name]} on {columns}'
+        report_file(out_p, summary_data)
+        print(f'\n⏳ Testing {len(contrasts)} contrasts on {n_data} edges ...')
+
+    tables = {name: {} for name in contrasts}
+    block_size = edge_block_size(n_sub, n_data, max_memory)
+    for start in range(0, n_data, block_size):
+        stop = min(start + block_size, n_data)
+        sub_conn = np.asarray(conn[sub_mask, start:stop], dtype=np.float64)
+        # Standardized estimates are the estimates over the SD of the controls, as in glm_wrap_cc
+        control_sd = sub_conn[case_masks[control]].std(axis=0)
+        control_sd[control_sd == 0] = 1
+
+        for name, results in fit_contrasts(sub_conn, factor, matrices).items():
+            n_rows, df_resid = results['df']
+            if n_rows == 1:
+                block = {'betas': results['effect'][0], 'stand_betas': results['effect'][0] / control_sd,
+                         'tvals': results['stat']}
+            else:
+                block = {'fvals': results['stat'],
+                         'stand_betas': n_rows * results['stat'] / (n_rows * results['stat'] + df_resid)}
+            block['pvals'] = results['pvals']
+            for col, values in block.items():
+                tables[name].setdefault(col, []).append(values)
+
+    return {name: pd.DataFrame({col: np.concatenate(values) for col, values in columns.items()})
+            for name, columns in tables.items()}
+
+
+def build_design(pheno, group, case, control, regressors=''):
+    """
+    Subjects of the case and control groups and their design matrix.
+    """
+    sub_mask, case_masks = find_subset(pheno, group, [case, control])
+    sub_pheno = pheno.loc[sub_mask]
+    # Categories without subjects in the subset would give empty design columns
+    sub_pheno = sub_pheno.apply(lambda col: col.cat.remove_unused_categories()
+                                if isinstance(col.dtype, pd.CategoricalDtype) else col)
+
+    # Construct design matrix
+    if type(control) == str:
+        contrast = f'C({group}, Treatment("{control}"))'
+    else:
+        contrast = f'C({group}, Treatment({control}))'
+        
+    formula = ' + '.join((regressors, contrast))
+    dmat = pat.dmatrix(formula, sub_pheno, return_type='dataframe')
+
+    return sub_mask, case_masks, dmat
+
+
+def glm_wrap_cc(out_p, conn, pheno, group, case, control, regressors='', report=False, engine='vectorized',
+                max_memory=None, n_perm=0, seed=None, n_jobs=1, design_cache=None, nbs_threshold=None,
+                conn_mask=None, null_dist=None, robust=None):
     # Make sure pheno and conn have the same number of cases
     if not conn.shape[0] == pheno.shape[0]:
         print(f'❌ Connectivity matrix ({conn.shape[0]}) and phenotype file ({pheno.shape[0]}) must be same number of cases')
 
-    # Define the subset of the sample
-    sub_mask, case_masks = find_subset(pheno, group, [case, control])
-    sub_conn = conn[sub_mask, :]
-    sub_pheno = pheno.loc[sub_mask]
+    # Define the subset of the sample and its design matrix
+    sub_mask, case_masks, dmat = build_design(pheno, group, case, control, regressors)
     n_sub = np.sum(sub_mask)
     n_case = np.sum(case_masks[case])
     n_control = np.sum(case_masks[control])
-    n_data = sub_conn.shape[1]
+    n_data = conn.shape[1]
+
+    if nbs_threshold is not None and (not n_perm or conn_mask is None):
+        raise ValueError('❌ The network-based statistic needs permutations (n_perm) and the connectome mask')
+    if robust is not None and n_perm:
+        raise ValueError('❌ Permutations use OLS t-statistics and cannot be combined with robust estimation')
+
+    # Keep track of the seed so that permutations can be reproduced
+    if n_perm and seed is None:
+        seed = int(np.random.SeedSequence().entropy % 2 ** 32)
     
     if report:
         summary_data = {
@@ -113,6 +367,13 @@ def glm_wrap_cc(out_p, conn, pheno, group, case, control, regressors='', report=
               f'data points available': f'{n_data}',
               f'standardized estimators are based on {group}': f'{control}'
               }
+        if robust is not None:
+            summary_data['robust estimation'] = ('Huber M-estimator (IRLS, t=1.345, MAD scale)' if robust == 'huber'
+                                                 else f'OLS with {robust} standard errors')
+        if n_perm:
+            summary_data['FWER correction'] = f'Freedman-Lane max-statistic, {n_perm} permutations, seed={seed}'
+        if nbs_threshold is not None:
+            summary_data['NBS'] = f'components of edges with |t| > {nbs_threshold}, same permutations'
         report_file(out_p, summary_data)
 
         print(f'\n⏳ Performing CWAS. This might take few minutes.\n')
@@ -122,20 +383,60 @@ def glm_wrap_cc(out_p, conn, pheno, group, case, control, regressors='', report=
             else:
                 print(f"{key}: {value}")
         
-    # Standardize the connectivity matrix
-    stand_conn = standardize(sub_conn, case_masks[control])
+    if engine not in ('vectorized', 'statsmodels'):
+        raise ValueError(f'❌ Unknown GLM engine: {engine}. Expected "vectorized" or "statsmodels"')
+    factor = None
+    if engine == 'vectorized':
+        factor = cached_factorization(dmat, design_cache)
 
-    # Construct design matrix
-    if type(control) == str:
-        contrast = f'C({group}, Treatment("{control}"))'
-    else:
-        contrast = f'C({group}, Treatment({control}))'
-        
-    formula = ' + '.join((regressors, contrast))
-    dmat = pat.dmatrix(formula, sub_pheno, return_type='dataframe')
+    # Fit the edges block by block to stay within the memory budget
+    betas = np.zeros(shape=n_data)
+    stand_betas = np.zeros(shape=n_data)
+    pvals = np.zeros(shape=n_data)
+    block_size = edge_block_size(n_sub, n_data, max_memory)
+    for start in range(0, n_data, block_size):
+        stop = min(start + block_size, n_data)
+        sub_conn = np.asarray(conn[sub_mask, start:stop], dtype=np.float64)
+
+        # Standardize the connectivity matrix
+        stand_conn = standardize(sub_conn, case_masks[control])
+
+        if engine == 'vectorized':
+            betas[start:stop], pvals[start:stop] = glm_vectorized(sub_conn, dmat, group, factor=factor, robust=robust)
+            stand_betas[start:stop], _ = glm_vectorized(stand_conn, dmat, group, factor=factor, robust=robust)
+        else:
+            betas[start:stop], pvals[start:stop] = glm(sub_conn, dmat, group, robust=robust)
+            stand_betas[start:stop], _ = glm(stand_conn, dmat, group, robust=robust)
 
-    betas, pvals = glm(sub_conn, dmat, group)
-    stand_betas, _ = glm(stand_conn, dmat, group)
     table = pd.DataFrame(data={'betas': betas, 'stand_betas': stand_betas, 'pvals': pvals})
 
-    return table
\ No newline at end of file
+    # Family-wise error control with permutations, on the same edge blocks
+    if n_perm:
+        contrast_id, _ = find_contrast(dmat, group)[0]
+        print(f'\n⏳ Running {n_perm} permutations for FWER correction (seed={seed}) ...')
+        # Each thread holds a batch of 100 permuted projections per edge on top of the data
+        perm_block_size = edge_block_size(n_sub + n_jobs * 100 * (dmat.shape[1] + 2), n_data, max_memory)
+        data_blocks = (np.asarray(conn[sub_mask, start:start + perm_block_size], dtype=np.float64)
+                       for start in range(0, n_data, perm_block_size))
+
+        # The NBS reuses the permutations of the max statistic
+        null_max, collect_max = max_stat_collector(n_perm)
+        collectors = [collect_max]
+        if nbs_threshold is not None:
+            supra_edges, collect_supra = supra_threshold_collector(n_perm, nbs_threshold)
+            collectors.append(collect_supra)
+        observed = freedman_lane_permutations(data_blocks, dmat, contrast_id, n_perm, collectors,
+                                              seed=seed, n_jobs=n_jobs)
+        table['pvals_fwer'] = fwer_pvalues(np.abs(observed), null_max)
+        if null_dist is not None:
+            # Kept to correct over the edges of other shards
+            null_dist.update(max_stat=null_max, observed=np.abs(observed))
+
+        if nbs_threshold is not None:
+            triangle = as_triangle(conn_mask)
+            null_sizes = nbs_null(supra_edges, triangle, n_jobs=n_jobs)
+            table['nbs_component'], table['pvals_nbs'] = nbs_components(observed, nbs_threshold, triangle, null_sizes)
+            n_significant = len(np.unique(table.loc[table.pvals_nbs < 0.05, 'nbs_component']))
+            print(f'📌 NBS: {table.nbs_component.max()} components, {n_significant} with p < 0.05')
+
+    return table
@@ -0,0 +1,133 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+
+
+def store_key(session, task, run, atlas, feature, dtype=None):
+    """
+    Name of the store entry for one session, task, run, atlas and feature.
+    A dtype other than float64 is added as a suffix (e.g. _float32) so that each precision keeps its own entry.
+    """
+    key = f"ses-{session}_task-{task}_run-{run}_seg-{atlas}_desc-{feature}"
+    if dtype is not None and np.dtype(dtype) != np.float64:
+        key += f"_{np.dtype(dtype).name}"
+    return key
+
+
+def store_paths(store_dir, key):
+    return {
+        "data": os.path.join(store_dir, f"{key}_relmat.dat"),
+        "subjects": os.path.join(store_dir, f"{key}_subjects.tsv"),
+        "manifest": os.path.join(store_dir, f"{key}_manifest.json"),
+    }
+
+
+def source_stat(path):
+    stat = os.stat(path)
+    return {"path": os.path.abspath(path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def read_store_manifest(store_dir, key):
+    manifest_path = store_paths(store_dir, key)["manifest"]
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+
+def open_connectome_store(store_dir, key, mode='r'):
+    """
+    Open the packed connectomes of a store entry as a memory-map (no copy).
+    """
+    manifest = read_store_manifest(store_dir, key)
+    if manifest is None:
+        raise FileNotFoundError(f"❌ No connectome store for {key} in {store_dir}")
+
+    n_sub = len(manifest["subjects"])
+    if n_sub == 0:
+        return np.zeros((0, manifest["n_edges"]), dtype=manifest["dtype"]), manifest
+    data = np.memmap(store_paths(store_dir, key)["data"], mode=mode,
+                     dtype=manifest["dtype"], shape=(n_sub, manifest["n_edges"]))
+    return data, manifest
+
+
+def write_store_manifest(store_dir, key, manifest):
+    paths = store_paths(store_dir, key)
+    pd.DataFrame({
+        "participant_id": manifest["subjects"],
+        "row": np.arange(len(manifest["subjects"])),
+        "path": [manifest["sources"][sub]["path"] for sub in manifest["subjects"]],
+    }).to_csv(paths["subjects"], sep='\t', index=False)
+
+    # Write the manifest last: it is what marks the store as complete
+    tmp_path = paths["manifest"] + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(tmp_path, paths["manifest"])
+
+
+def update_connectome_store(store_dir, key, subjects, connectome_paths, conn_mask, dtype=np.float64, n_jobs=1):
+    """
+    Bring a store entry up to date with the given subjects and relmat files.
+    Only new subjects and subjects whose file size or mtime changed are parsed.
+    Returns the memory-mapped store and the row of each requested subject.
+    """
+    from .connectome import load_connectomes
+    from .triangle import as_triangle
+
+    os.makedirs(store_dir, exist_ok=True)
+    paths = store_paths(store_dir, key)
+    n_edges = as_triangle(conn_mask).n_edges
+    dtype = np.dtype(dtype)
+
+    manifest = read_store_manifest(store_dir, key)
+    data_path = paths["data"]
+    new_entry = manifest is None or manifest["n_edges"] != n_edges or manifest["dtype"] != dtype.name
+    if new_entry:
+        # Start a new store entry in a temporary file: the previous one stays valid until it is replaced
+        manifest = {"key": key, "n_edges": n_edges, "dtype": dtype.name, "subjects": [], "sources": {}}
+        data_path = paths["data"] + ".tmp"
+        open(data_path, 'wb').close()
+
+    rows = {sub: row for row, sub in enumerate(manifest["subjects"])}
+    changed, added = [], []
+    for sub, path in zip(subjects, connectome_paths):
+        stat = source_stat(path)
+        if sub not in rows:
+            added.append((sub, path, stat))
+        elif manifest["sources"][sub] != stat:
+            changed.append((sub, path, stat))
+
+    # Append new subjects at the end, dropping rows left by an interrupted update
+    for sub, path, stat in added:
+        rows[sub] = len(manifest["subjects"])
+        manifest["subjects"].append(sub)
+    if added:
+        with open(data_path, 'r+b') as f:
+            f.truncate(len(manifest["subjects"]) * n_edges * dtype.itemsize)
+
+    # Parse new subjects and rewrite the rows of changed subjects in place
+    to_read = changed + added
+    if to_read:
+        data = np.memmap(data_path, mode='r+', dtype=dtype, shape=(len(manifest["subjects"]), n_edges))
+        load_connectomes([path for _, path, _ in to_read], conn_mask, data,
+                         rows=[rows[sub] for sub, _, _ in to_read], n_jobs=n_jobs)
+        data.flush()
+        del data
+        for sub, _, stat in to_read:
+            manifest["sources"][sub] = stat
+
+    if new_entry:
+        # Without a manifest the entry is rebuilt, so the data is never read with the manifest of another
+        if os.path.exists(paths["manifest"]):
+            os.remove(paths["manifest"])
+        os.replace(data_path, paths["data"])
+    if new_entry or changed or added or not os.path.exists(paths["subjects"]):
+        write_store_manifest(store_dir, key, manifest)
+
+    print(f"📦 Connectome store {key}: {len(added)} added, {len(changed)} updated, "
+          f"{len(subjects) - len(added) - len(changed)} reused")
+
+    data, _ = open_connectome_store(store_dir, key)
+    return data, np.array([rows[sub] for sub in subjects], dtype=int)
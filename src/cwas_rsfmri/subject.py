@@ -1,10 +1,13 @@
 import os
+import glob
 import json
 import warnings
 from tqdm import tqdm
 import numpy as np
 
-def find_valid_subjects(bids_dir, pheno, session, connectome_t, run, task, atlas, feature, out_p):    
+from .bids_index import find_connectome_files, AGGREGATE_LABEL
+
+def find_valid_subjects(bids_dir, pheno, session, connectome_t, run, task, atlas, feature, out_p, bids_index=None):    
     print("⏳ Identify subjects connectivity matrix ...")
     print("This will take a moment, please do not interupt the process ...\n")
     
@@ -14,13 +17,28 @@ def find_valid_subjects(bids_dir, pheno, session, connectome_t, run, task, atlas
     # Find subjects processed by HALFpipe
     processed_subjects = set()
 
-    for _, row in tqdm(pheno.iterrows()):
-        file_path = os.path.join(bids_dir, connectome_t.format(row['participant_id'], session, 
-                                                               row['participant_id'], session, 
-                                                               task, run, atlas, feature)
-                                                                )
-        if os.path.exists(file_path):
-            processed_subjects.add(row['participant_id'])
+    if bids_index is not None:
+        processed_subjects = set(find_connectome_files(bids_index, all_subjects, session, task, run, atlas, feature).index)
+    else:
+        aggregate = AGGREGATE_LABEL in (session, run)
+        for _, row in tqdm(pheno.iterrows()):
+            if aggregate:
+                # Any session or run label when they are aggregated, the rest of the path as it is
+                ses_label, run_label = ['*' if label == AGGREGATE_LABEL else glob.escape(label) for label in (session, run)]
+                sub, task_label, atlas_label, feature_label = [glob.escape(str(label)) for label in
+                                                               (row['participant_id'], task, atlas, feature)]
+                file_path = os.path.join(glob.escape(str(bids_dir)),
+                                         connectome_t.format(sub, ses_label, sub, ses_label,
+                                                             task_label, run_label, atlas_label, feature_label))
+                found = bool(glob.glob(file_path))
+            else:
+                file_path = os.path.join(bids_dir, connectome_t.format(row['participant_id'], session, 
+                                                                       row['participant_id'], session, 
+                                                                       task, run, atlas, feature)
+                                                                        )
+                found = os.path.exists(file_path)
+            if found:
+                processed_subjects.add(row['participant_id'])
         
     # Find unprocessed subjects
     unprocessed_subjects = all_subjects - processed_subjects
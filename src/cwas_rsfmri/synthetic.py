@@ -0,0 +1,148 @@
+import os
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from .triangle import ConnectomeTriangle
+
+NETWORKS = ['Vis', 'SomMot', 'DorsAttn', 'SalVentAttn', 'Limbic', 'Cont', 'Default']
+
+
+def synthetic_atlas(n_rois):
+    """
+    Schaefer-style labels: ROIs split in two hemispheres and 7 networks.
+    """
+    networks = [NETWORKS[i * len(NETWORKS) // max(n_rois // 2, 1) % len(NETWORKS)] for i in range(n_rois)]
+    hemispheres = ['LH' if i < n_rois // 2 else 'RH' for i in range(n_rois)]
+    labels = [f'7Networks_{hemi}_{net}_{i + 1}' for i, (hemi, net) in enumerate(zip(hemispheres, networks))]
+    return labels, networks
+
+
+def base_connectome(networks, rng):
+    """
+    Mean connectome with stronger connectivity within networks than between them.
+    """
+    networks = np.asarray(networks)
+    same = networks[:, None] == networks[None, :]
+    base = np.where(same, 0.4, 0.1) + rng.normal(scale=0.05, size=same.shape)
+    return (base + base.T) / 2
+
+
+def write_subject(bids_dir, sub, names, n_rois, mean, planted, effect, noise, mean_fd, seed):
+    """
+    Write the relmat TSV, the timeseries TSV and its confounds JSON of one subject.
+    """
+    triangle = ConnectomeTriangle(n_rois)
+    rng = np.random.default_rng(seed)
+    packed = mean + rng.normal(scale=noise, size=len(mean)) + effect * planted
+    connectome = np.clip(triangle.unpack(packed), -0.99, 0.99)
+    np.fill_diagonal(connectome, 1)
+
+    func_dir = os.path.join(bids_dir, sub, f"ses-{names['session']}", 'func')
+    os.makedirs(func_dir, exist_ok=True)
+    prefix = f"{sub}_ses-{names['session']}_task-{names['task']}_run-{names['run']}"
+    relmat = f"{prefix}_seg-{names['atlas']}_meas-PearsonCorrelation_desc-{names['feature']}_relmat.tsv"
+    pd.DataFrame(connectome).to_csv(os.path.join(func_dir, relmat), sep='\t', float_format='%.4f', index=False)
+
+    # Timeseries of the 300 acquired volumes left after non-steady states and scrubbing, and its sidecar JSON
+    n_scrubbed = int(rng.integers(0, 60))
+    timeseries = rng.normal(size=(300 - 1 - n_scrubbed, n_rois))
+    pd.DataFrame(timeseries).to_csv(os.path.join(func_dir, f"{prefix}_desc-{names['feature']}_timeseries.tsv"),
+                                    sep='\t', float_format='%.3f', header=False, index=False)
+    with open(os.path.join(func_dir, f"{prefix}_desc-{names['feature']}_timeseries.json"), 'w') as f:
+        json.dump({
+            "ConfoundRegressors": ["cosine00", "rot_x", "rot_y", "rot_z"],
+            "NumberOfVolumesDiscardedByMotionScrubbing": n_scrubbed,
+            "NumberOfVolumesDiscardedByNonsteadyStatesDetector": 1,
+            "MeanFramewiseDisplacement": mean_fd,
+            "SamplingFrequency": 0.5
+        }, f, indent=6)
+
+
+def generate_bids_dataset(bids_dir, n_subjects=100, n_rois=100, effect_size=0.5, effect_fraction=0.05,
+                          case_fraction=0.5, high_motion_fraction=0.05, noise=0.2, seed=0,
+                          session='timepoint1', task='task01', run='01', atlas='synthetic',
+                          feature='denoiseSimple', case_name='NDD', control_name='HC', n_jobs=1):
+    """
+    Write a synthetic HALFpipe/BEP-017 derivatives tree with a phenotype file and an atlas.
+    A fraction of the edges (effect_fraction) differ between cases and controls by
+    effect_size standard deviations of the noise; high_motion_fraction of the subjects
+    have a mean FD above 0.5 and are rejected by the pipeline.
+    The planted edges are saved in synthetic_ground_truth.tsv.
+    """
+    print(f"⏳ Generating synthetic dataset: {n_subjects} subjects, {n_rois} ROIs ...")
+    rng = np.random.default_rng(seed)
+    os.makedirs(bids_dir, exist_ok=True)
+
+    with open(os.path.join(bids_dir, 'dataset_description.json'), 'w') as f:
+        json.dump({"Name": "Synthetic BIDS Dataset", "BIDSVersion": "1.0.0", "DatasetType": "derivative"}, f, indent=4)
+    with open(os.path.join(bids_dir, 'meas-PearsonCorrelation_relmat.json'), 'w') as f:
+        json.dump({"Name": "Pearson Correlation Connectivity Matrix",
+                   "Description": "Connectivity matrix computed using Pearson correlation.",
+                   "BIDSVersion": "1.0.0"}, f, indent=4)
+
+    labels, networks = synthetic_atlas(n_rois)
+    atlas_file = os.path.join(bids_dir, f'{atlas}.tsv')
+    pd.DataFrame({'index': range(n_rois), 'label': labels, 'network': networks}) \
+        .to_csv(atlas_file, sep='\t', header=False, index=False)
+
+    # Phenotype
+    subjects = [f'sub-{i:05d}' for i in range(1, n_subjects + 1)]
+    is_case = rng.uniform(size=n_subjects) < case_fraction
+    mean_fd = np.round(np.where(rng.uniform(size=n_subjects) < high_motion_fraction,
+                                rng.uniform(0.55, 1.5, size=n_subjects),
+                                rng.uniform(0.05, 0.45, size=n_subjects)), 4)
+    pheno = pd.DataFrame({
+        'participant_id': subjects,
+        'diagnosis': np.where(is_case, case_name, control_name),
+        'sex': rng.choice(['M', 'F'], size=n_subjects),
+        'age': rng.integers(18, 66, size=n_subjects),
+        'medication': rng.choice(['Olanzapine', 'Lithium', 'None'], size=n_subjects),
+        'sequence': rng.choice(['T1', 'T2'], size=n_subjects),
+        'scanner': rng.choice(['Siemens', 'Philips', 'GE'], size=n_subjects),
+    })
+    phenotype_file = os.path.join(bids_dir, 'phenotype.tsv')
+    pheno.to_csv(phenotype_file, sep='\t', index=False)
+
+    # Planted effects, off the diagonal
+    triangle = ConnectomeTriangle(n_rois)
+    mean = triangle.pack(base_connectome(networks, rng))
+    planted = triangle.off_diagonal & (rng.uniform(size=triangle.n_edges) < effect_fraction)
+    pd.DataFrame({'row': triangle.rows[planted], 'col': triangle.cols[planted],
+                  'effect': effect_size * noise}) \
+        .to_csv(os.path.join(bids_dir, 'synthetic_ground_truth.tsv'), sep='\t', index=False)
+
+    names = {'session': session, 'task': task, 'run': run, 'atlas': atlas, 'feature': feature}
+    seeds = np.random.SeedSequence(seed).spawn(n_subjects)
+    jobs = [(bids_dir, sub, names, n_rois, mean, planted, effect_size * noise * case, noise, float(fd), sub_seed)
+            for sub, case, fd, sub_seed in zip(subjects, is_case, mean_fd, seeds)]
+    if n_jobs == 1:
+        for job in jobs:
+            write_subject(*job)
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            list(pool.map(write_subject, *zip(*jobs), chunksize=max(len(jobs) // (4 * n_jobs), 1)))
+
+    print(f"✅ Synthetic dataset saved in: {bids_dir} ({planted.sum()} planted edges)")
+    return dict(names, bids_dir=bids_dir, phenotype_file=phenotype_file, atlas_file=atlas_file,
+                case_name=case_name, control_name=control_name, planted=planted)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic BEP-017 dataset for tests and benchmarks")
+    parser.add_argument("--bids_dir", required=True, help="Path to the BIDS directory to create")
+    parser.add_argument("--n_subjects", type=int, default=100, help="Number of subjects")
+    parser.add_argument("--n_rois", type=int, default=100, help="Number of ROIs of the atlas")
+    parser.add_argument("--effect_size", type=float, default=0.5, help="Case-control difference on planted edges, in noise standard deviations")
+    parser.add_argument("--effect_fraction", type=float, default=0.05, help="Fraction of edges with a planted effect")
+    parser.add_argument("--high_motion_fraction", type=float, default=0.05, help="Fraction of subjects with mean FD above 0.5")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument("--n_jobs", type=int, default=1, help="Number of processes writing subjects")
+    args = parser.parse_args()
+
+    generate_bids_dataset(args.bids_dir, n_subjects=args.n_subjects, n_rois=args.n_rois,
+                          effect_size=args.effect_size, effect_fraction=args.effect_fraction,
+                          high_motion_fraction=args.high_motion_fraction, seed=args.seed, n_jobs=args.n_jobs)
@@ -0,0 +1,158 @@
+import numpy as np
+import pandas as pd
+import pytest
+import random
+import json
+import os
+
+
+def _write_relmat(path, n_roi, seed):
+    connectome = np.random.default_rng(seed).uniform(-1, 1, size=(n_roi, n_roi))
+    connectome = (connectome + connectome.T) / 2
+    np.fill_diagonal(connectome, 1)
+    pd.DataFrame(connectome).to_csv(path, sep="\t", index=False)
+    return pd.read_csv(path, sep="\t").values
+
+@pytest.fixture
+def write_relmat():
+    """Write a random symmetric relmat TSV and return the matrix as read back."""
+    return _write_relmat
+
+def _create_dummy_phenotype(bids_dir, subject_ids):
+    phenotype_file = os.path.join(bids_dir, "phenotype.tsv")
+
+    diagnoses = ["NDD", "HC"]
+    sexes = ["M", "F"]
+    medications = ["Olanzapine", "Beta", "None", "Lithium"]
+    sequences = ["T1", "T2", "T3"]
+    scanners = ["Siemens", "Cimax", "Philips", "Siemens"]
+
+    with open(phenotype_file, 'w') as f:
+        f.write("participant_id\tdiagnosis\tsex\tage\tmedication\tsequence\tscanner\n")
+        for sub in subject_ids:
+            diagnosis = random.choice(diagnoses)
+            sex = random.choice(sexes)
+            age = random.randint(18, 65)
+            medication = random.choice(medications)
+            sequence = random.choice(sequences)
+            scanner = random.choice(scanners)
+            f.write(f"{sub}\t{diagnosis}\t{sex}\t{age}\t{medication}\t{sequence}\t{scanner}\n")
+
+def _create_bids_dir_structure(bids_dir):
+    # Create dataset_description.json
+    dataset_description = {
+        "Name": "Dummy BIDS Dataset",
+        "BIDSVersion": "1.0.0",
+        "Authors": ["Dummy Author"],
+        "Acknowledgements": "This is a dummy dataset for testing purposes.",
+    }
+    
+    with open(os.path.join(bids_dir, 'dataset_description.json'), 'w') as f:
+        json.dump(dataset_description, f, indent=4)
+    
+    # Create meas-PearsonCorrelation_relmat.json
+    meas_json = {
+        "Name": "Pearson Correlation Connectivity Matrix",
+        "Description": "Connectivity matrix computed using Pearson correlation.",
+        "BIDSVersion": "1.0.0"
+    }
+    
+    with open(os.path.join(bids_dir, 'meas-PearsonCorrelation_relmat.json'), 'w') as f:
+        json.dump(meas_json, f, indent=4)
+
+def _create_dummy_json(bids_dir, sub):
+    confounds_json = os.path.join('{}_ses-{}_task-{}_run-{}_desc-{}_timeseries.json')
+
+    json_file = os.path.join(bids_dir, sub, "ses-timepoint1", "func", 
+                             confounds_json.format(sub, "timepoint1", 
+                                                    "task01", "01", 
+                                                    "denoiseSimple"))
+    info = {
+        "ConfoundRegressors" : [
+            "cosine00",
+            "rot_x",
+            "rot_y",
+            "rot_z",
+        ],
+        "ICAAROMANoiseComponents" : [
+            "aroma_motion_01",
+            "aroma_motion_02",
+            ],
+        "NumberOfVolumesDiscardedByMotionScrubbing" : 0,
+        "NumberOfVolumesDiscardedByNonsteadyStatesDetector" : 1,
+        "MeanFramewiseDisplacement" : 0.3,
+        "SamplingFrequency" : 0.5
+    }
+
+    with open(json_file, "w") as outfile:
+        json.dump(info, outfile, indent=6)
+
+def _create_dummy_data(bids_dir):
+    print("Creating dummy data for testing...")
+    
+    # Create a dummy BIDS directory structure with 2 subjects
+    # A matrix of 4x4
+    connectome_t = os.path.join('{}', 'ses-{}', 'func')
+    sub_list = [f"sub-{i:02d}" for i in range(1, 15)] 
+    _create_dummy_phenotype(bids_dir, sub_list)
+    for sub in sub_list :
+        sub_dir = os.path.join(bids_dir, connectome_t.format(sub, "timepoint1"))
+        os.makedirs(sub_dir, exist_ok=True)
+        sub_connectome = "{}_ses-{}_task-{}_run-{}_seg-{}_meas-PearsonCorrelation_desc-{}_relmat.tsv".format(sub, 
+                                                                                                            "timepoint1", 
+                                                                                                            "task01", 
+                                                                                                            "01", 
+                                                                                                            "example_atlas", 
+                                                                                                            "denoiseSimple")
+        # Create a dummy atlas file
+        atlas_file = os.path.join(bids_dir, "example_atlas.tsv")
+        with open(atlas_file, 'w') as f:
+            f.write("0\tRegion1\n1\tRegion2\n2\tRegion3\n3\tRegion4\n")
+
+        # Create dummy connectome data
+        connectome_file = os.path.join(sub_dir, sub_connectome)
+        connectome = np.random.uniform(-10, 10, size=(4, 4))
+        connectome = (connectome + connectome.T) / 2
+        np.fill_diagonal(connectome, 1)
+        
+        labels = [0, 1, 2, 3]
+        df = pd.DataFrame(connectome, columns=labels)
+        df.to_csv(connectome_file, sep="\t", float_format="%.4f", index=False)
+        
+        _create_dummy_json(bids_dir, sub)
+
+@pytest.fixture
+def create_bids_dir_structure():
+    """Write the dataset description files of a dummy HALFpipe derivatives folder."""
+    return _create_bids_dir_structure
+
+@pytest.fixture
+def create_dummy_data():
+    """Write the phenotype, atlas, connectomes and confounds JSONs of 14 dummy subjects."""
+    return _create_dummy_data
+
+def _create_site_sample(tmpdir, n_sub=60, n_roi=6, seed=0):
+    rng = np.random.default_rng(seed)
+    pheno = pd.DataFrame({
+        "participant_id": [f"sub-{i:02d}" for i in range(n_sub)],
+        "diagnosis": rng.integers(0, 2, size=n_sub),
+        "age": rng.uniform(18, 65, size=n_sub),
+        "mean_fd": rng.uniform(0.05, 0.45, size=n_sub),
+        "site": np.repeat(["A", "B"], n_sub // 2),
+    })
+    conn_mask = np.tril(np.ones((n_roi, n_roi))).astype(bool)
+    paths, conn = [], []
+    for sub_id, row in pheno.iterrows():
+        connectome = rng.normal(size=(n_roi, n_roi)) + 0.5 * row["diagnosis"] + 0.3 * (row["site"] == "B")
+        connectome = (connectome + connectome.T) / 2
+        np.fill_diagonal(connectome, 1)
+        path = os.path.join(str(tmpdir), f"{row['participant_id']}_relmat.tsv")
+        pd.DataFrame(connectome).to_csv(path, sep="\t", index=False)
+        paths.append(path)
+        conn.append(pd.read_csv(path, sep="\t").values[conn_mask])
+    return pheno, np.array(paths), np.array(conn), conn_mask
+
+@pytest.fixture
+def create_site_sample():
+    """Write the relmats of a two-site sample and return its phenotype, paths, edges and mask."""
+    return _create_site_sample
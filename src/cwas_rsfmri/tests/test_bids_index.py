@@ -0,0 +1,54 @@
+from cwas_rsfmri.bids_index import index_bids_derivatives, find_connectome_files, find_confounds_files, parse_bids_filename
+import pandas as pd
+import pytest
+import shutil
+import os
+
+def test_parse_bids_filename():
+    record = parse_bids_filename("sub-01_ses-1_task-rest_run-01_seg-schaefer_meas-PearsonCorrelation_desc-simple_relmat.tsv")
+    assert record == {"sub": "01", "ses": "1", "task": "rest", "run": "01", "seg": "schaefer",
+                      "meas": "PearsonCorrelation", "desc": "simple", "suffix": "relmat", "extension": ".tsv"}
+    assert parse_bids_filename("dataset_description.json") is None
+
+def test_bids_index_resolves_files_and_caches(tmpdir, create_bids_dir_structure, create_dummy_data):
+    bids_dir = str(tmpdir.mkdir("bids"))
+    create_bids_dir_structure(bids_dir)
+    create_dummy_data(bids_dir)
+    cache_path = os.path.join(str(tmpdir), "bids_index.json")
+    subjects = [f"sub-{i:02d}" for i in range(1, 15)]
+
+    bids_index = index_bids_derivatives(bids_dir, cache_path=cache_path)
+    connectomes = find_connectome_files(bids_index, subjects, "timepoint1", "task01", "01", "example_atlas", "denoiseSimple")
+    confounds = find_confounds_files(bids_index, subjects, "timepoint1", "task01", "01", "denoiseSimple")
+    assert sorted(connectomes.index) == subjects
+    assert sorted(confounds.index) == subjects
+    assert all(os.path.exists(p) for p in connectomes)
+
+    # Removing a file changes its folder, so the cache is rebuilt
+    os.remove(connectomes["sub-03"])
+    bids_index = index_bids_derivatives(bids_dir, cache_path=cache_path)
+    connectomes = find_connectome_files(bids_index, subjects, "timepoint1", "task01", "01", "example_atlas", "denoiseSimple")
+    assert "sub-03" not in connectomes.index
+    assert len(connectomes) == 13
+
+def test_bids_index_prefers_canonical_files(tmpdir, create_bids_dir_structure, create_dummy_data):
+    bids_dir = str(tmpdir.mkdir("bids"))
+    create_bids_dir_structure(bids_dir)
+    create_dummy_data(bids_dir)
+    subjects = [f"sub-{i:02d}" for i in range(1, 15)]
+    canonical = find_connectome_files(index_bids_derivatives(bids_dir), subjects, "timepoint1", "task01", "01",
+                                      "example_atlas", "denoiseSimple")
+
+    # A stray copy next to the session folder does not replace the file of sub-ses-func
+    shutil.copy(canonical["sub-01"], os.path.join(bids_dir, "sub-01"))
+    connectomes = find_connectome_files(index_bids_derivatives(bids_dir), subjects, "timepoint1", "task01", "01",
+                                        "example_atlas", "denoiseSimple")
+    pd.testing.assert_series_equal(connectomes.sort_index(), canonical.sort_index())
+
+    # Without a canonical file, two candidates are ambiguous
+    os.makedirs(os.path.join(bids_dir, "sub-01", "old"))
+    shutil.copy(canonical["sub-01"], os.path.join(bids_dir, "sub-01", "old"))
+    os.remove(canonical["sub-01"])
+    with pytest.raises(ValueError):
+        find_connectome_files(index_bids_derivatives(bids_dir), subjects, "timepoint1", "task01", "01",
+                              "example_atlas", "denoiseSimple")
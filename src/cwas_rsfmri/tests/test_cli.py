@@ -1,115 +1,19 @@
-from cwas_rsfmri.run import run_pipeline
-import numpy as np
+from cwas_rsfmri.run import run_pipeline, read_grid
+from cwas_rsfmri.workflow import run_batch, expand_grid
+from cwas_rsfmri import workflow
 import pandas as pd
 import os
+import glob
+import shutil
+import sys
 import json
-import random
+import subprocess
+import argparse
+import threading
+import pytest
+from concurrent.futures import ThreadPoolExecutor
 
-def create_dummy_phenotype(bids_dir, subject_ids):
-    phenotype_file = os.path.join(bids_dir, "phenotype.tsv")
-
-    diagnoses = ["NDD", "HC"]
-    sexes = ["M", "F"]
-    medications = ["Olanzapine", "Beta", "None", "Lithium"]
-    sequences = ["T1", "T2", "T3"]
-    scanners = ["Siemens", "Cimax", "Philips", "Siemens"]
-
-    with open(phenotype_file, 'w') as f:
-        f.write("participant_id\tdiagnosis\tsex\tage\tmedication\tsequence\tscanner\n")
-        for sub in subject_ids:
-            diagnosis = random.choice(diagnoses)
-            sex = random.choice(sexes)
-            age = random.randint(18, 65)
-            medication = random.choice(medications)
-            sequence = random.choice(sequences)
-            scanner = random.choice(scanners)
-            f.write(f"{sub}\t{diagnosis}\t{sex}\t{age}\t{medication}\t{sequence}\t{scanner}\n")
-
-# Example usage
-def create_bids_dir_structure(bids_dir):
-    # Create dataset_description.json
-    dataset_description = {
-        "Name": "Dummy BIDS Dataset",
-        "BIDSVersion": "1.0.0",
-        "Authors": ["Dummy Author"],
-        "Acknowledgements": "This is a dummy dataset for testing purposes.",
-    }
-    
-    with open(os.path.join(bids_dir, 'dataset_description.json'), 'w') as f:
-        json.dump(dataset_description, f, indent=4)
-    
-    # Create meas-PearsonCorrelation_relmat.json
-    meas_json = {
-        "Name": "Pearson Correlation Connectivity Matrix",
-        "Description": "Connectivity matrix computed using Pearson correlation.",
-        "BIDSVersion": "1.0.0"
-    }
-    
-    with open(os.path.join(bids_dir, 'meas-PearsonCorrelation_relmat.json'), 'w') as f:
-        json.dump(meas_json, f, indent=4)
-
-def create_dummy_json(bids_dir, sub):
-    confounds_json = os.path.join('{}_ses-{}_task-{}_run-{}_desc-{}_timeseries.json')
-
-    json_file = os.path.join(bids_dir, sub, "ses-timepoint1", "func", 
-                             confounds_json.format(sub, "timepoint1", 
-                                                    "task01", "01", 
-                                                    "denoiseSimple"))
-    info = {
-        "ConfoundRegressors" : [
-            "cosine00",
-            "rot_x",
-            "rot_y",
-            "rot_z",
-        ],
-        "ICAAROMANoiseComponents" : [
-            "aroma_motion_01",
-            "aroma_motion_02",
-            ],
-        "NumberOfVolumesDiscardedByMotionScrubbing" : 0,
-        "NumberOfVolumesDiscardedByNonsteadyStatesDetector" : 1,
-        "MeanFramewiseDisplacement" : 0.3,
-        "SamplingFrequency" : 0.5
-    }
-
-    with open(json_file, "w") as outfile:
-        json.dump(info, outfile, indent=6)
-
-def create_dummy_data(bids_dir):
-    print("Creating dummy data for testing...")
-    
-    # Create a dummy BIDS directory structure with 2 subjects
-    # A matrix of 4x4
-    connectome_t = os.path.join('{}', 'ses-{}', 'func')
-    sub_list = [f"sub-{i:02d}" for i in range(1, 15)] 
-    create_dummy_phenotype(bids_dir, sub_list)
-    for sub in sub_list :
-        sub_dir = os.path.join(bids_dir, connectome_t.format(sub, "timepoint1"))
-        os.makedirs(sub_dir, exist_ok=True)
-        sub_connectome = "{}_ses-{}_task-{}_run-{}_seg-{}_meas-PearsonCorrelation_desc-{}_relmat.tsv".format(sub, 
-                                                                                                            "timepoint1", 
-                                                                                                            "task01", 
-                                                                                                            "01", 
-                                                                                                            "example_atlas", 
-                                                                                                            "denoiseSimple")
-        # Create a dummy atlas file
-        atlas_file = os.path.join(bids_dir, "example_atlas.tsv")
-        with open(atlas_file, 'w') as f:
-            f.write("0\tRegion1\n1\tRegion2\n2\tRegion3\n3\tRegion4\n")
-
-        # Create dummy connectome data
-        connectome_file = os.path.join(sub_dir, sub_connectome)
-        connectome = np.random.uniform(-10, 10, size=(4, 4))
-        connectome = (connectome + connectome.T) / 2
-        np.fill_diagonal(connectome, 1)
-        
-        labels = [0, 1, 2, 3]
-        df = pd.DataFrame(connectome, columns=labels)
-        df.to_csv(connectome_file, sep="\t", float_format="%.4f", index=False)
-        
-        create_dummy_json(bids_dir, sub)
-
-def test_smoke(tmpdir):
+def test_smoke(tmpdir, create_bids_dir_structure, create_dummy_data):
     bids_dir = tmpdir.mkdir("data").mkdir("bids")
     # bids_dir = os.path.join("data", "bids")
     print(f"BIDS directory created at: {bids_dir}")
@@ -145,7 +49,7 @@ def test_smoke(tmpdir):
     assert os.path.isfile(os.path.join(output_dir, "cwas_report.json")), "Report file was not created"
     assert os.path.isfile(os.path.join(output_dir, "interactive_heatmap.html")), "Plot file was not created"
 
-def test_smoke_with_all(tmpdir):
+def test_smoke_with_all(tmpdir, create_bids_dir_structure, create_dummy_data):
     bids_dir = tmpdir.mkdir("data").mkdir("bids")
     # bids_dir = os.path.join("data", "bids")
     print(f"BIDS directory created at: {bids_dir}")
@@ -180,3 +84,175 @@ def test_smoke_with_all(tmpdir):
     assert os.path.isfile(os.path.join(output_dir, "cwas_report.json")), "Report file was not created"
     assert os.path.isfile(os.path.join(output_dir, "interactive_heatmap.html")), "Plot file was not created"
 
+
+def test_profile(tmpdir, create_bids_dir_structure, create_dummy_data):
+    bids_dir = tmpdir.mkdir("data").mkdir("bids")
+    output_dir = os.path.join(bids_dir, "output")
+    create_bids_dir_structure(bids_dir)
+    create_dummy_data(bids_dir)
+
+    run_pipeline(bids_dir=bids_dir,
+                 output_dir=output_dir,
+                 atlas_file=os.path.join(bids_dir, "example_atlas.tsv"),
+                 atlas="example_atlas",
+                 pheno_p=os.path.join(bids_dir, "phenotype.tsv"),
+                 scanner=True,
+                 sequence=True,
+                 medication=False,
+                 group="diagnosis",
+                 case_name="NDD",
+                 control_name="HC",
+                 session="timepoint1",
+                 task="task01",
+                 run="01",
+                 feature="denoiseSimple",
+                 cprofile_stages=["glm"])
+
+    with open(os.path.join(output_dir, "cwas_report.json")) as f:
+        profile = json.load(f)["profile"]
+    assert list(profile["stages"]) == ["atlas", "subjects", "fd_table", "fd_filter", "connectome_stack", "glm", "save", "plot"]
+    assert profile["stages"]["glm"]["edges"] == 10
+    assert os.path.isfile(os.path.join(output_dir, "profile_glm.prof")), "cProfile file was not created"
+
+
+def test_batch(tmpdir, create_bids_dir_structure, create_dummy_data):
+    bids_dir = tmpdir.mkdir("data").mkdir("bids")
+    atlas_file = os.path.join(bids_dir, "example_atlas.tsv")
+    phenotype_file = os.path.join(bids_dir, "phenotype.tsv")
+    output_dir = os.path.join(bids_dir, "output")
+
+    create_bids_dir_structure(bids_dir)
+    create_dummy_data(bids_dir)
+
+    # Second atlas with the same regions
+    for connectome_file in glob.glob(os.path.join(bids_dir, "sub-*", "ses-*", "func", "*_relmat.tsv")):
+        shutil.copy(connectome_file, connectome_file.replace("seg-example_atlas", "seg-other"))
+
+    combinations = expand_grid(["timepoint1"], ["task01"], ["01"], ["example_atlas", "other"],
+                               [atlas_file, atlas_file], ["denoiseSimple"])
+    index = run_batch(bids_dir=bids_dir,
+                      output_dir=output_dir,
+                      pheno_p=phenotype_file,
+                      combinations=combinations,
+                      group="diagnosis",
+                      scanner=False,
+                      sequence=False,
+                      medication=False,
+                      case_name="NDD",
+                      control_name="HC",
+                      batch_jobs=2)
+
+    assert os.path.isfile(os.path.join(output_dir, "cwas_batch_index.tsv")), "Batch index was not created"
+    assert list(index["status"]) == ["ok", "ok"]
+    for results_table in index["results_table"]:
+        assert os.path.isfile(results_table), "TSV file was not created"
+    first, second = [pd.read_csv(t, sep="\t") for t in index["results_table"]]
+    pd.testing.assert_frame_equal(first, second)
+
+def test_shared_results_do_not_block_other_keys():
+    shared = {"atlases": {}, "lock": threading.Lock()}
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def slow():
+        calls.append("slow")
+        started.set()
+        release.wait(10)
+        return "slow"
+
+    # While one key is computed, another key is served and the same key is computed only once
+    with ThreadPoolExecutor(2) as pool:
+        first = pool.submit(workflow.get_shared, shared, "atlases", "a", slow)
+        started.wait(10)
+        second = pool.submit(workflow.get_shared, shared, "atlases", "a", slow)
+        assert workflow.get_shared(shared, "atlases", "b", lambda: "fast") == "fast"
+        release.set()
+        assert first.result() == second.result() == "slow"
+    assert calls == ["slow"]
+
+def test_grid_rejects_several_command_line_labels(tmpdir):
+    grid_file = os.path.join(str(tmpdir), "grid.json")
+    with open(grid_file, "w") as f:
+        json.dump([{"atlas": "example_atlas", "atlas_file": "example_atlas.tsv", "feature": "denoiseSimple"}], f)
+    args = argparse.Namespace(session=["timepoint1"], task=["task01"], run=["01"], atlas=None, atlas_file=None,
+                              feature=None)
+    assert read_grid(grid_file, args)[0]["session"] == "timepoint1"
+
+    args.run = ["01", "02"]
+    with pytest.raises(ValueError):
+        read_grid(grid_file, args)
+
+def test_checkpoint_resume(tmpdir, monkeypatch, create_bids_dir_structure, create_dummy_data):
+    bids_dir = tmpdir.mkdir("data").mkdir("bids")
+    output_dir = os.path.join(bids_dir, "output")
+    create_bids_dir_structure(bids_dir)
+    create_dummy_data(bids_dir)
+    arguments = dict(bids_dir=bids_dir,
+                     output_dir=output_dir,
+                     atlas_file=os.path.join(bids_dir, "example_atlas.tsv"),
+                     atlas="example_atlas",
+                     pheno_p=os.path.join(bids_dir, "phenotype.tsv"),
+                     scanner=False,
+                     sequence=False,
+                     medication=False,
+                     group="diagnosis",
+                     case_name="NDD",
+                     control_name="HC",
+                     session="timepoint1",
+                     task="task01",
+                     run="01",
+                     feature="denoiseSimple",
+                     checkpoint=True)
+    results_table = os.path.join(output_dir, "cwas_NDD_HC_rsfmri_denoiseSimple_example_atlas.tsv")
+
+    run_pipeline(**arguments)
+    first = pd.read_csv(results_table, sep="\t")
+
+    # Connectomes must come from the checkpoint when nothing changed
+    def fail(*args, **kwargs):
+        raise AssertionError("connectomes were loaded again")
+    monkeypatch.setattr(workflow, "process_connectivity_matrix", fail)
+
+    run_pipeline(**arguments, n_perm=20, seed=1)
+    second = pd.read_csv(results_table, sep="\t")
+
+    assert os.path.isdir(os.path.join(output_dir, "cache")), "Cache directory was not created"
+    pd.testing.assert_frame_equal(first[["betas", "stand_betas", "pvals"]], second[["betas", "stand_betas", "pvals"]])
+    assert "pvals_fwer" in second
+
+    # Reused subjects and GLM stages write their report again, without the entries of older runs
+    report_path = os.path.join(output_dir, "cwas_report.json")
+    with open(report_path) as f:
+        expected = json.load(f)
+    with open(report_path, "w") as f:
+        json.dump(dict(expected, stale="entry"), f)
+    monkeypatch.setattr(workflow, "find_valid_subjects", fail)
+    monkeypatch.setattr(workflow, "glm_wrap_cc", fail)
+    run_pipeline(**arguments, n_perm=20, seed=1)
+    with open(report_path) as f:
+        report = json.load(f)
+    assert "stale" not in report
+    assert report["halfpipe_unprocessed"] == expected["halfpipe_unprocessed"]
+    assert report["FWER correction"] == expected["FWER correction"]
+    assert "seed=1" in report["FWER correction"]
+
+
+def test_dry_run(tmpdir, create_bids_dir_structure, create_dummy_data):
+    bids_dir = tmpdir.mkdir("data").mkdir("bids")
+    create_bids_dir_structure(bids_dir)
+    create_dummy_data(bids_dir)
+    output_dir = os.path.join(bids_dir, "output")
+
+    # The CLI runs in a fresh interpreter to see which modules the dry run imports
+    script = ("import sys; from cwas_rsfmri.run import main; main(); "
+              "print('HEAVY', [m for m in ('numpy', 'pandas', 'statsmodels', 'sklearn') if m in sys.modules])")
+    args = ["--bids_dir", str(bids_dir), "--output_dir", output_dir,
+            "--phenotype_file", os.path.join(bids_dir, "phenotype.tsv"),
+            "--atlas", "example_atlas", "--atlas_file", os.path.join(bids_dir, "example_atlas.tsv"),
+            "--session", "timepoint1", "--task", "task01", "--run", "01", "--feature", "denoiseSimple",
+            "--case_id", "NDD", "--control_id", "HC", "--dry-run"]
+    result = subprocess.run([sys.executable, "-c", script] + args, capture_output=True, text=True, check=True)
+
+    assert "HEAVY []" in result.stdout
+    assert "14 subjects" in result.stdout and "10 edges" in result.stdout
+    assert not os.path.exists(output_dir), "A dry run should not write outputs"
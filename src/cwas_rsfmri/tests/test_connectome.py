@@ -0,0 +1,33 @@
+from cwas_rsfmri.connectome import load_connectomes, conn2mat
+from cwas_rsfmri.triangle import ConnectomeTriangle, as_triangle
+import numpy as np
+import os
+
+def test_load_connectomes_parallel_keeps_order(tmpdir, write_relmat):
+    n_roi = 6
+    conn_mask = np.tril(np.ones((n_roi, n_roi))).astype(bool)
+    paths = [os.path.join(str(tmpdir), f"sub-{i:02d}_relmat.tsv") for i in range(20)]
+    expected = np.array([write_relmat(p, n_roi, seed)[conn_mask] for seed, p in enumerate(paths)])
+
+    serial = load_connectomes(paths, conn_mask, np.empty_like(expected), n_jobs=1)
+    parallel = load_connectomes(paths, conn_mask, np.empty_like(expected), n_jobs=4)
+
+    np.testing.assert_array_equal(serial, expected)
+    np.testing.assert_array_equal(parallel, expected)
+
+
+def test_triangle_matches_boolean_mask(tmpdir, write_relmat):
+    n_roi = 7
+    conn_mask = np.tril(np.ones((n_roi, n_roi))).astype(bool)
+    matrix = write_relmat(os.path.join(str(tmpdir), "sub-00_relmat.tsv"), n_roi, seed=0)
+    triangle = as_triangle(conn_mask)
+
+    # Same edge order as the boolean mask, and the same symmetric matrix back
+    np.testing.assert_array_equal(triangle.pack(matrix), matrix[conn_mask])
+    np.testing.assert_array_equal(conn2mat(matrix[conn_mask], conn_mask), matrix)
+    np.testing.assert_array_equal(triangle.unpack(triangle.pack(matrix)), matrix)
+
+    triangle32 = ConnectomeTriangle(n_roi, dtype=np.float32)
+    packed = load_connectomes([os.path.join(str(tmpdir), "sub-00_relmat.tsv")], triangle32,
+                              np.empty((1, triangle32.n_edges), dtype=np.float32))
+    np.testing.assert_allclose(packed[0], matrix[conn_mask], rtol=1e-6)
@@ -0,0 +1,54 @@
+from cwas_rsfmri.reject_fd_qc import read_fd_table, filter_by_fd
+import numpy as np
+import pandas as pd
+import pytest
+import json
+import os
+
+def write_confounds(path, mean_fd, n_scrubbed, n_volumes=200):
+    # HALFpipe confounds JSON, and the timeseries of the volumes left after the 2 non-steady and the scrubbed ones
+    with open(path, "w") as f:
+        json.dump({"MeanFramewiseDisplacement": mean_fd, "NumberOfVolumesDiscardedByMotionScrubbing": n_scrubbed,
+                   "NumberOfVolumesDiscardedByNonsteadyStatesDetector": 2}, f)
+    if n_volumes is not None:
+        pd.DataFrame(np.zeros((n_volumes - 2 - n_scrubbed, 3))).to_csv(path.replace(".json", ".tsv"), sep="\t",
+                                                                       header=False, index=False)
+
+def test_fd_table_cache_and_thresholds(tmpdir):
+    subjects = [f"sub-{i:02d}" for i in range(4)]
+    paths = pd.Series([os.path.join(str(tmpdir), f"{sub}_timeseries.json") for sub in subjects], index=subjects)
+    for path, mean_fd, n_scrubbed in zip(paths, [0.1, 0.3, 0.6, 0.2], [0, 50, 0, 10]):
+        write_confounds(path, mean_fd, n_scrubbed)
+    cache_path = os.path.join(str(tmpdir), "fd_cache.tsv")
+
+    fd_table = read_fd_table(paths, n_jobs=2, cache_path=cache_path)
+    assert list(fd_table["mean_fd"]) == [0.1, 0.3, 0.6, 0.2]
+    assert fd_table.loc["sub-01", "percent_scrubbed"] == 25
+
+    # Cached values are reused, a modified file is read again
+    os.remove(paths["sub-00"])
+    write_confounds(paths["sub-00"], 0.1, 0)
+    write_confounds(paths["sub-03"], 0.4, 10)
+    os.utime(paths["sub-03"], ns=(0, 10 ** 9))
+    cache = pd.read_csv(cache_path, sep="\t")
+    cache.loc[cache["path"] == paths["sub-01"], "mean_fd"] = 0.35
+    cache.to_csv(cache_path, sep="\t", index=False)
+    fd_table = read_fd_table(paths.iloc[::-1], cache_path=cache_path)
+    assert list(fd_table.index) == subjects[::-1]
+    assert list(fd_table["mean_fd"]) == [0.4, 0.6, 0.35, 0.1]
+
+    # Missing JSON (sub-04) is rejected, not misaligned
+    pheno = pd.DataFrame({"participant_id": subjects + ["sub-04"]})
+    kept = filter_by_fd(pheno, None, None, str(tmpdir), None, None, None, None,
+                        fd_table=fd_table, fd_threshold=0.5, max_percent_scrubbed=20)
+    assert list(kept["participant_id"]) == ["sub-00", "sub-03"]
+    assert list(kept["mean_fd"]) == [0.1, 0.4]
+
+    # Without the timeseries TSV, the number of volumes is unknown and scrubbing cannot be checked
+    write_confounds(paths["sub-00"], 0.1, 0, n_volumes=None)
+    os.remove(paths["sub-00"].replace(".json", ".tsv"))
+    fd_table = read_fd_table(paths)
+    assert np.isnan(fd_table.loc["sub-00", "n_volumes"])
+    with pytest.raises(ValueError, match="sub-00"):
+        filter_by_fd(pheno, None, None, str(tmpdir), None, None, None, None,
+                     fd_table=fd_table, fd_threshold=0.5, max_percent_scrubbed=20)
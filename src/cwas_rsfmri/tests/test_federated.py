@@ -0,0 +1,106 @@
+from cwas_rsfmri.federated import (site_sufficient_stats, save_sufficient_stats, merge_sufficient_stats,
+                                  glm_sufficient_stats)
+from cwas_rsfmri.run import merge_sites_main
+from cwas_rsfmri.stats import glm_wrap_cc
+from cwas_rsfmri.linear_model import factorize_design, fit_ols, fit_ols_crossproducts
+import numpy as np
+import pandas as pd
+import pytest
+import sys
+import os
+
+def test_merged_sites_match_pooled_glm(tmpdir, create_site_sample):
+    pheno, paths, conn, conn_mask = create_site_sample(tmpdir)
+    regressors = 'age + mean_fd'
+    edges = ~np.eye(conn_mask.shape[0], dtype=bool)[conn_mask]
+
+    # Small memory budget so that each site is streamed in several subject blocks
+    site_stats = []
+    for site in ["A", "B"]:
+        in_site = (pheno["site"] == site).values
+        site_stats.append(site_sufficient_stats(paths[in_site], pheno.loc[in_site].reset_index(drop=True),
+                                                'diagnosis', 1, 0, conn_mask, regressors=regressors,
+                                                max_memory=7 * conn.shape[1] * 8 * 2))
+
+    for site_effects, pooled_regressors in [(False, regressors), (True, regressors + ' + C(site)')]:
+        merged = merge_sufficient_stats(site_stats, ["A", "B"], site_effects=site_effects)
+        table_fed = glm_sufficient_stats(merged, 'diagnosis')
+        table_pool = glm_wrap_cc(str(tmpdir), conn, pheno, group='diagnosis', case=1, control=0,
+                                 regressors=pooled_regressors)
+
+        for column in ['betas', 'stand_betas', 'pvals']:
+            np.testing.assert_allclose(table_fed[column][edges], table_pool[column][edges], rtol=1e-6, atol=1e-10)
+        # The constant diagonal is fitted exactly: no effect rather than p = 0 from the rounding of Y'Y
+        assert (table_fed['pvals'][~edges] == 1).all()
+
+def test_sites_with_different_scanner_levels(tmpdir, create_site_sample):
+    pheno, paths, conn, conn_mask = create_site_sample(tmpdir)
+    # Site A scans on GE and Philips, site B on Philips and Siemens: the unused categories are dropped at each site
+    rng = np.random.default_rng(1)
+    scanner = np.where(pheno["site"] == "A", rng.choice(["GE", "Philips"], len(pheno)),
+                       rng.choice(["Philips", "Siemens"], len(pheno)))
+    pheno["scanner"] = pd.Categorical(scanner, categories=["GE", "Philips", "Siemens"])
+    regressors = 'age + C(scanner)'
+    edges = ~np.eye(conn_mask.shape[0], dtype=bool)[conn_mask]
+
+    site_stats = []
+    for site in ["A", "B"]:
+        in_site = (pheno["site"] == site).values
+        site_stats.append(site_sufficient_stats(paths[in_site], pheno.loc[in_site].reset_index(drop=True),
+                                                'diagnosis', 1, 0, conn_mask, regressors=regressors))
+    assert site_stats[0]["factors"]["C(scanner)"] == {"levels": ["GE", "Philips"], "reference": "GE"}
+    assert site_stats[1]["factors"]["C(scanner)"] == {"levels": ["Philips", "Siemens"], "reference": "Philips"}
+
+    for site_effects, pooled_regressors in [(False, regressors), (True, regressors + ' + C(site)')]:
+        merged = merge_sufficient_stats(site_stats, ["A", "B"], site_effects=site_effects)
+        assert {'C(scanner)[T.Philips]', 'C(scanner)[T.Siemens]'} <= set(merged['columns'])
+        table_fed = glm_sufficient_stats(merged, 'diagnosis')
+        table_pool = glm_wrap_cc(str(tmpdir), conn, pheno, group='diagnosis', case=1, control=0,
+                                 regressors=pooled_regressors)
+        for column in ['betas', 'stand_betas', 'pvals']:
+            np.testing.assert_allclose(table_fed[column][edges], table_pool[column][edges], rtol=1e-6, atol=1e-10)
+
+    # Interactions cannot be recoded: sites must share their columns
+    site_stats[1]['columns'] = site_stats[1]['columns'] + ['age:C(scanner)[T.Siemens]']
+    with pytest.raises(ValueError):
+        merge_sufficient_stats(site_stats, ["A", "B"], site_effects=False)
+
+def test_crossproducts_keep_low_variance_effects():
+    rng = np.random.default_rng(2)
+    n_sub = 200
+    design = np.column_stack([np.ones(n_sub), rng.integers(0, 2, size=n_sub)])
+    # A constant edge, and a real effect on an edge with a large mean and a small variance
+    data = np.column_stack([np.ones(n_sub), 1 + 5e-4 * design[:, 1] + 1e-4 * rng.normal(size=n_sub)])
+
+    full = fit_ols(data, factorize_design(design))
+    crossproducts = fit_ols_crossproducts(design.T @ design, design.T @ data, np.einsum('ij,ij->j', data, data),
+                                          n_sub, intercept=0)
+    for results in [full, crossproducts]:
+        assert (results['pvals'][:, 0] == 1).all()
+        assert results['tvals'][1, 1] > 20
+    np.testing.assert_allclose(crossproducts['tvals'][:, 1], full['tvals'][:, 1], rtol=1e-4)
+
+def test_merge_sites_cli(tmpdir, monkeypatch, create_site_sample):
+    pheno, paths, conn, conn_mask = create_site_sample(tmpdir)
+    site_files = []
+    for site in ["A", "B"]:
+        in_site = (pheno["site"] == site).values
+        stats = site_sufficient_stats(paths[in_site], pheno.loc[in_site].reset_index(drop=True),
+                                      'diagnosis', 1, 0, conn_mask, regressors='age')
+        site_files.append(os.path.join(str(tmpdir), f"site-{site}_stats.npz"))
+        save_sufficient_stats(site_files[-1], stats, {
+            "site": site, "group": "diagnosis", "case_name": "NDD", "control_name": "HC",
+            "atlas": "example", "feature": "denoiseSimple", "roi_labels": [f"roi{i}" for i in range(6)]})
+
+    output_dir = os.path.join(str(tmpdir), "merged")
+    monkeypatch.setattr(sys, "argv", ["cwas-rsfmri-merge-sites", "--site_stats", *site_files,
+                                      "--output_dir", output_dir])
+    merge_sites_main()
+    assert os.path.isfile(os.path.join(output_dir, "cwas_NDD_HC_rsfmri_denoiseSimple_example.tsv"))
+
+    # Motion QC happens at each site: the merge takes no FD options
+    for option in [["--max_scrubbed", "20"], ["--fd_cache", "fd.tsv"], ["--fd_threshold", "0.3"]]:
+        monkeypatch.setattr(sys, "argv", ["cwas-rsfmri-merge-sites", "--site_stats", *site_files,
+                                          "--output_dir", output_dir, *option])
+        with pytest.raises(SystemExit):
+            merge_sites_main()
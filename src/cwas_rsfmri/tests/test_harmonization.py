@@ -0,0 +1,64 @@
+from cwas_rsfmri.harmonization import combat_harmonize, fit_combat, apply_combat, combat_design
+import os
+import pytest
+import numpy as np
+import pandas as pd
+
+def create_scanner_sample(n_sub=90, n_edges=40, seed=0):
+    rng = np.random.default_rng(seed)
+    pheno = pd.DataFrame({
+        "participant_id": [f"sub-{i:02d}" for i in range(n_sub)],
+        "diagnosis": rng.integers(0, 2, size=n_sub),
+        "age": rng.uniform(18, 65, size=n_sub),
+        "mean_fd": rng.uniform(0.05, 0.45, size=n_sub),
+        "scanner": rng.choice(["GE", "Philips", "Siemens"], size=n_sub),
+    })
+    shift = pheno["scanner"].map({"GE": 0.0, "Philips": 1.0, "Siemens": -1.0}).values
+    spread = pheno["scanner"].map({"GE": 1.0, "Philips": 2.0, "Siemens": 0.5}).values
+    conn = (rng.normal(size=(n_sub, n_edges)) + shift[:, None]) * spread[:, None]
+    conn += 0.5 * pheno["diagnosis"].values[:, None] + 0.02 * pheno["age"].values[:, None]
+    # Constant edge, as the diagonal of correlation matrices
+    conn[:, 0] = 1
+    return pheno, conn
+
+def test_combat_removes_scanner_effects(tmpdir):
+    pheno, conn = create_scanner_sample()
+    regressors = 'age + mean_fd + C(scanner)'
+    sub_mask, batch_ids, levels, covariates = combat_design(pheno, 'diagnosis', 1, 0, regressors)
+    assert levels == ["GE", "Philips", "Siemens"]
+    assert list(covariates.columns) == ['C(diagnosis, Treatment(0))[T.1]', 'age', 'mean_fd']
+
+    # Without shrinkage, each scanner has the same location and scale once the covariates are removed
+    params = fit_combat(conn, batch_ids, covariates, n_batch=3, eb=False)
+    harmonized = apply_combat(conn, batch_ids, covariates, params)
+    resid = (harmonized - params['grand_mean'] - covariates.values @ params['beta_covariates'])[:, 1:]
+    for b in range(3):
+        np.testing.assert_allclose(resid[batch_ids == b].mean(axis=0), 0, atol=1e-10)
+        np.testing.assert_allclose(resid[batch_ids == b].var(axis=0, ddof=1), params['var_pooled'][1:], rtol=1e-10)
+    np.testing.assert_array_equal(harmonized[:, 0], 1)
+
+    # Edge blocks give the same harmonization as the whole stack
+    save_path = os.path.join(str(tmpdir), 'combat.npz')
+    full = combat_harmonize(str(tmpdir), conn, pheno, 'diagnosis', 1, 0, regressors, save_path=save_path)
+    chunked = combat_harmonize(str(tmpdir), conn, pheno, 'diagnosis', 1, 0, regressors,
+                               max_memory=len(pheno) * 8 * 6 * 7)
+    np.testing.assert_allclose(chunked, full, rtol=1e-12)
+    assert np.std([full[batch_ids == b, 1:].std() for b in range(3)]) < \
+        0.1 * np.std([conn[batch_ids == b, 1:].std() for b in range(3)])
+
+    # New subjects are harmonized with the saved parameters, without refitting
+    new = combat_harmonize(str(tmpdir), conn[:30], pheno.iloc[:30], 'diagnosis', 1, 0, regressors,
+                           params_path=save_path)
+    np.testing.assert_allclose(new, full[:30], rtol=1e-12)
+
+    # Saved parameters are only applied to the batches and covariates they were fitted on
+    pheno["site"] = pheno["scanner"]
+    with pytest.raises(ValueError, match="batches of scanner"):
+        combat_harmonize(str(tmpdir), conn, pheno, 'diagnosis', 1, 0, regressors, batch_col='site',
+                         params_path=save_path)
+    unseen = pheno.assign(scanner=pheno["scanner"].replace("GE", "Canon"))
+    with pytest.raises(ValueError, match="Canon"):
+        combat_harmonize(str(tmpdir), conn, unseen, 'diagnosis', 1, 0, regressors, params_path=save_path)
+    with pytest.raises(ValueError, match="sex"):
+        combat_harmonize(str(tmpdir), conn, pheno.assign(sex=1), 'diagnosis', 1, 0, regressors + ' + sex',
+                         params_path=save_path)
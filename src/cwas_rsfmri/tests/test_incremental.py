@@ -0,0 +1,105 @@
+from cwas_rsfmri.incremental import update_incremental, load_incremental_state, save_incremental_state
+from cwas_rsfmri.stats import glm_wrap_cc
+import numpy as np
+import pandas as pd
+import json
+import os
+
+def test_incremental_updates_match_full_refit(tmpdir, create_site_sample):
+    pheno, paths, conn, conn_mask = create_site_sample(tmpdir, n_sub=60)
+    state_dir = os.path.join(str(tmpdir), "state")
+    edges = ~np.eye(conn_mask.shape[0], dtype=bool)[conn_mask]
+
+    def update(subjects, regressors='age + mean_fd'):
+        table, stats, counts = update_incremental(str(tmpdir), state_dir, "cwas", pheno.loc[subjects], paths[subjects],
+                                                  'diagnosis', 1, 0, conn_mask, regressors=regressors, check=True)
+        full = glm_wrap_cc(str(tmpdir), conn[subjects], pheno.loc[subjects].reset_index(drop=True),
+                           group='diagnosis', case=1, control=0, regressors=regressors)
+        for column in ['betas', 'stand_betas', 'pvals']:
+            np.testing.assert_allclose(table[column][edges], full[column][edges], rtol=1e-6, atol=1e-10)
+        with open(os.path.join(str(tmpdir), "cwas_report.json")) as f:
+            assert json.load(f)["incremental check"]["consistent"]
+        return counts
+
+    counts = update(np.arange(40))
+    assert (counts["added"], counts["files read"], counts["removed"]) == (40, 40, 0)
+
+    # 5 subjects excluded, 20 new ones, a modified relmat file and an edited phenotype
+    connectome = pd.read_csv(paths[10], sep="\t").values + 0.5
+    pd.DataFrame(connectome).to_csv(paths[10], sep="\t", index=False)
+    os.utime(paths[10], ns=(0, 10 ** 9))
+    conn[10] = connectome[conn_mask]
+    pheno.loc[12, "age"] += 1
+    counts = update(np.arange(5, 60))
+    assert (counts["added"], counts["files read"], counts["removed"]) == (22, 21, 7)
+
+    # A new design column: the cross-products are rebuilt without reading the files again
+    counts = update(np.arange(5, 60), regressors='age + mean_fd + C(site)')
+    assert counts["design rebuilt"] and counts["files read"] == 0
+
+def test_incremental_contributions_stay_bounded(tmpdir, create_site_sample):
+    pheno, paths, conn, conn_mask = create_site_sample(tmpdir, n_sub=30)
+    state_dir = os.path.join(str(tmpdir), "state")
+    subjects = np.arange(20)
+    row_size = conn.shape[1] * 8
+
+    # Each update replaces 10 files and swaps 2 subjects: the replaced rows must not pile up
+    compacted = []
+    for update_id in range(8):
+        for sub_id in subjects[:10]:
+            connectome = pd.read_csv(paths[sub_id], sep="\t").values + 0.1
+            pd.DataFrame(connectome).to_csv(paths[sub_id], sep="\t", index=False)
+            os.utime(paths[sub_id], ns=(0, (update_id + 1) * 10 ** 9))
+            conn[sub_id] = connectome[conn_mask]
+        subjects = np.concatenate([subjects[2:], [(subjects[-1] + 1) % 30, (subjects[-1] + 2) % 30]])
+        table, stats, counts = update_incremental(str(tmpdir), state_dir, "cwas", pheno.loc[subjects], paths[subjects],
+                                                  'diagnosis', 1, 0, conn_mask, regressors='age', check=True)
+        compacted.append(counts["compacted"])
+        data_files = [name for name in os.listdir(state_dir) if name.endswith(".dat")]
+        assert len(data_files) == 1
+        assert os.path.getsize(os.path.join(state_dir, data_files[0])) <= 2 * len(subjects) * row_size
+
+    assert any(compacted)
+    full = glm_wrap_cc(str(tmpdir), conn[subjects], pheno.loc[subjects].reset_index(drop=True),
+                       group='diagnosis', case=1, control=0, regressors='age')
+    edges = ~np.eye(conn_mask.shape[0], dtype=bool)[conn_mask]
+    np.testing.assert_allclose(table['betas'][edges], full['betas'][edges], rtol=1e-6, atol=1e-10)
+
+def test_incremental_check_rebuilds_inconsistent_state(tmpdir, create_site_sample):
+    pheno, paths, conn, conn_mask = create_site_sample(tmpdir, n_sub=40)
+    state_dir = os.path.join(str(tmpdir), "state")
+    edges = ~np.eye(conn_mask.shape[0], dtype=bool)[conn_mask]
+    subjects = np.arange(40)
+    # An edge with a large mean, a small variance and a real effect must agree with the refit
+    rng = np.random.default_rng(5)
+    for sub_id, path in enumerate(paths):
+        connectome = pd.read_csv(path, sep="\t").values
+        connectome[1, 0] = connectome[0, 1] = 1 + 5e-4 * pheno.loc[sub_id, "diagnosis"] + 1e-4 * rng.normal()
+        pd.DataFrame(connectome).to_csv(path, sep="\t", index=False)
+        conn[sub_id] = pd.read_csv(path, sep="\t").values[conn_mask]
+
+    def update():
+        table, _, _ = update_incremental(str(tmpdir), state_dir, "cwas", pheno.loc[subjects], paths[subjects],
+                                         'diagnosis', 1, 0, conn_mask, regressors='age', check=True)
+        with open(os.path.join(str(tmpdir), "cwas_report.json")) as f:
+            return table, json.load(f)["incremental check"]
+
+    table, check = update()
+    assert check["consistent"] and table["pvals"][1] < 1e-6
+
+    # Cross-products that drifted on one off-diagonal edge
+    stats, metadata = load_incremental_state(state_dir, "cwas")
+    edge = np.flatnonzero(edges)[0]
+    stats['xty'][:, edge] += 1
+    save_incremental_state(state_dir, "cwas", stats, metadata)
+
+    table, check = update()
+    assert not check["consistent"] and check["betas"] > 1e-3
+    full = glm_wrap_cc(str(tmpdir), conn[subjects], pheno.loc[subjects].reset_index(drop=True),
+                       group='diagnosis', case=1, control=0, regressors='age')
+    for column in ['betas', 'stand_betas', 'pvals']:
+        np.testing.assert_allclose(table[column][edges], full[column][edges], rtol=1e-6, atol=1e-10)
+
+    # The rebuilt cross-products are saved and agree with the refit
+    _, check = update()
+    assert check["consistent"]
@@ -0,0 +1,53 @@
+from cwas_rsfmri.phenotype import load_phenotype, validate_subject_ids
+import pandas as pd
+import pytest
+import os
+
+def write_phenotype(tmpdir):
+    df = pd.DataFrame({
+        "participant_id": ["sub-01", "sub-02", "sub-03", "sub-04", "sub-05"],
+        "diagnosis": ["HC", "NDD", "other", "NDD", "HC"],
+        "sex": ["F", "M", "M", "F", "F"],
+        "age": [30, 25, 40, -1, 50],
+        "scanner": ["Siemens", "GE", "GE", "Siemens", "GE"],
+        "unused": [1, 2, 3, 4, 5],
+    })
+    path = os.path.join(str(tmpdir), "phenotype.tsv")
+    df.to_csv(path, sep="\t", index=False)
+    return df, path
+
+def test_load_phenotype_encoding(tmpdir):
+    _, path = write_phenotype(tmpdir)
+    with pytest.warns(UserWarning):
+        df = load_phenotype(path, diagnosis_col="diagnosis", subject_col="participant_id", age_col="age",
+                            sex_col="sex", scanner_col=True, case_name="NDD", control_name="HC")
+
+    assert list(df["participant_id"]) == ["sub-01", "sub-02", "sub-04", "sub-05"]
+    # Case as 0, control as 1, sex coded in order of appearance
+    assert list(df["diagnosis"]) == [1, 0, 0, 1]
+    assert list(df["sex"]) == [0, 1, 0, 0]
+    assert all(isinstance(df[col].dtype, pd.CategoricalDtype) for col in ["diagnosis", "sex", "scanner"])
+    assert "unused" not in df
+
+    with pytest.raises(ValueError, match="Missing required columns"):
+        load_phenotype(path, diagnosis_col="group", subject_col="participant_id", age_col="age", sex_col="sex")
+
+def test_subject_ids(tmpdir):
+    df, _ = write_phenotype(tmpdir)
+    subject_file = os.path.join(str(tmpdir), "subjects.txt")
+    with open(subject_file, "w") as f:
+        f.write("01\n02\n03\n04\n")
+    with pytest.warns(UserWarning, match="sub-05"):
+        validate_subject_ids(df, subject_file)
+
+def test_parquet_phenotype(tmpdir):
+    pytest.importorskip("pyarrow")
+    df, path = write_phenotype(tmpdir)
+    parquet_path = path.replace(".tsv", ".parquet")
+    df.to_parquet(parquet_path)
+    with pytest.warns(UserWarning):
+        from_parquet = load_phenotype(parquet_path, diagnosis_col="diagnosis", subject_col="participant_id",
+                                      age_col="age", sex_col="sex", case_name="NDD", control_name="HC")
+        from_tsv = load_phenotype(path, diagnosis_col="diagnosis", subject_col="participant_id",
+                                  age_col="age", sex_col="sex", case_name="NDD", control_name="HC")
+    pd.testing.assert_frame_equal(from_parquet[from_tsv.columns], from_tsv)
@@ -0,0 +1,27 @@
+from cwas_rsfmri.plots import plot_connectome_results, roi_networks
+from cwas_rsfmri.triangle import ConnectomeTriangle
+import numpy as np
+
+def test_scalable_heatmap(tmpdir):
+    n_roi = 30
+    labels = [f"7Networks_LH_{net}_{i}" for i, net in enumerate(np.repeat(["Vis", "SomMot", "Default"], 10))]
+    triangle = ConnectomeTriangle(n_roi)
+    rng = np.random.default_rng(0)
+    betas = rng.normal(size=triangle.n_edges)
+    pvals = np.where(rng.uniform(size=triangle.n_edges) < 0.05, 0.001, 0.5)
+
+    assert list(np.unique(roi_networks(labels))) == ["Default", "SomMot", "Vis"]
+    assert len(np.unique(roi_networks([f"Region{i}" for i in range(45)]))) == 15
+
+    path = plot_connectome_results(str(tmpdir), betas, pvals, labels, triangle, mode="scalable")
+    with open(path) as f:
+        html = f.read()
+    # Matrices are embedded as binary typed arrays, with one dropdown entry per network pair
+    assert '"bdata"' in html
+    assert html.count('"method":"update"') == 1 + 6
+    assert "significant edges (FDR)" in html
+
+    # Significant edges are named after the correction of the p-values given
+    path = plot_connectome_results(str(tmpdir), betas, pvals, labels, triangle, mode="full", correction="FWER")
+    with open(path) as f:
+        assert "with FWER correction" in f.read()
@@ -0,0 +1,86 @@
+from cwas_rsfmri.synthetic import generate_bids_dataset, write_subject
+from cwas_rsfmri.bids_index import index_bids_derivatives, find_connectome_runs, find_confounds_runs
+from cwas_rsfmri.reject_fd_qc import read_fd_table
+from cwas_rsfmri.connectome import process_connectivity_matrix, read_connectome
+from cwas_rsfmri.runs import aggregate_runs
+from cwas_rsfmri.triangle import ConnectomeTriangle
+from cwas_rsfmri.workflow import run_pipeline
+import numpy as np
+import pandas as pd
+import json
+import os
+
+def test_runs_are_averaged_by_subject(tmpdir):
+    dataset = generate_bids_dataset(os.path.join(str(tmpdir), "bids"), n_subjects=40, n_rois=8,
+                                    high_motion_fraction=0, seed=3)
+    pheno = pd.read_csv(dataset["phenotype_file"], sep="\t")
+    subjects = list(pheno["participant_id"])
+    names = {name: dataset[name] for name in ["session", "task", "run", "atlas", "feature"]}
+    mean = ConnectomeTriangle(8).pack(np.full((8, 8), 0.2))
+    # A second run for half of the subjects, and a third high-motion run for the first one
+    for i, sub in enumerate(subjects[:20]):
+        write_subject(dataset["bids_dir"], sub, dict(names, run="02"), 8, mean, np.zeros(len(mean), dtype=bool),
+                      0, 0.1, 0.2, seed=100 + i)
+    write_subject(dataset["bids_dir"], subjects[0], dict(names, run="03"), 8, mean, np.zeros(len(mean), dtype=bool),
+                  0, 0.1, 0.9, seed=99)
+
+    out_p = os.path.join(str(tmpdir), "runs")
+    os.makedirs(out_p)
+    bids_index = index_bids_derivatives(dataset["bids_dir"])
+    connectome_runs = find_connectome_runs(bids_index, subjects, names["session"], names["task"], "all",
+                                           names["atlas"], names["feature"])
+    fd_runs = read_fd_table(find_confounds_runs(bids_index, subjects, names["session"], names["task"], "all",
+                                                names["feature"])["path"])
+    assert len(connectome_runs) == 61
+    runs, fd_table = aggregate_runs(out_p, pheno, connectome_runs, fd_runs, weighting="volumes")
+    assert len(runs) == 60
+    with open(os.path.join(out_p, "cwas_report.json")) as f:
+        report = json.load(f)
+    assert report["Rejected runs"] == [f"{subjects[0]}_ses-{names['session']}_run-03"]
+    assert set(report["Runs per subject"][subjects[0]]) == {f"ses-{names['session']}_run-01",
+                                                           f"ses-{names['session']}_run-02"}
+
+    # Volume-weighted mean of the runs, and of their mean FD
+    pheno["mean_fd"] = pheno["participant_id"].map(fd_table["mean_fd"])
+    conn_stack, _ = process_connectivity_matrix(pheno, None, names["feature"], names["atlas"], None,
+                                                ConnectomeTriangle(8), None, None, None, runs=runs)
+    first = runs[runs["participant_id"] == subjects[0]]
+    expected = sum(w * read_connectome(path, ConnectomeTriangle(8)) for path, w in zip(first["path"], first["weight"]))
+    np.testing.assert_allclose(conn_stack[0], expected / first["weight"].sum())
+    np.testing.assert_allclose(pheno["mean_fd"][0], np.average(first["mean_fd"], weights=first["weight"]))
+    single = runs.loc[runs["participant_id"] == subjects[30], "path"].iloc[0]
+    np.testing.assert_allclose(conn_stack[30], read_connectome(single, ConnectomeTriangle(8)))
+
+    summary = run_pipeline(bids_dir=dataset["bids_dir"], output_dir=os.path.join(str(tmpdir), "output"),
+                           pheno_p=dataset["phenotype_file"], atlas_file=dataset["atlas_file"], atlas=names["atlas"],
+                           group="diagnosis", scanner=False, sequence=False, medication=False,
+                           case_name=dataset["case_name"], control_name=dataset["control_name"],
+                           session=names["session"], task=names["task"], run="all", feature=names["feature"],
+                           run_weights="fd", max_memory="1M")
+    assert summary["n_subjects"] == 40
+
+def test_volume_weights_from_halfpipe_outputs(tmpdir):
+    # Confounds JSON as written by HALFpipe (no total number of volumes) and the timeseries next to it
+    runs = {"sub-01_ses-1_run-01": (280, 12, 0.2), "sub-01_ses-1_run-02": (140, 3, 0.3),
+            "sub-02_ses-1_run-01": (200, 0, 0.1)}
+    paths = {}
+    for label, (n_rows, n_scrubbed, mean_fd) in runs.items():
+        path = os.path.join(str(tmpdir), f"{label}_task-rest_desc-denoiseSimple_timeseries.json")
+        with open(path, "w") as f:
+            json.dump({"ConfoundRegressors": ["cosine00", "rot_x", "rot_y", "rot_z"],
+                       "ICAAROMANoiseComponents": ["aroma_motion_01"],
+                       "NumberOfVolumesDiscardedByMotionScrubbing": n_scrubbed,
+                       "NumberOfVolumesDiscardedByNonsteadyStatesDetector": 2,
+                       "MeanFramewiseDisplacement": mean_fd,
+                       "SamplingFrequency": 0.5}, f, indent=6)
+        np.savetxt(path.replace(".json", ".tsv"), np.zeros((n_rows, 4)), delimiter="\t")
+        paths[label] = path
+
+    fd_runs = read_fd_table(pd.Series(paths))
+    assert list(fd_runs["n_volumes"]) == [294, 145, 202]
+    connectome_runs = pd.DataFrame({"participant_id": [label[:6] for label in runs], "path": list(paths.values())},
+                                   index=list(runs))
+    pheno = pd.DataFrame({"participant_id": ["sub-01", "sub-02"]})
+    selected, fd_table = aggregate_runs(str(tmpdir), pheno, connectome_runs, fd_runs, weighting="volumes")
+    assert list(selected["weight"]) == [280, 140, 200]
+    np.testing.assert_allclose(fd_table.loc["sub-01", "mean_fd"], (280 * 0.2 + 140 * 0.3) / 420)
@@ -0,0 +1,27 @@
+from cwas_rsfmri.synthetic import generate_bids_dataset
+from cwas_rsfmri.workflow import run_pipeline, run_merge_shards
+import pandas as pd
+import pytest
+import glob
+import os
+
+def test_merged_shards_match_full_run(tmpdir):
+    dataset = generate_bids_dataset(os.path.join(str(tmpdir), "bids"), n_subjects=60, n_rois=12, seed=2)
+    options = dict(bids_dir=dataset["bids_dir"], pheno_p=dataset["phenotype_file"], atlas_file=dataset["atlas_file"],
+                   atlas=dataset["atlas"], group="diagnosis", scanner=False, sequence=False, medication=False,
+                   case_name=dataset["case_name"], control_name=dataset["control_name"], session=dataset["session"],
+                   task=dataset["task"], run=dataset["run"], feature=dataset["feature"], n_perm=100, seed=4)
+
+    full = run_pipeline(output_dir=os.path.join(str(tmpdir), "full"), **options)
+    for index in range(1, 4):
+        run_pipeline(output_dir=os.path.join(str(tmpdir), f"shard-{index}"), shard=f"{index}/3", **options)
+    shard_files = sorted(glob.glob(os.path.join(str(tmpdir), "shard-*", "*_shard-*of3.npz")))
+    assert len(shard_files) == 3
+
+    with pytest.raises(ValueError, match="Expected shards 1 to 3"):
+        run_merge_shards(shard_files[:2], os.path.join(str(tmpdir), "merged"))
+    merged = run_merge_shards(shard_files[::-1], os.path.join(str(tmpdir), "merged"))
+
+    assert merged["n_subjects"] == full["n_subjects"]
+    pd.testing.assert_frame_equal(pd.read_csv(merged["results_table"], sep="\t"),
+                                  pd.read_csv(full["results_table"], sep="\t"))
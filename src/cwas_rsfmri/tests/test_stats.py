@@ -0,0 +1,181 @@
+from cwas_rsfmri.stats import glm, glm_vectorized, glm_wrap_cc, glm_contrasts, build_design
+from cwas_rsfmri.files import parse_memory
+import os
+import numpy as np
+import pandas as pd
+import patsy as pat
+import statsmodels.api as sm
+
+def create_dummy_sample(n_sub=40, n_edges=25, seed=0):
+    rng = np.random.default_rng(seed)
+    pheno = pd.DataFrame({
+        "participant_id": [f"sub-{i:02d}" for i in range(n_sub)],
+        "diagnosis": rng.integers(0, 2, size=n_sub),
+        "sex": rng.integers(0, 2, size=n_sub),
+        "age": rng.uniform(18, 65, size=n_sub),
+        "mean_fd": rng.uniform(0.05, 0.45, size=n_sub),
+        "scanner": rng.choice(["Siemens", "Philips", "GE"], size=n_sub),
+    })
+    conn = rng.normal(size=(n_sub, n_edges))
+    conn[:, :5] += 0.8 * pheno["diagnosis"].values[:, None]
+    return pheno, conn
+
+def test_glm_vectorized_matches_statsmodels():
+    pheno, conn = create_dummy_sample()
+    dmat = pat.dmatrix('age + C(sex) + mean_fd + C(scanner) + C(diagnosis, Treatment(0))',
+                       pheno, return_type='dataframe')
+
+    betas_sm, pvals_sm = glm(conn, dmat, 'diagnosis')
+    betas_vec, pvals_vec = glm_vectorized(conn, dmat, 'diagnosis')
+
+    np.testing.assert_allclose(betas_vec, betas_sm, rtol=1e-8, atol=1e-12)
+    np.testing.assert_allclose(pvals_vec, pvals_sm, rtol=1e-6, atol=1e-12)
+
+def test_glm_wrap_cc_engines_agree(tmpdir):
+    pheno, conn = create_dummy_sample()
+    regressors = 'age + C(sex) + mean_fd'
+
+    table_sm = glm_wrap_cc(str(tmpdir), conn, pheno, group='diagnosis', case=1, control=0,
+                           regressors=regressors, engine='statsmodels')
+    table_vec = glm_wrap_cc(str(tmpdir), conn, pheno, group='diagnosis', case=1, control=0,
+                            regressors=regressors, engine='vectorized')
+
+    pd.testing.assert_frame_equal(table_vec, table_sm, rtol=1e-6)
+
+def test_glm_wrap_cc_robust_engines_agree(tmpdir):
+    pheno, conn = create_dummy_sample()
+    regressors = 'age + C(sex) + mean_fd'
+    # Heteroskedastic edges with an outlier subject
+    conn = conn * (1 + pheno[['diagnosis']].values)
+    conn[0] += 5
+
+    for robust in ['HC3', 'huber']:
+        table_sm = glm_wrap_cc(str(tmpdir), conn, pheno, group='diagnosis', case=1, control=0,
+                               regressors=regressors, engine='statsmodels', robust=robust)
+        table_vec = glm_wrap_cc(str(tmpdir), conn, pheno, group='diagnosis', case=1, control=0,
+                                regressors=regressors, engine='vectorized', robust=robust)
+        pd.testing.assert_frame_equal(table_vec, table_sm, rtol=1e-5)
+
+def test_glm_contrasts_match_statsmodels(tmpdir):
+    pheno, conn = create_dummy_sample(n_edges=30)
+    regressors = 'age + C(sex) + mean_fd + C(scanner)'
+    contrasts = {'age': 'age', 'scanner': 'scanner', 'dxage': 'diagnosis:age',
+                 'diff': 'age - mean_fd', 'weights': [0, 0, 0, 0, 1, 0, 0, 0]}
+
+    # Blocks of 7 edges, as with a memory budget
+    tables = glm_contrasts(str(tmpdir), conn, pheno, 'diagnosis', 1, 0, contrasts, regressors=regressors,
+                           extra_terms='C(diagnosis):age', max_memory=len(pheno) * 8 * 6 * 7)
+    _, _, dmat = build_design(pheno, 'diagnosis', 1, 0, regressors + ' + C(diagnosis):age')
+
+    assert list(tables['scanner'].columns) == ['fvals', 'stand_betas', 'pvals']
+    for edge in range(conn.shape[1]):
+        results = sm.OLS(conn[:, edge], dmat).fit()
+        np.testing.assert_allclose(tables['age'].tvals[edge], results.tvalues['age'], rtol=1e-8)
+        np.testing.assert_allclose(tables['dxage'].pvals[edge], results.pvalues['C(diagnosis)[T.1]:age'], rtol=1e-8)
+        np.testing.assert_allclose(tables['diff'].pvals[edge], results.t_test('age - mean_fd').pvalue, rtol=1e-8)
+        np.testing.assert_allclose(tables['weights'].betas[edge], results.params.iloc[4], rtol=1e-8)
+        f_test = results.f_test('C(scanner)[T.Philips] = 0, C(scanner)[T.Siemens] = 0')
+        np.testing.assert_allclose(tables['scanner'].fvals[edge], f_test.fvalue, rtol=1e-8)
+        np.testing.assert_allclose(tables['scanner'].pvals[edge], f_test.pvalue, rtol=1e-8)
+
+def test_glm_wrap_cc_chunked_matches_in_memory(tmpdir):
+    pheno, conn = create_dummy_sample(n_edges=103)
+    regressors = 'age + C(sex) + mean_fd'
+
+    stack_path = os.path.join(str(tmpdir), 'conn_stack.npy')
+    conn_disk = np.lib.format.open_memmap(stack_path, mode='w+', dtype=np.float64, shape=conn.shape)
+    conn_disk[:] = conn
+
+    table = glm_wrap_cc(str(tmpdir), conn, pheno, group='diagnosis', case=1, control=0,
+                        regressors=regressors)
+    table_chunked = glm_wrap_cc(str(tmpdir), conn_disk, pheno, group='diagnosis', case=1, control=0,
+                                regressors=regressors, max_memory=parse_memory('20K'))
+
+    pd.testing.assert_frame_equal(table_chunked, table)
+
+def test_glm_wrap_cc_fwer_permutations(tmpdir):
+    pheno, conn = create_dummy_sample(n_edges=60)
+    conn[:, 0] += 3 * pheno["diagnosis"].values
+    regressors = 'age + C(sex) + mean_fd'
+
+    table = glm_wrap_cc(str(tmpdir), conn, pheno, group='diagnosis', case=1, control=0,
+                        regressors=regressors, n_perm=200, seed=7, n_jobs=2)
+    table_again = glm_wrap_cc(str(tmpdir), conn, pheno, group='diagnosis', case=1, control=0,
+                              regressors=regressors, n_perm=200, seed=7, max_memory=parse_memory('200K'))
+
+    np.testing.assert_array_equal(table['pvals_fwer'], table_again['pvals_fwer'])
+    assert table['pvals_fwer'].iloc[0] < 0.05
+    assert np.all(table['pvals_fwer'] >= table['pvals'] - 1e-12)
+
+def test_glm_wrap_cc_nbs(tmpdir):
+    from cwas_rsfmri.triangle import ConnectomeTriangle
+    from cwas_rsfmri.permutation import edge_components
+    from cwas_rsfmri.stats import nbs_component_table
+
+    # Components of a small graph: 0-1-2 and 3-4, ROI 5 isolated
+    triangle = ConnectomeTriangle(6)
+    edge_index = {(r, c): i for i, (r, c) in enumerate(zip(triangle.rows, triangle.cols))}
+    labels, sizes = edge_components([edge_index[(1, 0)], edge_index[(4, 3)], edge_index[(2, 1)]], triangle)
+    assert labels[0] == labels[2] != labels[1]
+    assert sorted(sizes) == [1, 2]
+
+    # Effect on every edge between the first 4 ROIs of a 12 ROI atlas
+    triangle = ConnectomeTriangle(12)
+    pheno, conn = create_dummy_sample(n_sub=60, n_edges=triangle.n_edges)
+    conn[:, :5] -= 0.8 * pheno["diagnosis"].values[:, None]
+    conn[:, ~triangle.off_diagonal] = 1
+    planted = triangle.off_diagonal & (triangle.rows < 4)
+    conn[:, planted] += 1.5 * pheno["diagnosis"].values[:, None]
+
+    table = glm_wrap_cc(str(tmpdir), conn, pheno, group='diagnosis', case=1, control=0,
+                        regressors='age + C(sex) + mean_fd', n_perm=200, seed=1, n_jobs=2,
+                        nbs_threshold=3.0, conn_mask=triangle)
+    table_again = glm_wrap_cc(str(tmpdir), conn, pheno, group='diagnosis', case=1, control=0,
+                              regressors='age + C(sex) + mean_fd', n_perm=200, seed=1,
+                              nbs_threshold=3.0, conn_mask=triangle, max_memory=parse_memory('100K'))
+    pd.testing.assert_frame_equal(table, table_again)
+
+    assert table.loc[planted, 'nbs_component'].nunique() == 1
+    assert np.all(table.loc[planted, 'pvals_nbs'] < 0.05)
+    assert np.all(np.isnan(table.loc[table.nbs_component == 0, 'pvals_nbs']))
+
+    components = nbs_component_table(table, triangle, [f'roi{i}' for i in range(12)])
+    planted_component = components.loc[components.component == table.loc[planted, 'nbs_component'].iloc[0]].iloc[0]
+    assert planted_component.direction == 'positive' and planted_component.n_rois == 4
+    assert planted_component.rois == 'roi0,roi1,roi2,roi3'
+
+def test_save_glm_binary_outputs(tmpdir):
+    from cwas_rsfmri.triangle import ConnectomeTriangle
+    from cwas_rsfmri.stats import summarize_glm, save_glm, read_results
+
+    triangle = ConnectomeTriangle(8)
+    pheno, conn = create_dummy_sample(n_edges=triangle.n_edges)
+    conn[:, 3] += 2 * pheno["diagnosis"].values
+    glm_con = glm_wrap_cc(str(tmpdir), conn, pheno, group='diagnosis', case=1, control=0,
+                          regressors='age + C(sex) + mean_fd')
+    roi_labels = [f'roi{i}' for i in range(8)]
+    table_con, table_stand_beta, table_qval = summarize_glm(glm_con, triangle, roi_labels)
+
+    formats = ['tsv', 'npz']
+    try:
+        import pyarrow
+        formats.append('parquet')
+    except ImportError:
+        pass
+    for output_format in formats:
+        out_p = tmpdir.mkdir(output_format)
+        path = save_glm(str(out_p), table_con, table_stand_beta, table_qval, triangle, roi_labels,
+                        'NDD', 'HC', 'denoiseSimple', 'example', output_format=output_format)
+        assert path.endswith(f'.{output_format}')
+        assert os.path.exists(os.path.join(str(out_p), 'cwas_NDD_HC_rsfmri_denoiseSimple_example_standardized_betas.tsv')) \
+            == (output_format == 'tsv')
+        if output_format != 'tsv':
+            table, metadata = read_results(path)
+            pd.testing.assert_frame_equal(table, table_con)
+            assert metadata['roi_labels'] == roi_labels
+
+    # Significant edges, strongest effect first
+    edges = pd.read_csv(os.path.join(str(out_p), 'cwas_NDD_HC_rsfmri_denoiseSimple_example_significant_edges.tsv'), sep='\t')
+    assert len(edges) == (table_con.qval < 0.05).sum() > 0
+    assert edges.loc[0, 'edge'] == 3 and (edges.loc[0, 'roi_1'], edges.loc[0, 'roi_2']) == ('roi2', 'roi0')
+    assert np.all(np.diff(np.abs(edges.stand_betas)) <= 0)
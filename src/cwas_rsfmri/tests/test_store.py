@@ -0,0 +1,71 @@
+from cwas_rsfmri.store import update_connectome_store, open_connectome_store, store_key
+from cwas_rsfmri import connectome
+import pytest
+import numpy as np
+import os
+
+def test_store_reuses_and_updates_subjects(tmpdir, write_relmat):
+    n_roi = 5
+    conn_mask = np.tril(np.ones((n_roi, n_roi))).astype(bool)
+    subjects = [f"sub-{i:02d}" for i in range(4)]
+    paths = [os.path.join(str(tmpdir), f"{sub}_relmat.tsv") for sub in subjects]
+    mats = [write_relmat(p, n_roi, seed) for seed, p in enumerate(paths)]
+    store_dir = os.path.join(str(tmpdir), "store")
+
+    data, rows = update_connectome_store(store_dir, "example", subjects, paths, conn_mask)
+    np.testing.assert_array_equal(data[rows], np.array([m[conn_mask] for m in mats]))
+
+    # A modified file is re-read, the other rows are kept
+    mats[2] = write_relmat(paths[2], n_roi, seed=42)
+    os.utime(paths[2], ns=(0, 10 ** 9))
+    data, rows = update_connectome_store(store_dir, "example", subjects[1:], paths[1:], conn_mask)
+    np.testing.assert_array_equal(rows, [1, 2, 3])
+    np.testing.assert_array_equal(data[2], mats[2][conn_mask])
+
+    reopened, manifest = open_connectome_store(store_dir, "example")
+    assert manifest["subjects"] == subjects
+    np.testing.assert_array_equal(reopened[0], mats[0][conn_mask])
+
+def test_interrupted_rebuild_keeps_the_store(tmpdir, monkeypatch, write_relmat):
+    n_roi = 5
+    conn_mask = np.tril(np.ones((n_roi, n_roi))).astype(bool)
+    subjects = [f"sub-{i:02d}" for i in range(3)]
+    paths = [os.path.join(str(tmpdir), f"{sub}_relmat.tsv") for sub in subjects]
+    mats = [write_relmat(p, n_roi, seed) for seed, p in enumerate(paths)]
+    store_dir = os.path.join(str(tmpdir), "store")
+    update_connectome_store(store_dir, "example", subjects, paths, conn_mask)
+
+    # A new entry (other dtype) interrupted while its connectomes are read
+    def interrupt(*args, **kwargs):
+        raise KeyboardInterrupt
+    monkeypatch.setattr(connectome, "load_connectomes", interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        update_connectome_store(store_dir, "example", subjects, paths, conn_mask, dtype=np.float32)
+
+    reopened, manifest = open_connectome_store(store_dir, "example")
+    assert manifest["dtype"] == "float64"
+    np.testing.assert_array_equal(reopened[:], np.array([m[conn_mask] for m in mats]))
+
+def test_each_dtype_keeps_its_store_entry(tmpdir, monkeypatch, write_relmat):
+    n_roi = 5
+    conn_mask = np.tril(np.ones((n_roi, n_roi))).astype(bool)
+    subjects = [f"sub-{i:02d}" for i in range(3)]
+    paths = [os.path.join(str(tmpdir), f"{sub}_relmat.tsv") for sub in subjects]
+    mats = [write_relmat(p, n_roi, seed) for seed, p in enumerate(paths)]
+    store_dir = os.path.join(str(tmpdir), "store")
+    assert store_key("1", "rest", "01", "example", "simple") == "ses-1_task-rest_run-01_seg-example_desc-simple"
+    assert store_key("1", "rest", "01", "example", "simple", np.float64) == store_key("1", "rest", "01", "example", "simple")
+    keys = {dtype: store_key("1", "rest", "01", "example", "simple", dtype) for dtype in [np.float64, np.float32]}
+    assert keys[np.float32].endswith("_float32")
+
+    for dtype in [np.float64, np.float32]:
+        update_connectome_store(store_dir, keys[dtype], subjects, paths, conn_mask, dtype=dtype)
+
+    # Switching back and forth between precisions reads no relmat file again
+    def fail(*args, **kwargs):
+        raise AssertionError("connectomes were read again")
+    monkeypatch.setattr(connectome, "load_connectomes", fail)
+    for dtype in [np.float64, np.float32]:
+        data, rows = update_connectome_store(store_dir, keys[dtype], subjects, paths, conn_mask, dtype=dtype)
+        assert data.dtype == dtype
+        np.testing.assert_allclose(data[rows], np.array([m[conn_mask] for m in mats]), rtol=1e-6)
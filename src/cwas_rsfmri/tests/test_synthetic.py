@@ -0,0 +1,33 @@
+from cwas_rsfmri.synthetic import generate_bids_dataset
+from cwas_rsfmri.workflow import run_pipeline
+import pandas as pd
+import os
+
+def test_synthetic_dataset_recovers_planted_effects(tmpdir):
+    dataset = generate_bids_dataset(os.path.join(str(tmpdir), "bids"), n_subjects=120, n_rois=20,
+                                    effect_size=1.5, effect_fraction=0.1, high_motion_fraction=0.1, seed=1)
+    ground_truth = pd.read_csv(os.path.join(dataset["bids_dir"], "synthetic_ground_truth.tsv"), sep="\t")
+    assert len(ground_truth) == dataset["planted"].sum()
+
+    summary = run_pipeline(bids_dir=dataset["bids_dir"],
+                           output_dir=os.path.join(str(tmpdir), "output"),
+                           pheno_p=dataset["phenotype_file"],
+                           atlas_file=dataset["atlas_file"],
+                           atlas=dataset["atlas"],
+                           group="diagnosis",
+                           scanner=True,
+                           sequence=False,
+                           medication=False,
+                           case_name=dataset["case_name"],
+                           control_name=dataset["control_name"],
+                           session=dataset["session"],
+                           task=dataset["task"],
+                           run=dataset["run"],
+                           feature=dataset["feature"])
+
+    # High-motion subjects are rejected by the FD filter
+    assert summary["n_subjects"] < 120
+    table = pd.read_csv(summary["results_table"], sep="\t")
+    significant = table["pvals"].values < 0.05 / len(table)
+    assert significant[dataset["planted"]].mean() > 0.8
+    assert significant[~dataset["planted"]].mean() < 0.05
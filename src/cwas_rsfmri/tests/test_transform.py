@@ -0,0 +1,46 @@
+from cwas_rsfmri.transform import fisher_z, partial_correlation, tangent_space, check_transforms
+from cwas_rsfmri.triangle import ConnectomeTriangle
+import numpy as np
+import pytest
+
+def create_correlation_stack(n_sub=20, n_roi=8, n_vol=60, seed=0):
+    rng = np.random.default_rng(seed)
+    triangle = ConnectomeTriangle(n_roi)
+    timeseries = rng.normal(size=(n_sub, n_vol, n_roi))
+    timeseries[:, :, 1] += timeseries[:, :, 0]
+    matrices = np.array([np.corrcoef(ts.T) for ts in timeseries])
+    return triangle, matrices, triangle.pack(matrices)
+
+def test_fisher_z_in_place():
+    triangle, _, conn = create_correlation_stack()
+    expected = np.zeros_like(conn)
+    expected[:, triangle.off_diagonal] = np.arctanh(conn[:, triangle.off_diagonal])
+    out = fisher_z(conn, triangle, out=conn, max_memory=triangle.n_edges * 8 * 3 * 7)
+    assert out is conn
+    np.testing.assert_allclose(conn, expected)
+
+def test_partial_correlation_matches_precision():
+    triangle, matrices, conn = create_correlation_stack()
+    partial, n_projected = partial_correlation(conn, triangle, max_memory=triangle.n_roi ** 2 * 8 * 6 * 3)
+    assert n_projected == 0
+    for sub in range(len(matrices)):
+        precision = np.linalg.inv(matrices[sub])
+        expected = -precision / np.sqrt(np.outer(np.diag(precision), np.diag(precision)))
+        np.fill_diagonal(expected, 1)
+        np.testing.assert_allclose(partial[sub], triangle.pack(expected), atol=1e-10)
+
+def test_tangent_space_chunked():
+    triangle, _, conn = create_correlation_stack()
+    tangent, reference, _ = tangent_space(conn, triangle)
+    chunked, _, _ = tangent_space(conn, triangle, max_memory=triangle.n_roi ** 2 * 8 * 6 * 3)
+    np.testing.assert_allclose(chunked, tangent, atol=1e-8)
+    # At the geometric mean, the tangent vectors of the group average to zero
+    np.testing.assert_allclose(tangent.mean(axis=0), 0, atol=1e-6)
+    np.testing.assert_allclose(reference, reference.T)
+
+def test_check_transforms():
+    assert check_transforms(['partial', 'fisher_z']) == ['partial', 'fisher_z']
+    with pytest.raises(ValueError):
+        check_transforms(['fisher_z', 'tangent'])
+    with pytest.raises(ValueError):
+        check_transforms(['tangent', 'fisher_z'])
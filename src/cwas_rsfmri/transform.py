@@ -0,0 +1,195 @@
+import numpy as np
+
+from .triangle import as_triangle
+from .files import report_file
+
+# Connectome transforms, applied in the given order after the stack is built
+TRANSFORMS = ['fisher_z', 'partial', 'tangent']
+
+
+def check_transforms(transforms):
+    """
+    Fail before the analysis on unknown, repeated or meaningless sequences of transforms.
+    """
+    transforms = list(transforms or [])
+    unknown = [name for name in transforms if name not in TRANSFORMS]
+    if unknown:
+        raise ValueError(f"❌ Unknown connectome transform: {unknown}. Expected some of {TRANSFORMS}")
+    if len(set(transforms)) != len(transforms):
+        raise ValueError(f"❌ Each connectome transform can only be applied once: {transforms}")
+    # Partial correlations and tangent vectors are computed from correlation matrices
+    for name in ['partial', 'tangent']:
+        if name in transforms and transforms.index(name) != 0:
+            raise ValueError(f"❌ The {name} transform needs correlation matrices and must come first: {transforms}")
+    if 'partial' in transforms and 'tangent' in transforms:
+        raise ValueError("❌ Choose either partial correlations or tangent-space connectomes")
+    if transforms[1:] and transforms[0] == 'tangent':
+        raise ValueError("❌ Tangent-space connectomes are not correlations and cannot be transformed further")
+    return transforms
+
+
+def subject_chunk_size(n_roi, n_sub, max_memory=None, default=64):
+    """
+    Number of subjects whose full matrices are processed together within max_memory bytes.
+    """
+    if max_memory is None:
+        return min(default, max(n_sub, 1))
+    # Matrices, eigenvectors and the temporaries of their products
+    n_copies = 6
+    return int(min(max(max_memory // (n_roi * n_roi * 8 * n_copies), 1), max(n_sub, 1)))
+
+
+def map_eigenvalues(function, matrices, min_eigenvalue=None):
+    """
+    function applied to the eigenvalues of a stack of symmetric matrices. With min_eigenvalue,
+    eigenvalues are first raised to it (the closest positive definite matrices, e.g. for
+    correlations over fewer volumes than ROIs) and the matrices that needed it are flagged.
+    """
+    vals, vecs = np.linalg.eigh(matrices)
+    projected = None
+    if min_eigenvalue is not None:
+        projected = vals.min(axis=-1) < min_eigenvalue
+        vals = np.maximum(vals, min_eigenvalue)
+    mapped = (vecs * function(vals)[..., None, :]) @ np.swapaxes(vecs, -1, -2)
+    return mapped if min_eigenvalue is None else (mapped, projected)
+
+
+def fisher_z(conn, triangle, out=None, max_memory=None):
+    """
+    Fisher r-to-z of packed correlations (subjects x edges), block by block of subjects.
+    With out=conn the stack is transformed in place. The diagonal is set to 0.
+    """
+    triangle = as_triangle(triangle)
+    out = np.empty(conn.shape, dtype=conn.dtype) if out is None else out
+    # Elementwise: the block, its clipped copy and the result
+    chunk = conn.shape[0] if max_memory is None else max(max_memory // (triangle.n_edges * 8 * 3), 1)
+    eps = np.finfo(conn.dtype).eps
+    for start in range(0, conn.shape[0], chunk):
+        stop = min(start + chunk, conn.shape[0])
+        block = np.asarray(conn[start:stop], dtype=np.float64)
+        out[start:stop] = np.where(triangle.off_diagonal, np.arctanh(np.clip(block, -1 + eps, 1 - eps)), 0)
+    return out
+
+
+def partial_correlation(conn, triangle, out=None, max_memory=None, min_eigenvalue=1e-6):
+    """
+    Partial correlations from the packed correlation matrices, through the precision matrix
+    of each subject, in chunks of subjects. Returns the packed stack and the number of
+    matrices that were not positive definite and were projected first.
+    """
+    triangle = as_triangle(triangle)
+    out = np.empty(conn.shape, dtype=conn.dtype) if out is None else out
+    n_projected = 0
+    chunk = subject_chunk_size(triangle.n_roi, conn.shape[0], max_memory)
+    for start in range(0, conn.shape[0], chunk):
+        stop = min(start + chunk, conn.shape[0])
+        matrices = triangle.unpack(np.asarray(conn[start:stop], dtype=np.float64))
+        precision, projected = map_eigenvalues(lambda vals: 1 / vals, matrices, min_eigenvalue)
+        scale = np.sqrt(np.einsum('kii->ki', precision))
+        partial = -precision / scale[:, :, None] / scale[:, None, :]
+        partial[:, np.arange(triangle.n_roi), np.arange(triangle.n_roi)] = 1
+        out[start:stop] = triangle.pack(partial)
+        n_projected += int(projected.sum())
+    return out, n_projected
+
+
+def whitened_logs(conn, triangle, whitening, start, stop, min_eigenvalue):
+    """
+    logm of the whitened connectomes of a chunk of subjects. Matrices that are not positive
+    definite are projected in the whitened space, with one eigendecomposition per subject.
+    """
+    matrices = triangle.unpack(np.asarray(conn[start:stop], dtype=np.float64))
+    return map_eigenvalues(np.log, whitening @ matrices @ whitening, min_eigenvalue)
+
+
+def geometric_mean(conn, triangle, max_memory=None, max_iter=10, tol=1e-7, min_eigenvalue=1e-6):
+    """
+    Geometric (Riemannian) mean of the connectomes, the reference point of the tangent space.
+    Gradient descent from the arithmetic mean, as nilearn; each step is one pass over
+    chunks of subjects, so the full matrices of all subjects are never held together.
+    """
+    triangle = as_triangle(triangle)
+    n_sub = conn.shape[0]
+    chunk = subject_chunk_size(triangle.n_roi, n_sub, max_memory)
+    chunks = [(start, min(start + chunk, n_sub)) for start in range(0, n_sub, chunk)]
+
+    mean = sum(np.asarray(conn[start:stop], dtype=np.float64).sum(axis=0) for start, stop in chunks) / n_sub
+    gmean, _ = map_eigenvalues(lambda vals: vals, triangle.unpack(mean), min_eigenvalue)
+    norm_old, step = np.inf, 1.0
+    for _ in range(max_iter):
+        vals, vecs = np.linalg.eigh(gmean)
+        whitening = (vecs / np.sqrt(vals)) @ vecs.T
+        logs_mean = sum(whitened_logs(conn, triangle, whitening, start, stop, min_eigenvalue)[0].sum(axis=0)
+                        for start, stop in chunks) / n_sub
+        if np.isnan(logs_mean).any():
+            raise FloatingPointError("❌ NaN in the logarithm of the whitened connectomes")
+
+        # Move along the geodesic towards the mean of the tangent vectors
+        gmean_sqrt = (vecs * np.sqrt(vals)) @ vecs.T
+        gmean = gmean_sqrt @ map_eigenvalues(np.exp, logs_mean * step) @ gmean_sqrt
+
+        norm = np.linalg.norm(logs_mean)
+        if norm < norm_old:
+            norm_old = norm
+        elif norm > norm_old:
+            step = step / 2
+            norm = norm_old
+        if norm / gmean.size < tol:
+            break
+    return gmean
+
+
+def tangent_space(conn, triangle, out=None, reference=None, max_memory=None, min_eigenvalue=1e-6):
+    """
+    Tangent-space connectomes: logm(R^-1/2 C R^-1/2) of each subject, with R the geometric mean
+    of the group (or a reference matrix from another sample). Returns the packed stack,
+    the reference and the number of matrices projected to positive definite ones.
+    """
+    triangle = as_triangle(triangle)
+    if reference is None:
+        reference = geometric_mean(conn, triangle, max_memory=max_memory, min_eigenvalue=min_eigenvalue)
+    vals, vecs = np.linalg.eigh(reference)
+    whitening = (vecs / np.sqrt(vals)) @ vecs.T
+
+    out = np.empty(conn.shape, dtype=conn.dtype) if out is None else out
+    n_projected = 0
+    chunk = subject_chunk_size(triangle.n_roi, conn.shape[0], max_memory)
+    for start in range(0, conn.shape[0], chunk):
+        stop = min(start + chunk, conn.shape[0])
+        tangent, projected = whitened_logs(conn, triangle, whitening, start, stop, min_eigenvalue)
+        out[start:stop] = triangle.pack(tangent)
+        n_projected += int(projected.sum())
+    return out, reference, n_projected
+
+
+def transform_connectomes(out_p, conn, triangle, transforms, out=None, max_memory=None, reference_path=None):
+    """
+    Apply the transforms in order to the packed stack, writing into out (conn itself for an
+    in-place Fisher z). The tangent-space reference is saved as a packed vector in reference_path.
+    """
+    triangle = as_triangle(triangle)
+    transforms = check_transforms(transforms)
+    out = np.empty(conn.shape, dtype=conn.dtype) if out is None else out
+    summary_data = {'connectome transforms': transforms}
+    source = conn
+    for name in transforms:
+        print(f"\n⏳ Connectome transform: {name} ({conn.shape[0]} subjects, {triangle.n_roi} ROIs) ...")
+        if name == 'fisher_z':
+            fisher_z(source, triangle, out=out, max_memory=max_memory)
+        elif name == 'partial':
+            _, n_projected = partial_correlation(source, triangle, out=out, max_memory=max_memory)
+            summary_data['partial correlation projected matrices'] = n_projected
+        else:
+            _, reference, n_projected = tangent_space(source, triangle, out=out, max_memory=max_memory)
+            summary_data['tangent space projected matrices'] = n_projected
+            if reference_path is not None:
+                np.save(reference_path, triangle.pack(reference))
+                summary_data['tangent space reference'] = reference_path
+        # The next transforms work on the output, in place
+        source = out
+
+    for key in ['partial correlation projected matrices', 'tangent space projected matrices']:
+        if summary_data.get(key):
+            print(f"❗️ {summary_data[key]} connectomes were not positive definite and were projected first")
+    report_file(out_p, summary_data)
+    return out
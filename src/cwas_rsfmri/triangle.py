@@ -0,0 +1,67 @@
+import numpy as np
+
+
+class ConnectomeTriangle:
+    """
+    Packed lower triangle (diagonal included) of n_roi x n_roi connectomes.
+    The index arrays are computed once and reused to pack and unpack every matrix,
+    in the same edge order as a np.tril boolean mask.
+    """
+
+    def __init__(self, n_roi, dtype=np.float64):
+        self.n_roi = int(n_roi)
+        self.dtype = np.dtype(dtype)
+        if self.dtype not in (np.dtype(np.float32), np.dtype(np.float64)):
+            raise ValueError(f"❌ Connectomes are stored as float32 or float64, not {self.dtype}")
+        self.rows, self.cols = np.tril_indices(self.n_roi)
+        self.n_edges = len(self.rows)
+        self.off_diagonal = self.rows != self.cols
+
+    @property
+    def shape(self):
+        return (self.n_roi, self.n_roi)
+
+    def __repr__(self):
+        return f"ConnectomeTriangle(n_roi={self.n_roi}, n_edges={self.n_edges}, dtype={self.dtype.name})"
+
+    def pack(self, matrix):
+        """
+        Lower triangle of a full matrix as a packed vector (or of a stack of matrices as rows).
+        """
+        return np.asarray(matrix)[..., self.rows, self.cols].astype(self.dtype, copy=False)
+
+    def unpack(self, values, dtype=None):
+        """
+        Full symmetric matrix of a packed vector (or stack of matrices of packed rows).
+        """
+        values = np.asarray(values)
+        matrix = np.zeros(values.shape[:-1] + self.shape, dtype=dtype or values.dtype)
+        matrix[..., self.rows, self.cols] = values
+        matrix[..., self.cols, self.rows] = values
+        return matrix
+
+    def upper(self, values, fill=np.nan):
+        """
+        Matrix with the packed values in the upper triangle only (diagonal excluded).
+        """
+        values = np.asarray(values)
+        matrix = np.full(self.shape, fill, dtype=np.result_type(values.dtype, np.float32))
+        matrix[self.cols[self.off_diagonal], self.rows[self.off_diagonal]] = values[self.off_diagonal]
+        return matrix
+
+
+def as_triangle(conn_mask, dtype=None):
+    """
+    ConnectomeTriangle of a lower-triangle boolean mask, as built by np.tril.
+    A ConnectomeTriangle is returned as is, or with a new dtype.
+    """
+    if isinstance(conn_mask, ConnectomeTriangle):
+        if dtype is None or np.dtype(dtype) == conn_mask.dtype:
+            return conn_mask
+        return ConnectomeTriangle(conn_mask.n_roi, dtype=dtype)
+
+    conn_mask = np.asarray(conn_mask, dtype=bool)
+    if conn_mask.ndim != 2 or conn_mask.shape[0] != conn_mask.shape[1] \
+            or not np.array_equal(conn_mask, np.tril(np.ones(conn_mask.shape, dtype=bool))):
+        raise ValueError("❌ The connectome mask must be the lower triangle of a square matrix")
+    return ConnectomeTriangle(conn_mask.shape[0], dtype=dtype or np.float64)
@@ -1,90 +1,497 @@
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
 from cwas_rsfmri.phenotype import load_phenotype
 from cwas_rsfmri.subject import find_valid_subjects
-from cwas_rsfmri.reject_fd_qc import filter_by_fd 
-from cwas_rsfmri.connectome import process_connectivity_matrix
-from cwas_rsfmri.plots import plot_interactive_matrix
+from cwas_rsfmri.reject_fd_qc import filter_by_fd, read_mean_fd
+from cwas_rsfmri.connectome import process_connectivity_matrix, find_connectome_paths
+from cwas_rsfmri.federated import (site_sufficient_stats, save_sufficient_stats, load_sufficient_stats,
+                                  merge_sufficient_stats, glm_sufficient_stats)
+from cwas_rsfmri.shards import shard_edges, save_shard, load_shard, merge_shards
+from cwas_rsfmri.harmonization import combat_harmonize
+from cwas_rsfmri.transform import transform_connectomes, check_transforms
+from cwas_rsfmri.runs import aggregate_runs
+from cwas_rsfmri.incremental import update_incremental
+from cwas_rsfmri.plots import plot_connectome_results
+from cwas_rsfmri.bids_index import (index_bids_derivatives, find_connectome_files, find_confounds_files,
+                                    find_connectome_runs, find_confounds_runs, aggregates_runs)
+from cwas_rsfmri.checkpoint import cached_stage, file_signature
+from cwas_rsfmri.store import store_key
+from cwas_rsfmri.triangle import ConnectomeTriangle
+from cwas_rsfmri.profiling import profile_stage, print_profile
+from cwas_rsfmri.plan import expand_grid
 from cwas_rsfmri.stats import *
 from cwas_rsfmri.files import *
 
-def run_pipeline(bids_dir, output_dir, pheno_p, atlas_file, atlas, group,
-                scanner, sequence, medication, case_name, control_name, 
-                session, task, run, feature): 
+def prepare_shared_inputs(bids_dir, output_dir, pheno_p, group, scanner, sequence, medication,
+                          case_name, control_name, bids_index_cache=None, checkpoint=False, cprofile_stages=(),
+                          fd_cache=None):
+    """
+    Work shared by every analysis of a run: BIDS validation and index, phenotype loading.
+    With checkpoint, stage outputs are saved in output_dir/cache and reused by later runs.
+    """
+    profile = {}
+    with profile_stage(profile, 'bids_index', output_dir, cprofile_stages) as counts:
+        bids_validation(bids_dir=bids_dir)
 
-    bids_validation(bids_dir=bids_dir)
+        create_output_directory(output_dir)
 
-    create_output_directory(output_dir)
+        dict_halfpipe = find_bids_output(bids_dir)
+
+        # Walk the BIDS tree once, all stages resolve their files from this index
+        bids_index = index_bids_derivatives(bids_dir, cache_path=bids_index_cache)
+        counts['files'] = len(bids_index)
 
-    dict_halfpipe = find_bids_output(bids_dir)
+    cache_dir = os.path.join(output_dir, 'cache') if checkpoint else None
 
     # Verify the phenotype file
-    df = load_phenotype(pheno_p,
-                        diagnosis_col=group,
-                        subject_col="participant_id",
-                        age_col="age",
-                        sex_col="sex",
-                        scanner_col=scanner,
-                        sequence=sequence, medication=medication,
-                        case_name=case_name, control_name=control_name,
-                        )
-  
+    with profile_stage(profile, 'phenotype', output_dir, cprofile_stages) as counts:
+        df, pheno_key = cached_stage(cache_dir, 'phenotype',
+                                     [file_signature([pheno_p]), group, scanner, sequence, medication,
+                                      case_name, control_name],
+                                     lambda: load_phenotype(pheno_p,
+                                                            diagnosis_col=group,
+                                                            subject_col="participant_id",
+                                                            age_col="age",
+                                                            sex_col="sex",
+                                                            scanner_col=scanner,
+                                                            sequence=sequence, medication=medication,
+                                                            case_name=case_name, control_name=control_name,
+                                                            ))
+        counts['subjects'] = len(df)
+
+    return {
+        "cache_dir": cache_dir,
+        "pheno_key": pheno_key,
+        "bids_dir": bids_dir,
+        "dict_halfpipe": dict_halfpipe,
+        "bids_index": bids_index,
+        "pheno": df,
+        "regressors": define_regressors(scanner, sequence, medication),
+        "profile": profile,
+        "cprofile_stages": cprofile_stages,
+        "fd_cache": fd_cache,
+        # Filled by the analyses and reused by the next ones
+        "atlases": {},
+        "fd_tables": {},
+        "design_cache": {},
+        "lock": threading.Lock(),
+    }
+
+def get_shared(shared, cache_name, key, compute):
+    """
+    Compute a shared result once, even when analyses run concurrently.
+    The lock only guards the creation of the entry: the first analysis computes it while
+    the others wait on its future, and analyses needing other keys are not blocked.
+    """
+    with shared["lock"]:
+        future = shared[cache_name].get(key)
+        owner = future is None
+        if owner:
+            future = shared[cache_name][key] = Future()
+    if owner:
+        try:
+            future.set_result(compute())
+        except BaseException as e:
+            future.set_exception(e)
+    return future.result()
+
+def save_profile(output_dir, shared, profile):
+    """
+    Stage measurements of an analysis, in the profile section of cwas_report.json.
+    """
+    print_profile(profile)
+    report_file(output_dir, {'profile': {'shared': shared["profile"], 'stages': profile}})
+
+def run_analysis(shared, output_dir, atlas_file, atlas, group, case_name, control_name,
+                 session, task, run, feature, glm_engine="vectorized", max_memory=None,
+                 store_dir=None, n_jobs=1, n_perm=0, seed=None, site_name=None, dtype="float64",
+                 plot_mode="auto", fd_threshold=0.5, max_percent_scrubbed=None, nbs_threshold=None, shard=None,
+                 output_format="tsv", robust=None, combat=False, combat_params=None,
+                 contrasts=None, extra_terms="", transforms=None, run_weights="equal",
+                 incremental_dir=None, incremental_check=False):
+    """
+    CWAS for one session, task, run, atlas and feature.
+    With site_name, only the sufficient statistics of the site GLM are exported
+    for a federated analysis (see run_merge_sites). Connectomes are stored with dtype
+    (float32 halves the memory of the stack), the GLM is always fitted in float64.
+    Wall time, CPU time, peak RSS and item counts of each stage are saved in cwas_report.json.
+    With shard (index, count), only that slice of the edges is fitted and saved for run_merge_shards.
+    robust selects HC0-HC3 standard errors or the Huber M-estimator instead of plain OLS.
+    With combat, scanner effects are removed from the connectomes by ComBat before the GLM,
+    with the parameters fitted here or read from combat_params.
+    contrasts (name -> spec, see stats.contrast_matrix) are tested on top of the diagnosis effect,
+    in one pass with the regressors and extra_terms, and saved with a _contrast-{name} suffix.
+    transforms (fisher_z, partial, tangent) are applied to the connectome stack before harmonization.
+    With session or run 'all', the connectomes of every session or run of a subject are averaged,
+    weighted by run_weights (equal, volumes, fd), after rejecting the high-motion runs.
+    With incremental_dir, the OLS cross-products of the previous update are kept there and only
+    the subjects added or excluded since then are read (see incremental.update_incremental).
+    """
+    shard = parse_shard(shard)
+    check_output_format(output_format)
+    if shard is not None and n_perm and (seed is None or nbs_threshold is not None):
+        raise ValueError("❌ Sharded permutations need a seed, shared by all shards, and do not support the NBS")
+    if robust is not None and site_name is not None:
+        raise ValueError("❌ Site statistics are OLS cross-products and cannot be combined with robust estimation")
+    combat = combat or combat_params is not None
+    if combat and site_name is not None:
+        raise ValueError("❌ ComBat needs the connectomes of all sites and cannot be combined with site statistics")
+    if contrasts and (site_name is not None or shard is not None):
+        raise ValueError("❌ Contrasts are only tested in a full analysis, not with site statistics or shards")
+    transforms = check_transforms(transforms)
+    if transforms and site_name is not None:
+        raise ValueError("❌ Connectome transforms need the connectome stack and cannot be combined with site statistics")
+    aggregate = aggregates_runs(session, run)
+    if aggregate and (site_name is not None or store_dir is not None):
+        raise ValueError("❌ Runs are only aggregated from the relmat files, not with site statistics or the connectome store")
+    if incremental_dir is not None:
+        unsupported = [name for name, used in [('site statistics', site_name is not None), ('shards', shard is not None),
+                                               ('permutations', n_perm), ('robust estimation', robust is not None),
+                                               ('ComBat', combat), ('contrasts', contrasts), ('transforms', transforms),
+                                               ('run aggregation', aggregate)] if used]
+        if unsupported:
+            raise ValueError(f"❌ Incremental updates keep OLS cross-products and cannot be combined with {unsupported}")
+    bids_dir = shared["bids_dir"]
+    dict_halfpipe = shared["dict_halfpipe"]
+    bids_index = shared["bids_index"]
+    create_output_directory(output_dir)
+    profile = {}
+    cprofile_stages = shared["cprofile_stages"]
+
     # Verify atlas location and format
-    conn_mask, roi_labels = verify_atlas_files(atlas_file)
-
-    # Find number of subjects
-    df_filtered = find_valid_subjects(
-        bids_dir=bids_dir,
-        pheno=df,
-        session=session,
-        connectome_t=dict_halfpipe['connectome_t'],
-        run=run,
-        task=task,
-        atlas=atlas,
-        feature=feature,
-        out_p=output_dir
-        )
-
-    # Reject subject based on FD>0.5
-    pheno_filtered_qc_fd = filter_by_fd(
-        pheno_filtered_qc=df_filtered,
-        derivatives_p=bids_dir,
-        confounds_json=dict_halfpipe['confounds_json'],
-        out_p=output_dir,
-        session=session,
-        task=task,
-        run=run,
-        feature=feature
-        )
-
-    # Define regressors
-    regressors = define_regressors(scanner, sequence, medication)
-
-    # Process connectivity matrix
-    conn_stack, final_df = process_connectivity_matrix(
-        pheno_filtered_fd=pheno_filtered_qc_fd,
-        connectome_t=dict_halfpipe['connectome_t'],
-        feature=feature,
-        atlas=atlas,
-        bids_dir=bids_dir,
-        conn_mask=conn_mask,
-        session=session, 
-        task=task,
-        run=run
-        )
+    with profile_stage(profile, 'atlas', output_dir, cprofile_stages) as counts:
+        conn_mask, roi_labels = get_shared(shared, "atlases", (atlas_file, dtype),
+                                           lambda: verify_atlas_files(atlas_file, dtype=dtype))
+        counts['rois'] = conn_mask.n_roi
+
+    cache_dir = shared["cache_dir"]
+    pheno = shared["pheno"]
+
+    # Find number of subjects; find_valid_subjects starts a new report, also when its checkpoint is reused
+    with profile_stage(profile, 'subjects', output_dir, cprofile_stages) as counts:
+        report_path = os.path.join(output_dir, 'cwas_report.json')
+        if os.path.exists(report_path):
+            os.remove(report_path)
+        connectome_files = find_connectome_files(bids_index, pheno['participant_id'], session, task, run, atlas, feature)
+        df_filtered, subjects_key = cached_stage(
+            cache_dir, 'subjects',
+            [shared["pheno_key"], session, task, run, atlas, feature, sorted(connectome_files.index)],
+            lambda: find_valid_subjects(
+                bids_dir=bids_dir,
+                pheno=pheno,
+                session=session,
+                connectome_t=dict_halfpipe['connectome_t'],
+                run=run,
+                task=task,
+                atlas=atlas,
+                feature=feature,
+                out_p=output_dir,
+                bids_index=bids_index
+                ), report_dir=output_dir)
+        counts['subjects'] = len(df_filtered)
+
+    # The FD table only depends on the confounds files, not on the atlas
+    with profile_stage(profile, 'fd_table', output_dir, cprofile_stages) as counts:
+        if aggregate:
+            confounds_files = find_confounds_runs(bids_index, pheno['participant_id'], session, task, run, feature)['path']
+        else:
+            confounds_files = find_confounds_files(bids_index, pheno['participant_id'], session, task, run, feature)
+        fd_table, fd_key = get_shared(shared, "fd_tables", (session, task, run, feature), lambda: cached_stage(
+            cache_dir, 'fd_table',
+            [session, task, run, feature, file_signature(confounds_files.sort_index())],
+            lambda: read_mean_fd(pheno, bids_dir, dict_halfpipe['confounds_json'],
+                                 session, task, run, feature, bids_index=bids_index,
+                                 n_jobs=n_jobs, cache_path=shared["fd_cache"])))
+        counts['files'] = len(confounds_files)
+
+    # Several sessions or runs: reject the high-motion runs and weight the others
+    runs = None
+    if aggregate:
+        with profile_stage(profile, 'runs', output_dir, cprofile_stages) as counts:
+            connectome_runs = find_connectome_runs(bids_index, pheno['participant_id'], session, task, run, atlas, feature)
+            runs, fd_table = aggregate_runs(output_dir, df_filtered, connectome_runs, fd_table, weighting=run_weights,
+                                            fd_threshold=fd_threshold, max_percent_scrubbed=max_percent_scrubbed)
+            counts.update(files=len(connectome_runs), subjects=len(fd_table))
+
+    # Reject subject based on mean FD and scrubbing
+    with profile_stage(profile, 'fd_filter', output_dir, cprofile_stages) as counts:
+        pheno_filtered_qc_fd = filter_by_fd(
+            pheno_filtered_qc=df_filtered,
+            derivatives_p=bids_dir,
+            confounds_json=dict_halfpipe['confounds_json'],
+            out_p=output_dir,
+            session=session,
+            task=task,
+            run=run,
+            feature=feature,
+            bids_index=bids_index,
+            fd_table=fd_table,
+            fd_threshold=fd_threshold,
+            max_percent_scrubbed=max_percent_scrubbed
+            )
+        counts['subjects'] = len(pheno_filtered_qc_fd)
+
+    # Federated mode: connectomes are streamed into cross-products and never stacked
+    if site_name is not None:
+        with profile_stage(profile, 'site_stats', output_dir, cprofile_stages) as counts:
+            summary = export_site_stats(output_dir, pheno_filtered_qc_fd, dict_halfpipe['connectome_t'], bids_dir,
+                                        bids_index, conn_mask, roi_labels, group, case_name, control_name,
+                                        session, task, run, atlas, feature, shared["regressors"], site_name,
+                                        n_jobs=n_jobs, max_memory=max_memory)
+            counts.update(subjects=summary["n_subjects"], edges=summary["n_edges"], files=summary["n_subjects"])
+        save_profile(output_dir, shared, profile)
+        return summary
+
+    # Incremental mode: the cross-products of the previous update are corrected for the subjects that changed
+    if incremental_dir is not None:
+        with profile_stage(profile, 'incremental', output_dir, cprofile_stages) as counts:
+            summary = export_incremental(output_dir, pheno_filtered_qc_fd, dict_halfpipe['connectome_t'], bids_dir,
+                                         bids_index, conn_mask, roi_labels, atlas_file, group, case_name,
+                                         control_name, session, task, run, atlas, feature, shared["regressors"],
+                                         incremental_dir, check=incremental_check, n_jobs=n_jobs,
+                                         max_memory=max_memory, plot_mode=plot_mode, output_format=output_format)
+            counts.update(subjects=summary["n_subjects"], edges=summary["n_edges"], files=summary["files_read"])
+        save_profile(output_dir, shared, profile)
+        return summary
+
+    # Process connectivity matrix, on disk when a memory budget is set
+    with profile_stage(profile, 'connectome_stack', output_dir, cprofile_stages) as counts:
+        stack_path = os.path.join(output_dir, 'conn_stack.npy') if max_memory else None
+        if runs is not None:
+            used_files = runs.loc[runs['participant_id'].isin(pheno_filtered_qc_fd['participant_id']), 'path']
+        else:
+            used_files = connectome_files.loc[connectome_files.index.isin(pheno_filtered_qc_fd['participant_id'])]
+        (conn_stack, final_df), stack_key = cached_stage(
+            cache_dir, 'connectome_stack',
+            [subjects_key, fd_key, list(pheno_filtered_qc_fd['participant_id']), file_signature([atlas_file]), dtype,
+             file_signature(used_files.sort_index()), None if runs is None else [run_weights, runs['weight'].tolist()]],
+            lambda: process_connectivity_matrix(
+                pheno_filtered_fd=pheno_filtered_qc_fd,
+                connectome_t=dict_halfpipe['connectome_t'],
+                feature=feature,
+                atlas=atlas,
+                bids_dir=bids_dir,
+                conn_mask=conn_mask,
+                session=session,
+                task=task,
+                run=run,
+                stack_path=stack_path,
+                store_dir=store_dir,
+                n_jobs=n_jobs,
+                bids_index=bids_index,
+                runs=runs
+                ),
+            kind='stack')
+        counts.update(subjects=conn_stack.shape[0], edges=conn_stack.shape[1], files=len(used_files))
+
+    # Fisher z, partial correlation or tangent-space connectomes, in chunks of subjects
+    if transforms:
+        with profile_stage(profile, 'transform', output_dir, cprofile_stages) as counts:
+            # In place only on a stack of this analysis, never on the connectome store or a checkpoint
+            on_disk = getattr(conn_stack, 'filename', None)
+            in_place = transforms == ['fisher_z'] and conn_stack.flags.writeable and \
+                (on_disk is None or stack_path is not None and os.path.samefile(on_disk, stack_path))
+            transformed_path = os.path.join(output_dir, 'conn_stack_transform.npy') if max_memory and not in_place else None
+            out = conn_stack if in_place else None
+            if transformed_path is not None:
+                out = np.lib.format.open_memmap(transformed_path, mode='w+', dtype=conn_stack.dtype, shape=conn_stack.shape)
+            reference_path = os.path.join(output_dir, f'cwas_{case_name}_{control_name}_rsfmri_{feature}_{atlas}_tangent_reference.npy')
+            transformed = transform_connectomes(output_dir, conn_stack, conn_mask, transforms, out=out,
+                                                max_memory=max_memory, reference_path=reference_path)
+            counts.update(subjects=conn_stack.shape[0], edges=conn_stack.shape[1])
+            stack_key = [stack_key, transforms]
+
+            if not in_place:
+                del conn_stack
+                if stack_path is not None and os.path.exists(stack_path):
+                    os.remove(stack_path)
+                conn_stack, stack_path = transformed, transformed_path
+
+    # Remove scanner effects from every edge, keeping the biological covariates
+    combat_key = None
+    if combat:
+        with profile_stage(profile, 'harmonization', output_dir, cprofile_stages) as counts:
+            combat_path = os.path.join(output_dir, f'cwas_{case_name}_{control_name}_rsfmri_{feature}_{atlas}_combat.npz')
+            harmonized_path = os.path.join(output_dir, 'conn_stack_combat.npy') if max_memory else None
+            out = None
+            if harmonized_path is not None:
+                out = np.lib.format.open_memmap(harmonized_path, mode='w+', dtype=conn_stack.dtype, shape=conn_stack.shape)
+            harmonized = combat_harmonize(output_dir, conn_stack, final_df, group=group, case=1, control=0,
+                                          regressors=shared["regressors"], batch_col='scanner',
+                                          params_path=combat_params, save_path=combat_path, out=out,
+                                          max_memory=max_memory)
+            counts.update(subjects=conn_stack.shape[0], edges=conn_stack.shape[1])
+            combat_key = [True, file_signature([combat_params]) if combat_params is not None else None]
+
+            # Only the harmonized stack is needed from here
+            del conn_stack
+            if stack_path is not None and os.path.exists(stack_path):
+                os.remove(stack_path)
+            conn_stack, stack_path = harmonized, harmonized_path
+
+    # Shard mode: fit one slice of the edges, the shards are assembled by run_merge_shards
+    if shard is not None:
+        with profile_stage(profile, 'glm', output_dir, cprofile_stages) as counts:
+            summary = export_shard(output_dir, conn_stack, final_df, shard, roi_labels, atlas_file, group,
+                                   case_name, control_name, atlas, feature, shared["regressors"],
+                                   glm_engine=glm_engine, max_memory=max_memory, n_perm=n_perm, seed=seed,
+                                   n_jobs=n_jobs, design_cache=shared["design_cache"], robust=robust,
+                                   combat=combat)
+            counts.update(subjects=conn_stack.shape[0], edges=summary["n_edges"], permutations=n_perm)
+            del conn_stack
+            if stack_path is not None and os.path.exists(stack_path):
+                os.remove(stack_path)
+        save_profile(output_dir, shared, profile)
+        return summary
 
     # Perform CWAS analysis
-    glm_con = glm_wrap_cc(output_dir, conn_stack, final_df,
-                            group=group, case=1, control=0, 
-                            regressors=regressors, report=True)
+    with profile_stage(profile, 'glm', output_dir, cprofile_stages) as counts:
+        glm_con, _ = cached_stage(
+            cache_dir, 'glm',
+            [stack_key, group, shared["regressors"], glm_engine, n_perm, seed, nbs_threshold, robust, combat_key],
+            lambda: glm_wrap_cc(output_dir, conn_stack, final_df,
+                                group=group, case=1, control=0,
+                                regressors=shared["regressors"], report=True,
+                                engine=glm_engine, max_memory=max_memory,
+                                n_perm=n_perm, seed=seed, n_jobs=n_jobs,
+                                design_cache=shared["design_cache"],
+                                nbs_threshold=nbs_threshold, conn_mask=conn_mask, robust=robust),
+            report_dir=output_dir)
+        counts.update(subjects=conn_stack.shape[0], edges=len(glm_con), permutations=n_perm)
+
+    # Other effects, all contrasts in one pass over the edges
+    contrast_tables = {}
+    if contrasts:
+        with profile_stage(profile, 'contrasts', output_dir, cprofile_stages) as counts:
+            contrast_tables, _ = cached_stage(
+                cache_dir, 'contrasts',
+                [stack_key, group, shared["regressors"], extra_terms, combat_key,
+                 {name: np.asarray(spec).tolist() for name, spec in contrasts.items()}],
+                lambda: glm_contrasts(output_dir, conn_stack, final_df, group=group, case=1, control=0,
+                                      contrasts=contrasts, regressors=shared["regressors"],
+                                      extra_terms=extra_terms, report=True, max_memory=max_memory,
+                                      design_cache=shared["design_cache"]),
+                report_dir=output_dir)
+            counts.update(edges=conn_stack.shape[1], contrasts=len(contrasts))
+
+    # The GLM tables are all we need from the on-disk stack
+    del conn_stack
+    if stack_path is not None and os.path.exists(stack_path):
+        os.remove(stack_path)
 
     # Get results
-    table_con, table_stand_beta, table_qval = summarize_glm(
-        glm_con, 
-        conn_mask, 
-        roi_labels
-        )
-
-    save_glm(
-        out_p=output_dir, 
+    with profile_stage(profile, 'save', output_dir, cprofile_stages) as counts:
+        table_con, table_stand_beta, table_qval = summarize_glm(
+            glm_con,
+            conn_mask,
+            roi_labels
+            )
+
+        results_path = save_glm(
+            out_p=output_dir,
+            table_con=table_con,
+            table_stand_beta_con=table_stand_beta,
+            table_qval_con=table_qval,
+            conn_mask=conn_mask,
+            roi_labels=roi_labels,
+            case_name=case_name,
+            control_name=control_name,
+            feature=feature,
+            atlas=atlas,
+            output_format=output_format)
+        counts['edges'] = len(table_con)
+
+        contrast_paths = {}
+        for name, contrast_table in contrast_tables.items():
+            contrast_con, contrast_stand_beta, contrast_qval = summarize_glm(contrast_table, conn_mask, roi_labels)
+            contrast_paths[name] = save_glm(out_p=output_dir, table_con=contrast_con,
+                                            table_stand_beta_con=contrast_stand_beta,
+                                            table_qval_con=contrast_qval, conn_mask=conn_mask, roi_labels=roi_labels,
+                                            case_name=case_name, control_name=control_name, feature=feature,
+                                            atlas=atlas, output_format=output_format, suffix=f'_contrast-{name}')
+
+    with profile_stage(profile, 'plot', output_dir, cprofile_stages) as counts:
+        pvals, correction = corrected_pvalues(table_con)
+        plot_connectome_results(output_path=output_dir,
+                                betas=table_con.stand_betas.values,
+                                pvals=pvals,
+                                correction=correction,
+                                labels=roi_labels,
+                                triangle=conn_mask,
+                                mode=plot_mode,
+                                networks=read_atlas_networks(atlas_file)
+                                )
+        counts['rois'] = conn_mask.n_roi
+
+    save_profile(output_dir, shared, profile)
+
+    return {
+        "n_subjects": len(final_df),
+        "n_edges": len(table_con),
+        "n_significant_fdr": int((table_con['qval'] < 0.05).sum()),
+        "results_table": results_path,
+        "contrast_tables": contrast_paths,
+    }
+
+def export_site_stats(output_dir, pheno, connectome_t, bids_dir, bids_index, conn_mask, roi_labels,
+                      group, case_name, control_name, session, task, run, atlas, feature, regressors,
+                      site_name, n_jobs=1, max_memory=None):
+    """
+    Write the sufficient statistics of a site, to be merged with the other sites.
+    """
+    print(f"\n⏳ Computing sufficient statistics for site {site_name} ...")
+    connectome_paths, indices = find_connectome_paths(pheno, connectome_t, feature, atlas, bids_dir,
+                                                      session, task, run, bids_index=bids_index)
+    stats = site_sufficient_stats(connectome_paths, pheno.loc[indices], group, case=1, control=0,
+                                  conn_mask=conn_mask, regressors=regressors,
+                                  n_jobs=n_jobs, max_memory=max_memory)
+
+    stats_path = os.path.join(output_dir, f'cwas_{case_name}_{control_name}_rsfmri_{feature}_{atlas}_site-{site_name}_stats.npz')
+    save_sufficient_stats(stats_path, stats, {
+        "site": site_name, "group": group, "case_name": case_name, "control_name": control_name,
+        "session": session, "task": task, "run": run, "atlas": atlas, "feature": feature,
+        "roi_labels": roi_labels,
+    })
+    report_file(output_dir, {
+        'federated site': site_name,
+        'site sample': f'n={stats["n_obs"]}',
+        'site controls': f'n={stats["n_control"]}',
+        'sufficient statistics': stats_path,
+    })
+
+    return {
+        "n_subjects": int(stats["n_obs"]),
+        "n_edges": int(stats["yty"].shape[0]),
+        "site_stats": stats_path,
+    }
+
+def export_incremental(output_dir, pheno, connectome_t, bids_dir, bids_index, conn_mask, roi_labels, atlas_file,
+                       group, case_name, control_name, session, task, run, atlas, feature, regressors,
+                       incremental_dir, check=False, n_jobs=1, max_memory=None, plot_mode="auto", output_format="tsv"):
+    """
+    Update the incremental state of the analysis with the current subjects, then save and plot the results.
+    """
+    print(f"\n⏳ Updating the incremental CWAS in {incremental_dir} ...")
+    connectome_paths, indices = find_connectome_paths(pheno, connectome_t, feature, atlas, bids_dir,
+                                                      session, task, run, bids_index=bids_index)
+    key = f'{store_key(session, task, run, atlas, feature)}_{case_name}_{control_name}'
+    glm_con, stats, update = update_incremental(output_dir, incremental_dir, key, pheno.loc[indices], connectome_paths,
+                                        group, case=1, control=0, conn_mask=conn_mask, regressors=regressors,
+                                        n_jobs=n_jobs, max_memory=max_memory, check=check)
+    report_file(output_dir, {
+        'sample': f'n={int(stats["n_obs"])}',
+        'controls': f'n={int(stats["n_control"])}',
+        'data points available': f'{len(glm_con)}',
+    })
+
+    table_con, table_stand_beta, table_qval = summarize_glm(glm_con, conn_mask, roi_labels)
+    results_path = save_glm(
+        out_p=output_dir,
         table_con=table_con,
         table_stand_beta_con=table_stand_beta,
         table_qval_con=table_qval,
@@ -93,10 +500,265 @@ def run_pipeline(bids_dir, output_dir, pheno_p, atlas_file, atlas, group,
         case_name=case_name,
         control_name=control_name,
         feature=feature,
-        atlas=atlas)
-    
-    plot_interactive_matrix(output_path=output_dir,
-                            beta_matrix=table_stand_beta, 
-                            pvalues_matrix=table_qval, 
-                            labels=roi_labels
-                            )
\ No newline at end of file
+        atlas=atlas,
+        output_format=output_format)
+
+    pvals, correction = corrected_pvalues(table_con)
+
+    plot_connectome_results(output_path=output_dir,
+                            betas=table_con.stand_betas.values,
+                            pvals=pvals,
+                            correction=correction,
+                            labels=roi_labels,
+                            triangle=conn_mask,
+                            mode=plot_mode,
+                            networks=read_atlas_networks(atlas_file)
+                            )
+
+    return {
+        "n_subjects": int(stats["n_obs"]),
+        "n_edges": len(table_con),
+        "n_significant_fdr": int((table_con['qval'] < 0.05).sum()),
+        "results_table": results_path,
+        "files_read": update["files read"],
+    }
+
+def export_shard(output_dir, conn_stack, pheno, shard, roi_labels, atlas_file, group, case_name, control_name,
+                 atlas, feature, regressors, glm_engine="vectorized", max_memory=None, n_perm=0, seed=None,
+                 n_jobs=1, design_cache=None, robust=None, combat=False):
+    """
+    Fit the GLM on one slice of the edges and write it, with the permutation null, to a shard file.
+    """
+    index, count = shard
+    n_edges = conn_stack.shape[1]
+    start, stop = shard_edges(n_edges, index, count)
+    print(f"\n⏳ Fitting shard {index}/{count}: edges {start} to {stop - 1} of {n_edges} ...")
+
+    null_dist = {}
+    glm_con = glm_wrap_cc(output_dir, conn_stack[:, start:stop], pheno, group=group, case=1, control=0,
+                          regressors=regressors, report=True, engine=glm_engine, max_memory=max_memory,
+                          n_perm=n_perm, seed=seed, n_jobs=n_jobs, design_cache=design_cache, null_dist=null_dist,
+                          robust=robust)
+
+    shard_path = os.path.join(output_dir, f'cwas_{case_name}_{control_name}_rsfmri_{feature}_{atlas}_shard-{index}of{count}.npz')
+    save_shard(shard_path, glm_con, null_dist, {
+        "index": index, "count": count, "start": start, "stop": stop, "n_edges": n_edges,
+        "group": group, "case_name": case_name, "control_name": control_name, "atlas": atlas,
+        "feature": feature, "roi_labels": roi_labels, "networks": read_atlas_networks(atlas_file),
+        "n_subjects": len(pheno), "n_perm": n_perm, "seed": seed, "robust": robust, "combat": combat,
+    })
+    report_file(output_dir, {'shard': f'{index}/{count}', 'shard edges': f'{start}-{stop - 1}', 'shard file': shard_path})
+
+    return {
+        "n_subjects": len(pheno),
+        "n_edges": stop - start,
+        "shard": shard_path,
+    }
+
+def run_merge_shards(shard_files, output_dir, plot_mode="auto", output_format="tsv"):
+    """
+    Assemble the shards of one CWAS, then correct, save and plot the results over all edges.
+    """
+    check_output_format(output_format)
+    create_output_directory(output_dir)
+    print(f"\n⏳ Merging {len(shard_files)} shards ...")
+
+    shards, shard_metadata = zip(*[load_shard(path) for path in shard_files])
+    glm_con = merge_shards(shards, shard_metadata)
+    reference = shard_metadata[0]
+
+    roi_labels = reference["roi_labels"]
+    conn_mask = ConnectomeTriangle(len(roi_labels))
+    report_file(output_dir, {
+        'merged shards': reference["count"],
+        'sample': f'n={reference["n_subjects"]}',
+        'data points available': f'{len(glm_con)}',
+    })
+
+    table_con, table_stand_beta, table_qval = summarize_glm(glm_con, conn_mask, roi_labels)
+    results_path = save_glm(
+        out_p=output_dir,
+        table_con=table_con,
+        table_stand_beta_con=table_stand_beta,
+        table_qval_con=table_qval,
+        conn_mask=conn_mask,
+        roi_labels=roi_labels,
+        case_name=reference["case_name"],
+        control_name=reference["control_name"],
+        feature=reference["feature"],
+        atlas=reference["atlas"],
+        output_format=output_format)
+
+    pvals, correction = corrected_pvalues(table_con)
+
+    plot_connectome_results(output_path=output_dir,
+                            betas=table_con.stand_betas.values,
+                            pvals=pvals,
+                            correction=correction,
+                            labels=roi_labels,
+                            triangle=conn_mask,
+                            mode=plot_mode,
+                            networks=reference["networks"]
+                            )
+
+    return {
+        "n_subjects": reference["n_subjects"],
+        "n_edges": len(table_con),
+        "n_significant_fdr": int((table_con['qval'] < 0.05).sum()),
+        "results_table": results_path,
+    }
+
+def run_merge_sites(site_files, output_dir, site_effects=True, plot_mode="auto", output_format="tsv"):
+    """
+    Pooled CWAS of several sites from their sufficient statistics.
+    """
+    check_output_format(output_format)
+    create_output_directory(output_dir)
+    print(f"\n⏳ Merging sufficient statistics of {len(site_files)} sites ...")
+
+    site_stats, site_metadata = zip(*[load_sufficient_stats(path) for path in site_files])
+    reference = site_metadata[0]
+    for metadata in site_metadata[1:]:
+        for name in ["group", "atlas", "feature", "roi_labels"]:
+            if metadata[name] != reference[name]:
+                raise ValueError(f"❌ Sites {reference['site']} and {metadata['site']} differ in {name}")
+
+    site_names = [metadata["site"] for metadata in site_metadata]
+    if len(set(site_names)) != len(site_names):
+        raise ValueError(f"❌ Site names must be unique: {site_names}")
+    merged = merge_sufficient_stats(site_stats, site_names, site_effects=site_effects and len(site_names) > 1)
+    glm_con = glm_sufficient_stats(merged, reference["group"])
+
+    roi_labels = reference["roi_labels"]
+    conn_mask = ConnectomeTriangle(len(roi_labels))
+    summary_data = {
+        'federated sites': {name: f'n={int(stats["n_obs"])}' for name, stats in zip(site_names, site_stats)},
+        'pooled sample': f'n={int(merged["n_obs"])}',
+        'site effects': bool(site_effects and len(site_names) > 1),
+        'pooled design': merged['columns'],
+    }
+    report_file(output_dir, summary_data)
+
+    table_con, table_stand_beta, table_qval = summarize_glm(glm_con, conn_mask, roi_labels)
+    results_path = save_glm(
+        out_p=output_dir,
+        table_con=table_con,
+        table_stand_beta_con=table_stand_beta,
+        table_qval_con=table_qval,
+        conn_mask=conn_mask,
+        roi_labels=roi_labels,
+        case_name=reference["case_name"],
+        control_name=reference["control_name"],
+        feature=reference["feature"],
+        atlas=reference["atlas"],
+        output_format=output_format)
+
+    pvals, correction = corrected_pvalues(table_con)
+
+    plot_connectome_results(output_path=output_dir,
+                            betas=table_con.stand_betas.values,
+                            pvals=pvals,
+                            correction=correction,
+                            labels=roi_labels,
+                            triangle=conn_mask,
+                            mode=plot_mode
+                            )
+
+    return {
+        "n_subjects": int(merged["n_obs"]),
+        "n_edges": len(table_con),
+        "n_significant_fdr": int((table_con['qval'] < 0.05).sum()),
+        "results_table": results_path,
+    }
+
+def run_pipeline(bids_dir, output_dir, pheno_p, atlas_file, atlas, group,
+                scanner, sequence, medication, case_name, control_name,
+                session, task, run, feature, glm_engine="vectorized", max_memory=None,
+                store_dir=None, n_jobs=1, bids_index_cache=None, n_perm=0, seed=None, checkpoint=False,
+                site_name=None, dtype="float64", plot_mode="auto", cprofile_stages=(),
+                fd_cache=None, fd_threshold=0.5, max_percent_scrubbed=None, nbs_threshold=None, shard=None,
+                output_format="tsv", robust=None, combat=False, combat_params=None,
+                contrasts=None, extra_terms="", transforms=None, run_weights="equal",
+                incremental_dir=None, incremental_check=False):
+
+    shared = prepare_shared_inputs(bids_dir, output_dir, pheno_p, group, scanner, sequence, medication,
+                                   case_name, control_name, bids_index_cache=bids_index_cache,
+                                   checkpoint=checkpoint, cprofile_stages=cprofile_stages,
+                                   fd_cache=fd_cache)
+
+    return run_analysis(shared, output_dir, atlas_file, atlas, group, case_name, control_name,
+                        session, task, run, feature, glm_engine=glm_engine,
+                        max_memory=parse_memory(max_memory), store_dir=store_dir,
+                        n_jobs=n_jobs, n_perm=n_perm, seed=seed, site_name=site_name, dtype=dtype,
+                        plot_mode=plot_mode, fd_threshold=fd_threshold,
+                        max_percent_scrubbed=max_percent_scrubbed, nbs_threshold=nbs_threshold,
+                        shard=shard, output_format=output_format, robust=robust,
+                        combat=combat, combat_params=combat_params, contrasts=contrasts,
+                        extra_terms=extra_terms, transforms=transforms, run_weights=run_weights,
+                        incremental_dir=incremental_dir, incremental_check=incremental_check)
+
+def run_batch(bids_dir, output_dir, pheno_p, combinations, group,
+              scanner, sequence, medication, case_name, control_name,
+              glm_engine="vectorized", max_memory=None, store_dir=None, n_jobs=1,
+              bids_index_cache=None, n_perm=0, seed=None, batch_jobs=None, checkpoint=False, site_name=None,
+              dtype="float64", plot_mode="auto", cprofile_stages=(),
+              fd_cache=None, fd_threshold=0.5, max_percent_scrubbed=None, nbs_threshold=None, shard=None,
+              output_format="tsv", robust=None, combat=False, combat_params=None,
+              contrasts=None, extra_terms="", transforms=None, run_weights="equal",
+              incremental_dir=None, incremental_check=False):
+    """
+    Run several session/task/run/atlas/feature combinations in one invocation.
+    The BIDS index, phenotype, FD tables and design factorizations are shared, and
+    the combinations run concurrently. Each one is saved in its own sub-directory
+    and a summary index of all results is written in output_dir.
+    """
+    shared = prepare_shared_inputs(bids_dir, output_dir, pheno_p, group, scanner, sequence, medication,
+                                   case_name, control_name, bids_index_cache=bids_index_cache,
+                                   checkpoint=checkpoint, cprofile_stages=cprofile_stages,
+                                   fd_cache=fd_cache)
+    max_memory = parse_memory(max_memory)
+    batch_jobs = batch_jobs or min(len(combinations), os.cpu_count() or 1)
+    if cprofile_stages and batch_jobs > 1:
+        # Only one cProfile profiler can be active at a time in a process
+        print("❗️ cProfile stages are profiled one analysis at a time: the combinations run sequentially")
+        batch_jobs = 1
+    print(f"\n📌 Running {len(combinations)} analyses with {batch_jobs} concurrent jobs")
+
+    def run_combination(combination):
+        combination_dir = os.path.join(output_dir, store_key(combination["session"], combination["task"],
+                                                             combination["run"], combination["atlas"],
+                                                             combination["feature"]))
+        summary = dict(combination, output_dir=combination_dir)
+        try:
+            summary.update(run_analysis(shared, combination_dir, combination["atlas_file"], combination["atlas"],
+                                        group, case_name, control_name, combination["session"],
+                                        combination["task"], combination["run"], combination["feature"],
+                                        glm_engine=glm_engine, max_memory=max_memory, store_dir=store_dir,
+                                        n_jobs=n_jobs, n_perm=n_perm, seed=seed, site_name=site_name,
+                                        dtype=dtype, plot_mode=plot_mode, fd_threshold=fd_threshold,
+                                        max_percent_scrubbed=max_percent_scrubbed,
+                                        nbs_threshold=nbs_threshold, shard=shard,
+                                        output_format=output_format, robust=robust,
+                                        combat=combat, combat_params=combat_params,
+                                        contrasts=contrasts, extra_terms=extra_terms,
+                                        transforms=transforms, run_weights=run_weights,
+                                        incremental_dir=incremental_dir,
+                                        incremental_check=incremental_check))
+            summary["status"] = "ok"
+        except Exception as e:
+            summary["status"] = f"failed: {e}"
+        return summary
+
+    with ThreadPoolExecutor(max_workers=batch_jobs) as pool:
+        summaries = list(pool.map(run_combination, combinations))
+
+    index = pd.DataFrame(summaries)
+    index_path = os.path.join(output_dir, 'cwas_batch_index.tsv')
+    index.to_csv(index_path, sep='\t', index=False)
+    print(f"\n✅ Batch summary saved in: {index_path}")
+
+    failed = index[index['status'] != 'ok']
+    if not failed.empty:
+        raise RuntimeError(f"❌ {len(failed)} of {len(index)} analyses failed, see {index_path}")
+
+    return index